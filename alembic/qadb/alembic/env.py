@@ -62,16 +62,31 @@ def run_migrations_online() -> None:
     In this scenario we need to create an Engine
     and associate a connection with the context.
 
+    A connection given in config.attributes['connection'] (e.g., by
+    qadb-migrate-rehearse) is used instead of the url in db.cfg.
+
     """
+    connection = config.attributes.get('connection', None)
+    if connection is not None:
+        do_run_migrations(connection)
+        return
+
     connectable = create_engine(get_url())
 
     with connectable.connect() as connection:
-        context.configure(
-            connection=connection, target_metadata=target_metadata, compare_type=True
-        )
+        do_run_migrations(connection)
+
+
+def do_run_migrations(connection) -> None:
+    # each revision is committed on its own, so that the locks it takes are
+    # released before the next one (and qadb.migration can use autocommit_block)
+    context.configure(
+        connection=connection, target_metadata=target_metadata, compare_type=True,
+        transaction_per_migration=True,
+    )
 
-        with context.begin_transaction():
-            context.run_migrations()
+    with context.begin_transaction():
+        context.run_migrations()
 
 
 if context.is_offline_mode():
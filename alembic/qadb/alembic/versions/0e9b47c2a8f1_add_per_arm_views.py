@@ -0,0 +1,62 @@
+"""add per-arm views
+
+Revision ID: 0e9b47c2a8f1
+Revises: 71c0e5b8d3a9
+Create Date: 2026-10-18 17:05:31.802219
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0e9b47c2a8f1'
+down_revision: Union[str, None] = '71c0e5b8d3a9'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+ARMS = ['b', 'r', 'n', 'm']
+
+# as qadb.models.PER_ARM_COLUMNS at this revision
+PER_ARM_COLUMNS = {
+    'throughput': {'mean': 'throughput_{arm}_mean',
+                   'median': 'throughput_{arm}_median',
+                   'sigma': 'throughput_{arm}_sigma',
+                   'wavelength_ref': 'wavelength_ref_{arm}'},
+    'noise': {'mean': 'noise_{arm}_mean',
+              'median': 'noise_{arm}_median',
+              'sigma': 'noise_{arm}_sigma',
+              'wavelength_ref': 'wavelength_ref_{arm}'},
+    'sky': {'mean': 'sky_background_{arm}_mean',
+            'median': 'sky_background_{arm}_median',
+            'sigma': 'sky_background_{arm}_sigma',
+            'wavelength_ref': 'wavelength_ref_{arm}'},
+    'exposure_time': {'effective_exposure_time': 'effective_exposure_time_{arm}'},
+}
+
+
+def view_sql(tableName, dialect):
+    columns = PER_ARM_COLUMNS[tableName]
+    if dialect == 'postgresql':
+        values = ', '.join('(' + ', '.join([f"'{arm}'"] + [f't.{c.format(arm=arm)}' for c in columns.values()]) + ')'
+                           for arm in ARMS)
+        return ('SELECT t.pfs_visit_id, v.arm, ' + ', '.join(f'v.{name}' for name in columns)
+                + f' FROM {tableName} AS t CROSS JOIN LATERAL (VALUES {values})'
+                + f' AS v (arm, {", ".join(columns)})')
+    return ' UNION ALL '.join(
+        f"SELECT pfs_visit_id, '{arm}' AS arm, "
+        + ', '.join(f'{c.format(arm=arm)} AS {name}' for name, c in columns.items())
+        + f' FROM {tableName}' for arm in ARMS)
+
+
+def upgrade() -> None:
+    dialect = op.get_bind().dialect.name
+    for tableName in PER_ARM_COLUMNS:
+        op.execute(f'CREATE VIEW {tableName}_per_arm AS {view_sql(tableName, dialect)}')
+
+
+def downgrade() -> None:
+    for tableName in PER_ARM_COLUMNS:
+        op.execute(f'DROP VIEW IF EXISTS {tableName}_per_arm')
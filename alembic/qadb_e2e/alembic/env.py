@@ -21,6 +21,12 @@ if config.config_file_name is not None:
 from qadb import models
 target_metadata = models.Base.metadata
 
+
+def include_object(object, name, type_, reflected, compare_to):
+    # the tables of the later qadb revisions (visit_summary, rollups, ...)
+    # belong to alembic/qadb only, see models.QADB_ONLY_TABLES
+    return not (type_ == 'table' and name in models.QADB_ONLY_TABLES)
+
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
 # my_important_option = config.get_main_option("my_important_option")
@@ -48,6 +54,7 @@ def run_migrations_offline() -> None:
     context.configure(
         url=url,
         target_metadata=target_metadata,
+        include_object=include_object,
         literal_binds=True,
         dialect_opts={"paramstyle": "named"},
     )
@@ -62,16 +69,31 @@ def run_migrations_online() -> None:
     In this scenario we need to create an Engine
     and associate a connection with the context.
 
+    A connection given in config.attributes['connection'] (e.g., by
+    qadb-migrate-rehearse) is used instead of the url in db.cfg.
+
     """
+    connection = config.attributes.get('connection', None)
+    if connection is not None:
+        do_run_migrations(connection)
+        return
+
     connectable = create_engine(get_url())
 
     with connectable.connect() as connection:
-        context.configure(
-            connection=connection, target_metadata=target_metadata, compare_type=True
-        )
+        do_run_migrations(connection)
+
 
-        with context.begin_transaction():
-            context.run_migrations()
+def do_run_migrations(connection) -> None:
+    # each revision is committed on its own, so that the locks it takes are
+    # released before the next one (and qadb.migration can use autocommit_block)
+    context.configure(
+        connection=connection, target_metadata=target_metadata, compare_type=True,
+        include_object=include_object, transaction_per_migration=True,
+    )
+
+    with context.begin_transaction():
+        context.run_migrations()
 
 
 if context.is_offline_mode():
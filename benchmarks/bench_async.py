@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+'''Compare concurrent per-visit writes of AsyncQaDB with the sequential QaDB
+
+usage: python benchmarks/bench_async.py [--nvisits 200] [--url postgresql://...]
+
+The url is given for the sync driver (sqlite:// or postgresql://) and is
+translated to aiosqlite / asyncpg for the async client.
+'''
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from qadb import models
+from qadb.qadb import QaDB
+from qadb.asyncqadb import AsyncQaDB
+
+TABLES = ['seeing', 'transparency', 'moon', 'telescope', 'guide_offset']
+
+
+def make_visit(pfs_visit_id, rng):
+    ''' one row for each per-visit table '''
+    dfs = {}
+    for tableName in TABLES:
+        table = models.Base.metadata.tables[tableName]
+        data = {c.name: [rng.uniform(0, 1)] for c in table.columns if c.name != 'pfs_visit_id'}
+        data['pfs_visit_id'] = [pfs_visit_id]
+        dfs[tableName] = pd.DataFrame(data)
+    return dfs
+
+
+def async_url(url):
+    if url.startswith('sqlite://'):
+        return url.replace('sqlite://', 'sqlite+aiosqlite://', 1)
+    return url.replace('postgresql://', 'postgresql+asyncpg://', 1)
+
+
+def run_sync(url, visits):
+    db = QaDB(url)
+    t0 = time.perf_counter()
+    for dfs in visits:
+        for tableName, df in dfs.items():
+            db.upsert(tableName, df)
+    elapsed = time.perf_counter() - t0
+    db.close()
+    return elapsed
+
+
+async def run_async(url, visits):
+    db = AsyncQaDB(async_url(url))
+
+    async def write(dfs):
+        for tableName, df in dfs.items():
+            await db.upsert(tableName, df)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*[write(dfs) for dfs in visits])
+    elapsed = time.perf_counter() - t0
+    await db.close()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nvisits', type=int, default=200)
+    parser.add_argument('--url', type=str, default=None,
+                        help='database url (default: temporary sqlite file)')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    visits = [make_visit(i, rng) for i in range(args.nvisits)]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        url = args.url or f'sqlite:///{os.path.join(tmpdir, "bench.sqlite")}'
+        models.make_database(url)
+        results = {'sync': run_sync(url, visits)}
+        models.make_database(url)
+        results['async'] = asyncio.run(run_async(url, visits))
+
+    for name, elapsed in results.items():
+        print(f'{name:>6s}: {elapsed:8.3f} s  {args.nvisits / elapsed:10.1f} visits/s')
+
+
+if __name__ == '__main__':
+    main()
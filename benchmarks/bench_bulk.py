@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+'''Compare the ways to insert many rows of a qadb.models class
+
+usage: python benchmarks/bench_bulk.py [--nrows 100000] [--table seeing_agc_exposure] [--url sqlite:///...]
+
+The same synthetic rows (benchmarks/synthetic.py) are inserted into an empty
+table with
+    orm_add_all : Session.add_all of the objects built with the __init__ of the model
+                  (and setattr for the columns which it does not take)
+    bulk_insert_mappings : Session.bulk_insert_mappings of the dicts
+    core_executemany : models.bulk_insert with the column arrays (Core insert with executemany)
+The table is emptied before each method. The url should be a throwaway database.
+'''
+
+import argparse
+import inspect
+import os
+import tempfile
+import time
+
+from sqlalchemy import create_engine, delete
+from sqlalchemy.orm import Session
+
+from qadb import models
+
+import synthetic
+
+
+def ormAddAll(engine, model, df):
+    names = list(inspect.signature(model.__init__).parameters)[1:]
+    # the columns which __init__ does not take (e.g., spectrograph of detector_map)
+    rest = [k for k in df.columns if k not in names]
+    objects = []
+    for r in models.bulk_rows(model, df, batchsize=len(df)):
+        for row in r:
+            obj = model(*[row[k] for k in names])
+            for k in rest:
+                setattr(obj, k, row[k])
+            objects.append(obj)
+    with Session(engine) as session:
+        session.add_all(objects)
+        session.commit()
+
+
+def bulkInsertMappings(engine, model, df):
+    with Session(engine) as session:
+        for batch in models.bulk_rows(model, df):
+            session.bulk_insert_mappings(model, batch)
+        session.commit()
+
+
+def coreExecutemany(engine, model, df):
+    models.bulk_insert(engine, model, df)
+
+
+METHODS = [('orm_add_all', ormAddAll),
+           ('bulk_insert_mappings', bulkInsertMappings),
+           ('core_executemany', coreExecutemany)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='compare the bulk insert paths of qadb.models')
+    parser.add_argument('--nrows', type=int, default=100000)
+    parser.add_argument('--table', type=str, default='seeing_agc_exposure',
+                        help='the table of a model (e.g., detector_map)')
+    parser.add_argument('--url', type=str, default=None,
+                        help='throwaway database url (default: temporary sqlite file)')
+    args = parser.parse_args()
+
+    model = next(m.class_ for m in models.Base.registry.mappers if m.local_table.name == args.table)
+    df = synthetic.make_table(args.table, args.nrows)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        url = args.url or f'sqlite:///{os.path.join(tmpdir, "bench.sqlite")}'
+        models.make_database(url)
+        engine = create_engine(url)
+        # the parent rows of the foreign keys
+        for parent in ['pfs_visit', 'data_processing', 'data_qa']:
+            if any(fk.column.table.name == parent for fk in model.__table__.foreign_keys):
+                models.bulk_insert(engine, models.Base.metadata.tables[parent],
+                                   synthetic.make_table(parent, args.nrows))
+
+        results = {}
+        for name, method in METHODS:
+            with engine.begin() as conn:
+                conn.execute(delete(model.__table__))
+            t0 = time.perf_counter()
+            method(engine, model, df)
+            results[name] = time.perf_counter() - t0
+        engine.dispose()
+
+    for name, elapsed in results.items():
+        print(f'{name:>22s}: {elapsed:8.3f} s  {args.nrows / elapsed:12.1f} rows/s  '
+              f'{results["orm_add_all"] / elapsed:6.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+'''Import time of qadb.qadb, checked against a budget
+
+usage: python benchmarks/bench_import.py [--repeat 7] [--budget-ms 250] [--json]
+
+Each run is a fresh interpreter which imports SQLAlchemy first (the cost of
+which qadb cannot avoid) and then qadb.qadb, and constructs a QaDB. The
+median time of the qadb import on top of SQLAlchemy is compared with the
+budget, and the command fails (exit status 1) if it is over the budget, if
+numpy/pandas/logzero are imported by the import (or by that of qadb.writer and
+qadb.asyncqadb afterwards), or if the construction of QaDB creates the engine,
+so that it can be run as a check in CI (see tests/test_import_time.py).
+'''
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# modules which should be imported only when a DataFrame API is used
+DEFERRED = ['numpy', 'pandas', 'logzero']
+
+PROBE = '''
+import json, sys, time
+t0 = time.perf_counter()
+import sqlalchemy.orm, sqlalchemy.dialects.postgresql, sqlalchemy.dialects.sqlite
+t1 = time.perf_counter()
+import qadb.qadb
+t2 = time.perf_counter()
+db = qadb.qadb.QaDB('sqlite://')
+t3 = time.perf_counter()
+import qadb.writer, qadb.asyncqadb
+print(json.dumps({'sqlalchemy_ms': (t1 - t0) * 1e3, 'qadb_ms': (t2 - t1) * 1e3,
+                  'construct_ms': (t3 - t2) * 1e3, 'engine_created': getattr(db, '_engineInstance', db) is not None,
+                  'deferred_imported': [m for m in %r if m in sys.modules]}))
+''' % DEFERRED
+
+
+def probe():
+    env = dict(os.environ)
+    python = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'python')
+    env['PYTHONPATH'] = os.pathsep.join([python] + [p for p in [env.get('PYTHONPATH')] if p])
+    out = subprocess.run([sys.executable, '-c', PROBE], env=env, check=True,
+                         capture_output=True, text=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='check the import time of qadb.qadb')
+    parser.add_argument('--repeat', type=int, default=7)
+    parser.add_argument('--budget-ms', type=float, default=250.0,
+                        help='the budget of the median qadb.qadb import time on top of SQLAlchemy')
+    parser.add_argument('--json', action='store_true', help='print the result as JSON')
+    args = parser.parse_args()
+
+    runs = [probe() for _ in range(args.repeat)]
+    result = {key: statistics.median(r[key] for r in runs)
+              for key in ['sqlalchemy_ms', 'qadb_ms', 'construct_ms']}
+    result['budget_ms'] = args.budget_ms
+    result['engine_created'] = any(r['engine_created'] for r in runs)
+    result['deferred_imported'] = sorted(set(m for r in runs for m in r['deferred_imported']))
+
+    failures = []
+    if result['qadb_ms'] > args.budget_ms:
+        failures.append(f'qadb.qadb import {result["qadb_ms"]:.1f} ms is over the budget {args.budget_ms:.1f} ms')
+    if len(result['deferred_imported']) > 0:
+        failures.append(f'imported by qadb.qadb: {", ".join(result["deferred_imported"])}')
+    if result['engine_created']:
+        failures.append('QaDB() created the engine before it is used')
+    result['ok'] = len(failures) == 0
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print(f'sqlalchemy: {result["sqlalchemy_ms"]:.1f} ms  qadb.qadb: {result["qadb_ms"]:.1f} ms '
+              f'(budget {args.budget_ms:.1f} ms)  QaDB(): {result["construct_ms"]:.2f} ms')
+    for failure in failures:
+        print(f'FAIL: {failure}', file=sys.stderr)
+    if len(failures) > 0:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
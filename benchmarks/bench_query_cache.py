@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+'''Compare the latency of repeated QaDB.query with and without the result cache
+
+usage: python benchmarks/bench_query_cache.py [--nvisits 2000] [--repeat 200] [--url postgresql://...]
+
+The same dashboard-like query is run repeatedly; every --write-every queries a
+row is written to one of the tables it reads, which invalidates the cache.
+'''
+
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from qadb import models
+from qadb.qadb import QaDB
+
+SQL = '''
+SELECT s.pfs_visit_id, s.seeing_mean, t.transparency_mean
+FROM seeing s JOIN transparency t ON t.pfs_visit_id = s.pfs_visit_id
+WHERE s.pfs_visit_id >= 0
+ORDER BY s.pfs_visit_id
+'''
+
+
+def populate(db, nvisits, rng):
+    visits = np.arange(nvisits)
+    db.upsert('pfs_visit', pd.DataFrame({'pfs_visit_id': visits}))
+    db.upsert('seeing', pd.DataFrame({'pfs_visit_id': visits, 'seeing_mean': rng.uniform(0.4, 1.5, nvisits)}))
+    db.upsert('transparency', pd.DataFrame({'pfs_visit_id': visits,
+                                            'transparency_mean': rng.uniform(0, 1, nvisits)}))
+
+
+def run(db, repeat, writeEvery, rng):
+    latencies = []
+    for i in range(repeat):
+        if writeEvery > 0 and i > 0 and i % writeEvery == 0:
+            db.upsert('seeing', pd.DataFrame({'pfs_visit_id': [0], 'seeing_mean': [rng.uniform(0.4, 1.5)]}))
+        t0 = time.perf_counter()
+        db.query(SQL)
+        latencies.append(time.perf_counter() - t0)
+    return np.array(latencies) * 1e3
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nvisits', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--write-every', type=int, default=50)
+    parser.add_argument('--url', type=str, default=None,
+                        help='database url (default: temporary sqlite file)')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        url = args.url or f'sqlite:///{os.path.join(tmpdir, "bench.sqlite")}'
+        models.make_database(url)
+        populate(QaDB(url, refresh_summary=False), args.nvisits, rng)
+
+        for label, kwargs in [('no cache', {}), ('cache', {'cache_bytes': 64 * 1024**2})]:
+            db = QaDB(url, refresh_summary=False, **kwargs)
+            ms = run(db, args.repeat, args.write_every, rng)
+            print(f'{label:>8s}: mean {ms.mean():8.3f} ms  p50 {np.percentile(ms, 50):8.3f} ms  '
+                  f'p99 {np.percentile(ms, 99):8.3f} ms')
+            if db.cacheStats():
+                print(f'          {db.cacheStats()}')
+            db.close()
+
+
+if __name__ == '__main__':
+    main()
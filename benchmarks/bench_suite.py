@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+'''Benchmark suite of the QaDB ingest and query paths, with a JSON report
+
+usage: python benchmarks/bench_suite.py [--sizes 1000 10000 100000] [--url postgresql://...]
+                                        [--output result.json] [--baseline previous.json]
+
+For each size, synthetic rows (benchmarks/synthetic.py) are written to every
+table of qadb.models with populateQATable, and then the query, streaming and
+bulk paths are timed. Each case runs in a forked process so that its peak RSS
+is measured on its own. The database is cloned from the schema template
+(qadb.provision) for each size: a temporary SQLite file by default, or the
+given (throwaway!) database.
+
+Each result has 'case', 'table', 'rows', 'calls', 'seconds', 'rows_per_sec',
+'p50_ms', 'p99_ms' (latency of a call, or of a chunk for the streaming
+cases) and 'peak_rss_mb'. With --baseline, the rows_per_sec are compared with
+a previous report and the command fails if any case is slower than the
+tolerance.
+'''
+
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import sqlalchemy
+
+# the qadb package of this checkout, as in tests/conftest.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'python'))
+
+from qadb import provision  # noqa: E402
+from qadb.qadb import QaDB  # noqa: E402
+
+import synthetic  # noqa: E402
+
+QUERY_TABLES = ['seeing', 'throughput']
+STREAM_TABLE = 'seeing_agc_exposure'
+COPY_TABLE = 'seeing_agc_exposure'
+
+
+def _result(case, tableName, rows, latencies, seconds=None):
+    latencies = np.asarray(latencies, dtype=float)
+    seconds = float(latencies.sum()) if seconds is None else seconds
+    return {'case': case, 'table': tableName, 'rows': int(rows), 'calls': len(latencies),
+            'seconds': seconds, 'rows_per_sec': rows / seconds if seconds > 0 else None,
+            'p50_ms': float(np.percentile(latencies, 50)) * 1e3 if len(latencies) > 0 else None,
+            'p99_ms': float(np.percentile(latencies, 99)) * 1e3 if len(latencies) > 0 else None}
+
+
+def _timedChunks(iterable, latencies):
+    ''' the items of the iterable, recording the time taken by each of them '''
+    t0 = time.perf_counter()
+    for item in iterable:
+        latencies.append(time.perf_counter() - t0)
+        yield item
+        t0 = time.perf_counter()
+
+
+def _peakRSS():
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024**2 if sys.platform == 'darwin' else rss / 1024
+
+
+def _child(conn, func, args):
+    try:
+        results = func(*args)
+        for r in results:
+            r['peak_rss_mb'] = _peakRSS()
+        conn.send(results)
+    except BaseException as e:
+        conn.send(e)
+    finally:
+        conn.close()
+
+
+def inChild(func, *args):
+    ''' run the case in a forked process and return its results with the peak RSS '''
+    ctx = multiprocessing.get_context('fork')
+    parent, child = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=_child, args=(child, func, args))
+    proc.start()
+    results = parent.recv()
+    proc.join()
+    if isinstance(results, BaseException):
+        raise results
+    return results
+
+
+def benchPopulate(url, tableName, nrows, batch):
+    df = synthetic.make_table(tableName, nrows)
+    db = QaDB(url, refresh_summary=False)
+    results = []
+    for case in ['populateQATable_insert', 'populateQATable_update']:
+        latencies = []
+        for i in range(0, nrows, batch):
+            t0 = time.perf_counter()
+            db.populateQATable(tableName, df.iloc[i:i + batch])
+            latencies.append(time.perf_counter() - t0)
+        results.append(_result(case, tableName, nrows, latencies))
+    db.close()
+    return results
+
+
+def benchQuery(url, tableName, nrows, repeat, window=100):
+    db = QaDB(url)
+    rng = np.random.default_rng(0)
+    latencies = []
+    rows = 0
+    for _ in range(repeat):
+        start = int(rng.integers(0, max(nrows - window, 1)))
+        t0 = time.perf_counter()
+        df = db.query(f'SELECT * FROM {tableName} '
+                      f'WHERE pfs_visit_id >= {start} AND pfs_visit_id < {start + window}')
+        latencies.append(time.perf_counter() - t0)
+        rows += len(df)
+    results = [_result('query_window', tableName, rows, latencies)]
+
+    latencies = []
+    rows = 0
+    for _ in range(max(repeat // 20, 3)):
+        t0 = time.perf_counter()
+        df = db.query(f'SELECT * FROM {tableName}')
+        latencies.append(time.perf_counter() - t0)
+        rows += len(df)
+    results.append(_result('query_full', tableName, rows, latencies))
+    db.close()
+    return results
+
+
+def benchStream(url, tableName, chunksize):
+    db = QaDB(url)
+    results = []
+    for case, method in [('queryChunks', db.queryChunks), ('queryRecords', db.queryRecords)]:
+        latencies = []
+        t0 = time.perf_counter()
+        rows = sum(len(chunk) for chunk in _timedChunks(method(f'SELECT * FROM {tableName}',
+                                                               chunksize=chunksize), latencies))
+        results.append(_result(case, tableName, rows, latencies, time.perf_counter() - t0))
+    db.close()
+    return results
+
+
+def benchCopy(url, tableName, nrows, chunksize):
+    df = synthetic.make_table(tableName, nrows, seed=1)
+    db = QaDB(url, refresh_summary=False)
+    latencies = []
+    chunks = (df.iloc[i:i + chunksize] for i in range(0, nrows, chunksize))
+    t0 = time.perf_counter()
+    db.copy_into(tableName, _laps(chunks, latencies))
+    result = _result('copy_into', tableName, nrows, latencies, time.perf_counter() - t0)
+    db.close()
+    return [result]
+
+
+def _laps(chunks, latencies):
+    ''' yield the chunks, recording the time taken by the consumer for each of them '''
+    for chunk in chunks:
+        t0 = time.perf_counter()
+        yield chunk
+        latencies.append(time.perf_counter() - t0)
+
+
+def benchDerived(url, nrows, repeat):
+    results = []
+    db = QaDB(url)
+    latencies = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        r = db.per_arm('throughput')
+        latencies.append(time.perf_counter() - t0)
+    results.append(_result('per_arm', 'throughput', len(r['arm']) * repeat, latencies))
+
+    latencies = []
+    end = synthetic.START + datetime.timedelta(seconds=nrows * synthetic.CADENCE / synthetic.AGC_PER_VISIT)
+    for _ in range(repeat):
+        # a new QaDB for each call, so that the buckets are not served from its cache
+        db2 = QaDB(url)
+        t0 = time.perf_counter()
+        db2.aggregate_agc('seeing_median', synthetic.START, end, bucket='1h')
+        latencies.append(time.perf_counter() - t0)
+        db2.close()
+    results.append(_result('aggregate_agc', 'seeing_agc_exposure', nrows * repeat, latencies))
+
+    t0 = time.perf_counter()
+    db.refreshVisitSummary()
+    results.append(_result('refreshVisitSummary', 'visit_summary', nrows, [time.perf_counter() - t0]))
+    db.close()
+    return results
+
+
+def runSize(url, nrows, tables, args):
+    provision.clone_database(url, replace=True)
+    results = []
+    for tableName in tables:
+        results += inChild(benchPopulate, url, tableName, nrows, args.batch)
+    for tableName in QUERY_TABLES:
+        results += inChild(benchQuery, url, tableName, nrows, args.repeat)
+    results += inChild(benchStream, url, STREAM_TABLE, args.chunksize)
+    results += inChild(benchCopy, url, COPY_TABLE, nrows, args.chunksize)
+    results += inChild(benchDerived, url, nrows, max(args.repeat // 20, 3))
+    return results
+
+
+def metadata(url):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    return {'created_at': datetime.datetime.now().isoformat(timespec='seconds'),
+            'dialect': sqlalchemy.engine.make_url(url).get_backend_name(),
+            'commit': commit or None,
+            'python': platform.python_version(),
+            'sqlalchemy': sqlalchemy.__version__,
+            'pandas': pd.__version__,
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count()}
+
+
+def compare(report, baseline, tolerance):
+    ''' the cases whose rows_per_sec dropped by more than the tolerance from the baseline '''
+    previous = {(r['case'], r['table'], r['size']): r for r in baseline['results']}
+    regressions = []
+    for r in report['results']:
+        old = previous.get((r['case'], r['table'], r['size']))
+        if old is None or not old['rows_per_sec'] or not r['rows_per_sec']:
+            continue
+        ratio = r['rows_per_sec'] / old['rows_per_sec']
+        if ratio < 1 - tolerance:
+            regressions.append((r, ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the QaDB ingest and query paths')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='the number of rows in each table')
+    parser.add_argument('--url', type=str, default=None,
+                        help='throwaway database url, recreated for each size (default: temporary sqlite file)')
+    parser.add_argument('--tables', type=str, nargs='+', default=None,
+                        help='the tables to be populated (default: all)')
+    parser.add_argument('--batch', type=int, default=1000, help='rows per populateQATable call')
+    parser.add_argument('--chunksize', type=int, default=10000, help='rows per chunk of the streaming paths')
+    parser.add_argument('--repeat', type=int, default=100, help='the number of the window queries')
+    parser.add_argument('--output', type=str, default=None, help='JSON report (default: stdout)')
+    parser.add_argument('--baseline', type=str, default=None, help='previous JSON report to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='the allowed fractional drop of rows_per_sec from the baseline')
+    args = parser.parse_args()
+
+    tables = synthetic.tableNames()
+    if args.tables is not None:
+        # the parents of the given tables are populated too, so that the foreign keys hold
+        tables = [t for t in tables if t in set(args.tables) | {'pfs_visit', 'data_processing', 'data_qa'}]
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        url = args.url or f'sqlite:///{os.path.join(tmpdir, "bench.sqlite")}'
+        for nrows in args.sizes:
+            for r in runSize(url, nrows, tables, args):
+                r['size'] = nrows
+                results.append(r)
+                print(f'{nrows:>7d} {r["case"]:<24s} {r["table"]:<26s} {r["rows_per_sec"] or 0:>12.0f} rows/s  '
+                      f'p50 {r["p50_ms"] or 0:9.2f} ms  p99 {r["p99_ms"] or 0:9.2f} ms  '
+                      f'rss {r["peak_rss_mb"]:7.1f} MB', file=sys.stderr)
+        report = {'meta': metadata(url), 'results': results}
+
+    text = json.dumps(report, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for r, ratio in regressions:
+            print(f'regression: {r["case"]} {r["table"]} size {r["size"]}: {ratio:.2f}x', file=sys.stderr)
+        if len(regressions) > 0:
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+'''Compare the bulk upsert with the former row-by-row loop of populateQATable
+
+usage: python benchmarks/bench_upsert.py [--nrows 1000] [--url sqlite:///...]
+'''
+
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine, exc, text
+
+from qadb import models
+from qadb.qadb import QaDB
+
+
+def make_seeing(nrows, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'pfs_visit_id': np.arange(nrows),
+        'seeing_mean': rng.uniform(0.4, 1.5, nrows),
+        'seeing_median': rng.uniform(0.4, 1.5, nrows),
+        'seeing_sigma': rng.uniform(0.0, 0.2, nrows),
+        'wavelength_ref': np.full(nrows, 750.0),
+    })
+
+
+def legacy_populate(engine, tableName, df):
+    ''' the row-by-row loop used by populateQATable before the bulk upsert '''
+    for idx, data in df.iterrows():
+        df_new = pd.DataFrame(data={k: [v] for k, v in data.items()})
+        df_new = df_new.fillna(-1).astype(float)
+        try:
+            df_new.to_sql(tableName, engine, if_exists='append', index=False)
+        except (exc.IntegrityError, pd.errors.DatabaseError):
+            pfs_visit_id = int(data['pfs_visit_id'])
+            keys = ','.join(data.keys())
+            vals = ','.join(str(v) for v in data.values)
+            sqlCmd = text(f'UPDATE {tableName} SET ({keys}) = ({vals}) WHERE pfs_visit_id={pfs_visit_id};')
+            with engine.connect() as conn:
+                conn.execute(sqlCmd)
+                conn.commit()
+
+
+def timeit(func, *args):
+    t0 = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nrows', type=int, default=1000)
+    parser.add_argument('--url', type=str, default=None,
+                        help='database url (default: temporary sqlite file)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        url = args.url or f'sqlite:///{os.path.join(tmpdir, "bench.sqlite")}'
+        models.make_database(url)
+        engine = create_engine(url)
+        db = QaDB(url)
+        df = make_seeing(args.nrows)
+
+        results = {
+            'legacy insert': timeit(legacy_populate, engine, 'seeing', df),
+            'legacy update': timeit(legacy_populate, engine, 'seeing', df),
+        }
+        models.make_database(url)
+        results['upsert insert'] = timeit(db.populateQATable, 'seeing', df)
+        results['upsert update'] = timeit(db.populateQATable, 'seeing', df)
+
+    for name, elapsed in results.items():
+        print(f'{name:>15s}: {elapsed:8.3f} s  {args.nrows / elapsed:12.1f} rows/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+'''Synthetic rows for every QA table in qadb.models
+
+make_tables(nrows) returns {tableName: DataFrame} with nrows rows in each
+table, in the order in which the tables can be written (parents first). The
+values are generated from the column types, and the keys are consistent
+with the foreign keys: the i-th row of a child table refers to a parent row
+which exists in the nrows rows of the parent.
+'''
+
+import datetime
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import BigInteger, Boolean, Date, DateTime, Integer, REAL, String
+
+from qadb import models
+
+# tables derived from the others by the ingest path
+DERIVED_TABLES = ['visit_summary', 'qa_rollup_nightly', 'qa_rollup_monthly', 'qa_table_version',
+                  'qa_table_change']
+
+ARMS = ['b', 'r', 'n', 'm']
+SPECTROGRAPHS = [1, 2, 3, 4]
+# AGC exposures per visit
+AGC_PER_VISIT = 8
+START = datetime.datetime(2024, 1, 1, 20, 0, 0)
+# seconds between visits
+CADENCE = 900
+
+
+def tableNames():
+    return [t.name for t in models.Base.metadata.sorted_tables if t.name not in DERIVED_TABLES]
+
+
+def _keys(table, index):
+    ''' the primary key columns of the rows, unique and within the parents '''
+    pkeys = [c for c in table.primary_key.columns]
+    per = 1
+    keys = {}
+    names = [c.name for c in pkeys]
+    for name, values in [('arm', ARMS), ('spectrograph', SPECTROGRAPHS)]:
+        if name in names:
+            keys[name] = np.array(values)[index // per % len(values)]
+            per *= len(values)
+    own = [c for c in pkeys if c.name not in keys and len(c.foreign_keys) == 0]
+    for c in own:
+        keys[c.name] = index
+    for c in pkeys:
+        if c.name in keys:
+            continue
+        if c.name == 'pfs_visit_id' and len(own) > 0:
+            per *= AGC_PER_VISIT
+        keys[c.name] = index // per
+    return keys
+
+
+def _values(column, index, rng):
+    n = len(index)
+    t = column.type
+    if column.name == 'taken_at' or column.name == 'issued_at':
+        seconds = index * CADENCE / (AGC_PER_VISIT if column.name == 'taken_at' else 1)
+        return pd.Timestamp(START) + pd.to_timedelta(seconds, unit='s')
+    if len(column.foreign_keys) > 0:
+        return index
+    if isinstance(t, BigInteger):
+        return rng.integers(0, 2**40, n)
+    if isinstance(t, Integer):
+        return rng.integers(0, 1000, n)
+    if isinstance(t, REAL):
+        return rng.uniform(0, 1, n).astype(np.float32)
+    if isinstance(t, DateTime):
+        return pd.Timestamp(START) + pd.to_timedelta(index * CADENCE, unit='s')
+    if isinstance(t, Date):
+        return (pd.Timestamp(START) + pd.to_timedelta(index, unit='D')).date
+    if isinstance(t, Boolean):
+        return rng.integers(0, 2, n).astype(bool)
+    if isinstance(t, String):
+        if t.length == 1:
+            return np.array(ARMS)[index % len(ARMS)]
+        return np.char.add(f'{column.name}-', index.astype(str))
+    raise NotImplementedError(f'{column.table.name}.{column.name}: {t}')
+
+
+def make_table(tableName, nrows, seed=0):
+    ''' nrows synthetic rows of the table '''
+    rng = np.random.default_rng(seed)
+    table = models.Base.metadata.tables[tableName]
+    index = np.arange(nrows)
+    data = _keys(table, index)
+    for c in table.columns:
+        if c.name not in data:
+            data[c.name] = _values(c, index, rng)
+    return pd.DataFrame({c.name: data[c.name] for c in table.columns})
+
+
+def make_tables(nrows, seed=0, tables=None):
+    """nrows synthetic rows for each table
+
+    Parameters
+    ----------
+        nrows : the number of rows of each table
+        seed : the random seed
+        tables : the table names (default: all the tables but DERIVED_TABLES)
+
+    Returns
+    ----------
+        dfs : dict of {tableName: DataFrame} in the order of sorted_tables
+    """
+    names = tableNames() if tables is None else [t for t in tableNames() if t in tables]
+    return {name: make_table(name, nrows, seed=seed + i) for i, name in enumerate(names)}
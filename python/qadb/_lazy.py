@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+'''Deferred imports of the modules which are slow to import (numpy, pandas, logzero)
+
+The module is imported on the first attribute access of the proxy, so that
+importing qadb does not pay for them until a DataFrame API is used.
+'''
+
+import importlib
+
+
+class LazyModule(object):
+    ''' proxy of a module which is imported on the first attribute access '''
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+class LazyAttribute(object):
+    ''' proxy of an attribute of a module (e.g., logzero.logger) which is imported on the first use '''
+    def __init__(self, moduleName, name):
+        self._moduleName = moduleName
+        self._name = name
+        self._object = None
+
+    def __getattr__(self, attr):
+        if self._object is None:
+            self._object = getattr(importlib.import_module(self._moduleName), self._name)
+        return getattr(self._object, attr)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+import hashlib
+import os
+import threading
+import uuid
+
+import pyarrow as pa
+from logzero import logger
+
+SUFFIX = '.arrow'
+
+
+class ArrowCache(object):
+    """Query results shared by the processes on a host as Arrow IPC files
+
+    Each result is written once to '{path}/{key}.arrow' and memory-mapped on
+    read, so the processes reading the same result share the pages of the
+    file instead of holding their own copies. The key is a hash of the
+    normalized SQL, the parameters and the versions in qa_table_version of the
+    tables the SQL refers to; a write through QaDB increments these versions,
+    so the results of the earlier versions are not read anymore and are
+    removed by the eviction. The files are evicted in the order of their last
+    access when the total size exceeds max_bytes.
+
+    Parameters
+    ----------
+        path : the cache directory, created if it does not exist
+        max_bytes : the size budget of the directory
+    """
+    def __init__(self, path, max_bytes=1024**3):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok=True)
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def key(self, cacheKey, versions):
+        """the file key of the query
+
+        Parameters
+        ----------
+            cacheKey : (normalized SQL, parameters) (see qadb.cache.cacheKey)
+            versions : dict of the table versions read by the query
+        """
+        stamp = repr((cacheKey, sorted(versions.items())))
+        return hashlib.sha256(stamp.encode()).hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.path, key + SUFFIX)
+
+    def get(self, key):
+        ''' the cached result as a memory-mapped pyarrow.Table, or None '''
+        filepath = self._file(key)
+        try:
+            table = pa.ipc.open_file(pa.memory_map(filepath, 'r')).read_all()
+        except (FileNotFoundError, pa.ArrowInvalid):
+            with self._lock:
+                self._stats['misses'] += 1
+            return None
+        try:
+            os.utime(filepath)
+        except FileNotFoundError:
+            pass
+        with self._lock:
+            self._stats['hits'] += 1
+        return table
+
+    def put(self, key, df):
+        ''' write the DataFrame to the cache; the results which Arrow cannot hold are not cached '''
+        try:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+        except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+            logger.warning(f'query result not cached: {e}')
+            return
+        if table.nbytes > self.max_bytes:
+            return
+        # written to a temporary file and renamed, so the readers never see a partial file
+        tmppath = os.path.join(self.path, f'.{key}.{uuid.uuid4().hex}.tmp')
+        with pa.OSFile(tmppath, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmppath, self._file(key))
+        self.evict()
+
+    def _files(self):
+        files = []
+        with os.scandir(self.path) as it:
+            for entry in it:
+                if not entry.name.endswith(SUFFIX):
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((st.st_mtime, st.st_size, entry.path))
+        return files
+
+    def evict(self):
+        ''' remove the least recently used files until the directory fits in max_bytes '''
+        files = sorted(self._files())
+        total = sum(size for _, size, _ in files)
+        for _, size, filepath in files:
+            if total <= self.max_bytes:
+                break
+            try:
+                # the processes which have mapped the file keep reading it
+                os.remove(filepath)
+                with self._lock:
+                    self._stats['evictions'] += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        for _, _, filepath in self._files():
+            try:
+                os.remove(filepath)
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        """Statistics of the cache
+
+        Returns
+        ----------
+            stats : dict with 'hits', 'misses' and 'evictions' of this process,
+                    and 'files' and 'bytes' in the directory
+        """
+        files = self._files()
+        with self._lock:
+            stats = dict(self._stats)
+        stats['files'] = len(files)
+        stats['bytes'] = sum(size for _, size, _ in files)
+        return stats
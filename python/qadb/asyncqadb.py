@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+import io
+
+from sqlalchemy import inspect, text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from . import models
+from ._lazy import LazyModule, LazyAttribute
+from .qadb import (_getTable, _upsert, _update, _primaryKeys, _stagingTable,
+                   _createStagingSQL, _mergeSQL, _toCSV, _iterChunks, _Touched, _conflictKeys,
+                   _refreshSummary, _bumpVersions)
+
+# imported on the first use, as in qadb.qadb
+pd = LazyModule('pandas')
+logger = LazyAttribute('logzero', 'logger')
+
+
+class AsyncQaDB(object):
+    """AsyncQaDB
+
+    asyncio counterpart of QaDB built on the SQLAlchemy async engine
+
+    Parameters
+    ----------
+        url : f'{dialect}+{driver}://{username}@{hostname}:{port}/{dbname}'
+            e.g., 'postgresql+asyncpg://...' or 'sqlite+aiosqlite:///...'
+        pool_size : the number of connections kept open in the pool
+        max_overflow : the number of connections allowed beyond pool_size
+        pool_timeout : seconds to wait for a connection before giving up
+        pool_recycle : seconds after which a connection is replaced
+        pool_pre_ping : test the connection liveness on every checkout
+        refresh_summary : refresh visit_summary for the visits touched by each write
+                          (skipped with a warning if the database has no visit_summary)
+        table_versions : increment the versions of the written tables in qa_table_version
+                         (if the database has it) after each write, for the readers using
+                         QaDB(cache_dir=...)
+
+    Examples
+    ----------
+        db = AsyncQaDB('postgresql+asyncpg://pfs@localhost/qadb')
+        await asyncio.gather(*[db.upsert('seeing', df) for df in dfs])
+        await db.close()
+    """
+    def __init__(self, url, pool_size=5, max_overflow=10, pool_timeout=30,
+                 pool_recycle=3600, pool_pre_ping=True, refresh_summary=True, table_versions=True):
+        self.url = url
+        self.refresh_summary = refresh_summary
+        self.table_versions = table_versions
+        self._tables = {}
+        self._engine = create_async_engine(self.url,
+                                           pool_size=pool_size,
+                                           max_overflow=max_overflow,
+                                           pool_timeout=pool_timeout,
+                                           pool_recycle=pool_recycle,
+                                           pool_pre_ping=pool_pre_ping,
+                                           )
+
+    async def close(self):
+        await self._engine.dispose()
+
+    async def _hasTable(self, conn, tableName):
+        ''' whether the database has the table (looked up once, see QaDB._hasTable) '''
+        if tableName not in self._tables:
+            self._tables[tableName] = await conn.run_sync(lambda c: inspect(c).has_table(tableName))
+            if not self._tables[tableName]:
+                logger.warning(f'{tableName} does not exist in {self._engine.url.render_as_string()}')
+        return self._tables[tableName]
+
+    async def _afterWrite(self, conn, touched):
+        written = [touched.table.name]
+        if self.refresh_summary and len(touched.summaryVisits) > 0 \
+           and await self._hasTable(conn, models.visit_summary.name):
+            await conn.run_sync(_refreshSummary, touched.summaryVisits)
+            written.append('visit_summary')
+        return written
+
+    async def _afterCommit(self, written, touched=None):
+        ''' increment the table versions in a short transaction of their own (see QaDB._afterCommit) '''
+        if self.table_versions:
+            async with self._engine.begin() as conn:
+                if await self._hasTable(conn, models.qa_table_version.__tablename__):
+                    changes = await self._hasTable(conn, models.qa_table_change.__tablename__)
+                    await conn.run_sync(_bumpVersions, written, touched, changes)
+
+    async def refreshVisitSummary(self, visits=None):
+        """Refresh the visit_summary table (see QaDB.refreshVisitSummary)"""
+        async with self._engine.begin() as conn:
+            await conn.run_sync(models.require_tables, [models.visit_summary.name])
+            nrows = await conn.run_sync(_refreshSummary, visits)
+        await self._afterCommit(['visit_summary'])
+        return nrows
+
+    async def query(self, sqlCmd):
+        async with self._engine.connect() as conn:
+            df = await conn.run_sync(lambda c: pd.read_sql(sql=sqlCmd, con=c))
+        return df
+
+    async def upsert(self, tableName, df):
+        """Insert or update all rows of a DataFrame in a single batch (see QaDB.upsert)
+
+        Returns
+        ----------
+            counts : dict with the number of 'inserted' and 'updated' rows
+        """
+        table = _getTable(tableName)
+        async with self._engine.begin() as conn:
+            counts = await conn.run_sync(_upsert, table, df)
+            touched = _Touched(table, df)
+            written = await self._afterWrite(conn, touched)
+        await self._afterCommit(written, touched)
+        return counts
+
+    async def update(self, tableName, df):
+        """Update the existing rows of the table, matched by primary key (see QaDB.update)
+
+        Returns
+        ----------
+            nUpdated : the number of updated rows
+        """
+        table = _getTable(tableName)
+        async with self._engine.begin() as conn:
+            nUpdated = await conn.run_sync(_update, table, df)
+            touched = _Touched(table, df)
+            written = await self._afterWrite(conn, touched)
+        await self._afterCommit(written, touched)
+        return nUpdated
+
+    async def _copyChunk(self, conn, driver, table, df, pkeys):
+        pkeys = _primaryKeys(table, df, pkeys)
+        df = df.drop_duplicates(subset=pkeys, keep='last')
+        cols = list(df.columns)
+        countSQL, mergeSQL = _mergeSQL(table, cols, pkeys)
+
+        buf = io.BytesIO(_toCSV(table, df).getvalue().encode())
+        await conn.execute(text(f'TRUNCATE {_stagingTable(table)}'))
+        await driver.copy_to_table(_stagingTable(table), source=buf,
+                                   columns=cols, format='csv')
+        nExisting = (await conn.execute(text(countSQL))).scalar()
+        await conn.execute(text(mergeSQL))
+        return {'inserted': len(df) - nExisting, 'updated': nExisting}
+
+    async def copy_into(self, tableName, df_or_iterator):
+        """Stream rows into the table with ``COPY FROM STDIN`` and merge them by primary key
+
+        The asyncpg connection is used for the COPY (see QaDB.copy_into).
+        On SQLite each chunk goes through the batched upsert.
+
+        Parameters
+        ----------
+            tableName : name of the table (e.g., 'seeing_agc_exposure')
+            df_or_iterator : pandas.DataFrame or an iterable of DataFrame chunks
+
+        Returns
+        ----------
+            counts : dict with the number of 'inserted' and 'updated' rows
+        """
+        table = _getTable(tableName)
+        counts = {'inserted': 0, 'updated': 0}
+        touched = _Touched(table)
+        async with self._engine.begin() as conn:
+            if conn.dialect.name != 'postgresql':
+                for df in _iterChunks(df_or_iterator):
+                    for k, v in (await conn.run_sync(_upsert, table, df)).items():
+                        counts[k] += v
+                    touched.add(df)
+            else:
+                raw = await conn.get_raw_connection()
+                pkeys = await conn.run_sync(_conflictKeys, table)
+                await conn.execute(text(_createStagingSQL(table)))
+                for df in _iterChunks(df_or_iterator):
+                    if len(df) == 0:
+                        continue
+                    chunk = await self._copyChunk(conn, raw.driver_connection, table, df, pkeys)
+                    for k, v in chunk.items():
+                        counts[k] += v
+                    touched.add(df)
+            written = await self._afterWrite(conn, touched)
+        await self._afterCommit(written, touched)
+        return counts
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+'''Parallel backfill of the QA tables for a range of visits
+
+The QA values are produced by a source function given as 'module:function',
+which takes the first and the next-to-last pfs_visit_id of a shard and returns
+a dict of {tableName: DataFrame} for the visits it has, e.g.
+
+    def reprocess(start, end):
+        ...
+        return {'noise': df_noise, 'sky': df_sky}
+
+    qadb-backfill postgresql://pfs@localhost/qadb 100000 120000 mypkg.qa:reprocess
+
+The visit range is split into shards which are written by a pool of processes,
+each with its own connection. Finished shards are recorded in backfill_progress,
+so running the same job again resumes from the visits not yet covered by them,
+even with another shard size.
+'''
+
+import argparse
+import datetime
+import importlib
+import multiprocessing
+import os
+import time
+
+import pandas as pd
+from sqlalchemy import create_engine, text
+from logzero import logger
+
+from . import models
+from .qadb import QaDB
+
+# connections left for the other clients when the concurrency is derived from max_connections
+RESERVED_CONNECTIONS = 10
+
+_db = None
+_source = None
+
+
+def loadSource(spec):
+    ''' the function given as 'module:function' '''
+    moduleName, funcName = spec.split(':', 1)
+    return getattr(importlib.import_module(moduleName), funcName)
+
+
+def safeConcurrency(url, requested=None, reserved=RESERVED_CONNECTIONS):
+    """The number of worker processes the database can accept
+
+    Each worker uses a single connection. On PostgreSQL the number is bounded by
+    max_connections minus the connections in use and the reserved ones; on
+    SQLite, which has a single writer, it is 1.
+    """
+    engine = create_engine(url)
+    try:
+        if engine.dialect.name != 'postgresql':
+            return 1
+        with engine.connect() as conn:
+            maxConn = int(conn.execute(text('SHOW max_connections')).scalar())
+            used = conn.execute(text('SELECT count(*) FROM pg_stat_activity')).scalar()
+    finally:
+        engine.dispose()
+    available = max(1, maxConn - used - reserved)
+    limit = min(os.cpu_count() or 1, available)
+    if requested is not None:
+        if requested > available:
+            logger.warning(f'{requested} workers requested but only {available} connections available')
+        return max(1, min(requested, available))
+    return limit
+
+
+def shards(start, end, size):
+    ''' (shard_start, shard_end) covering [start, end) '''
+    return [(s, min(s + size, end)) for s in range(start, end, size)]
+
+
+def finishedShards(db, job):
+    ''' (shard_start, shard_end) of the finished shards of the job, sorted '''
+    df = db.query(text('SELECT shard_start, shard_end FROM backfill_progress WHERE job_name = :job')
+                  .bindparams(job=job), cache=False)
+    return sorted((int(s), int(e)) for s, e in zip(df['shard_start'], df['shard_end']))
+
+
+def covered(finished, start, end):
+    ''' whether the finished (shard_start, shard_end), sorted, cover [start, end) '''
+    for s, e in finished:
+        if s > start:
+            break
+        start = max(start, e)
+        if start >= end:
+            return True
+    return start >= end
+
+
+def _init(url, sourceSpec):
+    global _db, _source
+    _db = QaDB(url, pool_size=1, max_overflow=0)
+    _source = loadSource(sourceSpec)
+
+
+def _runShard(job, start, end, retries, retryWait):
+    order = [t.name for t in models.Base.metadata.sorted_tables]
+    t0 = time.perf_counter()
+    for attempt in range(retries + 1):
+        try:
+            dfs = _source(start, end)
+            nrows = 0
+            visits = set()
+            for tableName in sorted(dfs, key=order.index):
+                df = dfs[tableName]
+                _db.upsert(tableName, df)
+                nrows += len(df)
+                if 'pfs_visit_id' in df.columns:
+                    visits |= set(df['pfs_visit_id'].dropna().astype(int))
+            break
+        except Exception as e:
+            if attempt == retries:
+                logger.error(f'shard {start}-{end} failed: {e}')
+                return {'start': start, 'end': end, 'ok': False, 'visits': 0, 'rows': 0,
+                        'retries': attempt, 'elapsed': time.perf_counter() - t0}
+            logger.warning(f'shard {start}-{end} retrying ({attempt + 1}/{retries}): {e}')
+            time.sleep(retryWait * 2 ** attempt)
+
+    _db.upsert('backfill_progress', pd.DataFrame([{
+        'job_name': job, 'shard_start': start, 'shard_end': end,
+        'number_of_visits': len(visits), 'number_of_rows': nrows,
+        'number_of_retries': attempt, 'finished_at': datetime.datetime.now()}]))
+    return {'start': start, 'end': end, 'ok': True, 'visits': len(visits), 'rows': nrows,
+            'retries': attempt, 'elapsed': time.perf_counter() - t0}
+
+
+def backfill(url, start, end, source, job=None, shard_size=100, concurrency=None,
+             retries=3, retry_wait=1.0):
+    """Backfill the visits in [start, end) with a process pool
+
+    Parameters
+    ----------
+        url : database url
+        start, end : the range of pfs_visit_id (end is excluded)
+        source : the source function as 'module:function'
+        job : the job name of the checkpoints (default: '{source}:{start}-{end}')
+        shard_size : the number of visits in each shard
+        concurrency : the number of worker processes (default: safeConcurrency)
+        retries : the number of retries of a failed shard
+        retry_wait : the initial wait (sec.) before a retry, doubled for each retry
+
+    Returns
+    ----------
+        summary : dict with 'shards', 'skipped', 'failed', 'visits', 'rows', 'retries',
+                  'elapsed', 'visits_per_sec' and 'rows_per_sec'
+    """
+    job = job or f'{source}:{start}-{end}'
+    concurrency = safeConcurrency(url, concurrency)
+    db = QaDB(url, pool_size=1, max_overflow=0)
+    try:
+        db._requireTables([models.backfill_progress.__tablename__])
+        done = finishedShards(db, job)
+    finally:
+        db.close()
+    # the shards may differ from those of the previous runs (e.g., another shard_size),
+    # so a shard is skipped only if the finished ones cover all its visits
+    allShards = shards(start, end, shard_size)
+    todo = [(s, e) for s, e in allShards if not covered(done, s, e)]
+    skipped = len(allShards) - len(todo)
+    logger.info(f'{job}: {len(todo)} shards to process ({skipped} finished) with {concurrency} workers')
+
+    t0 = time.perf_counter()
+    results = []
+    with multiprocessing.Pool(concurrency, initializer=_init, initargs=(url, source)) as pool:
+        tasks = [(job, s, e, retries, retry_wait) for s, e in todo]
+        for result in pool.starmap(_runShard, tasks):
+            results.append(result)
+    elapsed = time.perf_counter() - t0
+
+    summary = {'shards': len(results), 'skipped': skipped,
+               'failed': sum(not r['ok'] for r in results),
+               'visits': sum(r['visits'] for r in results),
+               'rows': sum(r['rows'] for r in results),
+               'retries': sum(r['retries'] for r in results),
+               'elapsed': elapsed}
+    summary['visits_per_sec'] = summary['visits'] / elapsed if elapsed > 0 else 0.0
+    summary['rows_per_sec'] = summary['rows'] / elapsed if elapsed > 0 else 0.0
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='backfill the QA tables for a range of visits')
+    parser.add_argument('url', type=str, help='database url')
+    parser.add_argument('start', type=int, help='the first pfs_visit_id')
+    parser.add_argument('end', type=int, help='the pfs_visit_id next to the last one')
+    parser.add_argument('source', type=str, help='the source function as module:function')
+    parser.add_argument('--job', type=str, default=None, help='the job name of the checkpoints')
+    parser.add_argument('--shard-size', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=None)
+    parser.add_argument('--retries', type=int, default=3)
+    args = parser.parse_args()
+
+    summary = backfill(args.url, args.start, args.end, args.source, job=args.job,
+                       shard_size=args.shard_size, concurrency=args.concurrency,
+                       retries=args.retries)
+    print(f'shards: {summary["shards"]} (skipped {summary["skipped"]}, failed {summary["failed"]})')
+    print(f'visits: {summary["visits"]}  rows: {summary["rows"]}  retries: {summary["retries"]}')
+    print(f'elapsed: {summary["elapsed"]:.2f} s  {summary["visits_per_sec"]:.1f} visits/s  '
+          f'{summary["rows_per_sec"]:.1f} rows/s')
+    if summary['failed'] > 0:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
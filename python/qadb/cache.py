@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from . import models
+
+# the views are invalidated by the writes to their source tables
+_VIEWS = {models.per_arm_view(t): t for t in models.PER_ARM_COLUMNS}
+_TABLE_PATTERN = re.compile(r'\b(' + '|'.join(sorted(list(models.Base.metadata.tables) + list(_VIEWS),
+                                                      key=len, reverse=True)) + r')\b')
+
+
+def normalizeSQL(sqlCmd):
+    ''' the SQL string with the whitespace collapsed, used as the cache key '''
+    return ' '.join(str(sqlCmd).split())
+
+
+def tablesIn(sql):
+    ''' the qadb.models tables referred to in the SQL '''
+    return frozenset(_VIEWS.get(t, t) for t in _TABLE_PATTERN.findall(sql))
+
+
+def cacheKey(sqlCmd, params=None):
+    ''' (normalized SQL, parameters) of a SQL string or a SQLAlchemy statement '''
+    if not isinstance(sqlCmd, str):
+        compiled = sqlCmd.compile()
+        params = dict(compiled.params, **(params or {}))
+        sqlCmd = str(compiled)
+    if isinstance(params, dict):
+        params = repr(sorted(params.items()))
+    elif params is not None:
+        params = repr(params)
+    return (normalizeSQL(sqlCmd), params)
+
+
+class QueryCache(object):
+    """LRU/TTL cache of query results, invalidated by table versions
+
+    Each entry records the versions of the tables the query reads. A write
+    through QaDB bumps the version of the written table, so the entries which
+    read it are not served anymore. The total size of the cached DataFrames is
+    bounded by max_bytes, evicting the least recently used entries first, and
+    entries older than ttl seconds are dropped, which also covers the writes
+    made by the other clients.
+
+    Parameters
+    ----------
+        max_bytes : the maximum total size of the cached results
+        ttl : the lifetime of an entry (sec.)
+    """
+    def __init__(self, max_bytes=256 * 1024**2, ttl=60.0):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0, 'expirations': 0}
+
+    def version(self, tableName):
+        with self._lock:
+            return self._versions.get(tableName, 0)
+
+    def bump(self, tableNames):
+        ''' increment the versions of the tables which have been written '''
+        with self._lock:
+            for tableName in tableNames:
+                self._versions[tableName] = self._versions.get(tableName, 0) + 1
+
+    def key(self, sqlCmd, params=None):
+        return cacheKey(sqlCmd, params)
+
+    def get(self, key):
+        ''' the cached DataFrame, or None '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            df, nbytes, created, versions = entry
+            if time.monotonic() - created > self.ttl:
+                self._remove(key)
+                self._stats['expirations'] += 1
+                self._stats['misses'] += 1
+                return None
+            if any(self._versions.get(t, 0) != v for t, v in versions.items()):
+                self._remove(key)
+                self._stats['invalidations'] += 1
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            return df
+
+    def versionsOf(self, key):
+        ''' the current versions of the tables read by the query, taken before running it '''
+        with self._lock:
+            return {t: self._versions.get(t, 0) for t in tablesIn(key[0])}
+
+    def put(self, key, df, versions):
+        nbytes = int(df.memory_usage(deep=True).sum())
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (df, nbytes, time.monotonic(), versions)
+            self._bytes += nbytes
+            while self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self._stats['evictions'] += 1
+
+    def _remove(self, key):
+        df, nbytes, created, versions = self._entries.pop(key)
+        self._bytes -= nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """Statistics of the cache
+
+        Returns
+        ----------
+            stats : dict with 'hits', 'misses', 'evictions', 'invalidations',
+                    'expirations', 'entries' and 'bytes'
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._bytes
+        return stats
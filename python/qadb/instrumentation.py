@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+
+import bisect
+import functools
+from contextlib import contextmanager
+import http.server
+import os
+import re
+import threading
+import time
+
+from sqlalchemy import event, exc
+
+# upper bounds (sec.) of the latency histogram buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_TABLE = re.compile(r'\b(?:INTO|UPDATE|FROM|COPY|TABLE)\s+"?(\w+)"?', re.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=1024)
+def statementLabels(statement):
+    ''' (kind, table) of the SQL statement, e.g. ('insert', 'seeing') '''
+    words = statement.split(None, 1)
+    kind = words[0].lower() if len(words) > 0 else ''
+    match = _TABLE.search(statement)
+    return kind, match.group(1) if match is not None else ''
+
+
+class Histogram(object):
+    '''Cumulative latency histogram with fixed buckets (as in Prometheus)'''
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.sum += other.sum
+
+    def quantile(self, q):
+        ''' the upper bound of the bucket which contains the q-quantile (0-1) '''
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        n = 0
+        for bound, count in zip(self.buckets + (float('inf'), ), self.counts):
+            n += count
+            if n >= rank:
+                return bound
+        return float('inf')
+
+
+class _Statement(object):
+    def __init__(self, buckets):
+        self.latency = Histogram(buckets)
+        self.rows = 0
+        self.errors = 0
+        self.integrityErrors = 0
+
+
+def _rowcount(cursor):
+    return cursor.rowcount if cursor.rowcount is not None and cursor.rowcount >= 0 else 0
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels):
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + '}'
+
+
+class Instrumentation(object):
+    """Latency histograms, row counts and errors of the SQL statements of an engine
+
+    The statements are timed with the before/after_cursor_execute events of
+    SQLAlchemy and labeled by kind (insert, select, ...) and table, and the
+    errors are counted with the handle_error event. Nothing is hooked until
+    attach() is called, so an engine without instrumentation has no overhead.
+    Other counters (e.g., the retries of the writer) are added with count().
+
+    Parameters
+    ----------
+        buckets : the upper bounds (sec.) of the latency histogram buckets
+    """
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._statements = {}
+        self._counters = {}
+        self._gauges = []
+        self._engines = []
+
+    def attach(self, engine):
+        ''' start recording the statements executed by the engine '''
+        event.listen(engine, 'before_cursor_execute', self._before)
+        event.listen(engine, 'after_cursor_execute', self._after)
+        event.listen(engine, 'handle_error', self._error)
+        self._engines.append(engine)
+
+    def detach(self):
+        for engine in self._engines:
+            event.remove(engine, 'before_cursor_execute', self._before)
+            event.remove(engine, 'after_cursor_execute', self._after)
+            event.remove(engine, 'handle_error', self._error)
+        self._engines = []
+
+    def addGauges(self, func):
+        ''' func() returns {name: value} included in the exported metrics (e.g., the pool status) '''
+        self._gauges.append(func)
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        context._qadb_t0 = time.perf_counter()
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - context._qadb_t0
+        self._observe(statementLabels(statement), elapsed, _rowcount(cursor))
+
+    def _error(self, context):
+        integrity = isinstance(context.sqlalchemy_exception, exc.IntegrityError) or \
+            type(context.original_exception).__name__ == 'IntegrityError'
+        self._failed(statementLabels(context.statement or ''), integrity)
+
+    def _statement(self, key):
+        s = self._statements.get(key)
+        if s is None:
+            s = self._statements[key] = _Statement(self.buckets)
+        return s
+
+    def _observe(self, key, elapsed, rows):
+        with self._lock:
+            s = self._statement(key)
+            s.latency.observe(elapsed)
+            s.rows += rows
+
+    def _failed(self, key, integrity):
+        with self._lock:
+            s = self._statement(key)
+            s.errors += 1
+            if integrity:
+                s.integrityErrors += 1
+
+    @contextmanager
+    def timed(self, statement, cursor=None, kind=None, table=None):
+        """Record a statement executed outside of the events of the engine
+
+        e.g. on the DBAPI cursor of a raw connection (see QaDB.copy_into), as
+
+            with instrumentation.timed(sql, cursor):
+                cursor.execute(sql)
+
+        Parameters
+        ----------
+            statement : the SQL statement, labeled as in the events
+            cursor : the DBAPI cursor whose rowcount is recorded as the rows
+            kind, table : the labels to be used instead of those of the statement
+        """
+        labels = statementLabels(statement)
+        key = (kind or labels[0], table or labels[1])
+        t0 = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self._failed(key, type(e).__name__ == 'IntegrityError')
+            raise
+        self._observe(key, time.perf_counter() - t0, _rowcount(cursor) if cursor is not None else 0)
+
+    def count(self, name, n=1, **labels):
+        ''' increment the counter (e.g., count('retries', component='writer', table='seeing')) '''
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + n
+
+    def reset(self):
+        with self._lock:
+            self._statements = {}
+            self._counters = {}
+
+    def snapshot(self):
+        """The recorded metrics
+
+        Returns
+        ----------
+            metrics : dict with
+                'statements' : list of dict with 'statement' (kind), 'table', 'calls',
+                               'rows', 'errors', 'integrity_errors', 'seconds_total',
+                               'p50', 'p99' (the bucket upper bounds, sec.) and 'buckets'
+                'tables' : the same, merged over the statements of each table
+                'counters' : list of dict with 'name', 'labels' and 'value'
+        """
+        with self._lock:
+            statements = {k: (s.latency.counts[:], s.latency.count, s.latency.sum,
+                              s.rows, s.errors, s.integrityErrors)
+                          for k, s in self._statements.items()}
+            counters = dict(self._counters)
+
+        def summary(latency, rows, errors, integrityErrors, **labels):
+            buckets = dict(zip([str(b) for b in self.buckets] + ['+Inf'], latency.counts))
+            return dict(labels, calls=latency.count, rows=rows, errors=errors,
+                        integrity_errors=integrityErrors, seconds_total=latency.sum,
+                        p50=latency.quantile(0.5), p99=latency.quantile(0.99), buckets=buckets)
+
+        result = {'statements': [], 'tables': [], 'counters': []}
+        tables = {}
+        for (kind, table), (counts, count, total, rows, errors, integrityErrors) in sorted(statements.items()):
+            latency = Histogram(self.buckets)
+            latency.counts, latency.count, latency.sum = counts, count, total
+            result['statements'].append(summary(latency, rows, errors, integrityErrors,
+                                                statement=kind, table=table))
+            t = tables.setdefault(table, [Histogram(self.buckets), 0, 0, 0])
+            t[0].merge(latency)
+            t[1] += rows
+            t[2] += errors
+            t[3] += integrityErrors
+        for table, (latency, rows, errors, integrityErrors) in sorted(tables.items()):
+            result['tables'].append(summary(latency, rows, errors, integrityErrors, table=table))
+        for (name, labels), value in sorted(counters.items()):
+            result['counters'].append({'name': name, 'labels': dict(labels), 'value': value})
+        return result
+
+    def prometheus(self, prefix='qadb'):
+        ''' the metrics in the Prometheus text exposition format '''
+        snapshot = self.snapshot()
+        lines = [f'# HELP {prefix}_statement_duration_seconds latency of the SQL statements',
+                 f'# TYPE {prefix}_statement_duration_seconds histogram']
+        for s in snapshot['statements']:
+            labels = {'statement': s['statement'], 'table': s['table']}
+            n = 0
+            for le, count in s['buckets'].items():
+                n += count
+                lines.append(f'{prefix}_statement_duration_seconds_bucket{_labels(**labels, le=le)} {n}')
+            lines.append(f'{prefix}_statement_duration_seconds_sum{_labels(**labels)} {s["seconds_total"]}')
+            lines.append(f'{prefix}_statement_duration_seconds_count{_labels(**labels)} {s["calls"]}')
+        for name, key, text in [('statement_rows_total', 'rows', 'rows affected by the SQL statements'),
+                                ('statement_errors_total', 'errors', 'failed SQL statements'),
+                                ('integrity_errors_total', 'integrity_errors', 'SQL statements failed by IntegrityError')]:
+            lines += [f'# HELP {prefix}_{name} {text}', f'# TYPE {prefix}_{name} counter']
+            for s in snapshot['statements']:
+                lines.append(f'{prefix}_{name}{_labels(statement=s["statement"], table=s["table"])} {s[key]}')
+        names = sorted(set(c['name'] for c in snapshot['counters']))
+        for name in names:
+            lines.append(f'# TYPE {prefix}_{name}_total counter')
+            for c in snapshot['counters']:
+                if c['name'] == name:
+                    lines.append(f'{prefix}_{name}_total{_labels(**c["labels"])} {c["value"]}')
+        for func in self._gauges:
+            for name, value in func().items():
+                lines += [f'# TYPE {prefix}_{name} gauge', f'{prefix}_{name} {value}']
+        return '\n'.join(lines) + '\n'
+
+    def writePrometheus(self, path, prefix='qadb'):
+        ''' write the metrics to the file, e.g. for the textfile collector of node_exporter '''
+        tmppath = f'{path}.{os.getpid()}.tmp'
+        with open(tmppath, 'w') as f:
+            f.write(self.prometheus(prefix))
+        os.replace(tmppath, path)
+
+    def serve(self, port=9464, host='127.0.0.1', prefix='qadb'):
+        """Serve the metrics at http://{host}:{port}/metrics from a background thread
+
+        Returns
+        ----------
+            server : http.server.ThreadingHTTPServer (call shutdown() to stop it)
+        """
+        instrumentation = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = instrumentation.prometheus(prefix).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, name='QaDBMetrics', daemon=True).start()
+        return server
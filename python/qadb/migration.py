@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+'''Helpers for the alembic revisions which run while the database is in use
+
+The revisions of alembic/qadb* take ACCESS EXCLUSIVE locks (ALTER TABLE) and
+may rewrite large tables. These helpers keep the time the ingest is blocked
+short:
+
+    lock_retry : run schema changes with lock_timeout, and retry them later
+                 rather than queueing the writers behind a long wait for the lock
+    backfill : UPDATE a table in keyed batches, each committed on its own,
+               with progress in the log
+    create_index_concurrently / drop_index_concurrently :
+               CREATE/DROP INDEX CONCURRENTLY outside the migration transaction
+               (partition by partition on a partitioned table)
+
+e.g. in a revision
+
+    from qadb import migration
+
+    def upgrade():
+        migration.lock_retry(lambda: op.add_column('noise', sa.Column('noise_b_mean', sa.REAL())))
+        migration.backfill('noise', {'noise_b_mean': 'noise_mean'}, where='noise_b_mean IS NULL')
+        migration.create_index_concurrently('ix_noise_noise_b_mean', 'noise', ['noise_b_mean'])
+
+backfill and create_index_concurrently commit the changes made so far by the
+revision (alembic autocommit_block), so the environments run each revision
+in its own transaction (transaction_per_migration). On databases other than
+PostgreSQL the operations are run as they are, and in the offline (--sql)
+mode the statements are written without the retries, for tables which are not
+partitioned.
+'''
+
+import time
+from contextlib import contextmanager, nullcontext
+
+from alembic import op
+from logzero import logger
+from sqlalchemy import exc, text
+
+# SQLSTATE of lock_not_available, raised when lock_timeout expires
+LOCK_NOT_AVAILABLE = '55P03'
+
+
+def _isPostgres():
+    return not op.get_context().as_sql and op.get_bind().dialect.name == 'postgresql'
+
+
+def isLockTimeout(e):
+    ''' whether the error is the cancellation of a statement by lock_timeout '''
+    orig = getattr(e, 'orig', e)
+    return (getattr(orig, 'pgcode', None) or getattr(orig, 'sqlstate', None)) == LOCK_NOT_AVAILABLE
+
+
+def _setLockTimeout(conn, timeout, local=True):
+    conn.exec_driver_sql(f'SET {"LOCAL " if local else ""}lock_timeout = {max(int(timeout * 1000), 1)}')
+
+
+def _retryLocked(func, what, retries, interval=1.0, max_interval=30.0):
+    ''' call func, retrying with a backoff while it is cancelled by lock_timeout '''
+    for attempt in range(retries + 1):
+        try:
+            return func()
+        except exc.DBAPIError as e:
+            if not isLockTimeout(e) or attempt == retries:
+                raise
+            wait = min(interval * 2**attempt, max_interval)
+            logger.warning(f'{what}: lock not granted, retrying in {wait:.1f} s ({attempt + 1}/{retries})')
+            time.sleep(wait)
+
+
+@contextmanager
+def _sessionLockTimeout(conn, timeout):
+    ''' lock_timeout of the statements in autocommit_block, where SET LOCAL does not last '''
+    _setLockTimeout(conn, timeout, local=False)
+    try:
+        yield
+    finally:
+        conn.exec_driver_sql('RESET lock_timeout')
+
+
+def lock_retry(func, lock_timeout=2.0, retries=10, interval=1.0, max_interval=30.0):
+    """Run the schema changes, giving up the locks and retrying if they are not granted soon
+
+    func (e.g., a function calling op.add_column and op.alter_column on a
+    table) runs in a SAVEPOINT with lock_timeout. When a lock is not granted
+    within lock_timeout, because of a long query or transaction on the table,
+    the SAVEPOINT is rolled back, which lets the writers queued behind the
+    ALTER TABLE go on, and func is retried after a backoff.
+
+    Parameters
+    ----------
+        func : function without arguments making the changes
+        lock_timeout : the time (sec.) to wait for each lock
+        retries : the number of retries before the error is raised
+        interval, max_interval : the first and the longest waits (sec.) between the attempts
+
+    Returns
+    ----------
+        result : the return value of func
+    """
+    if not _isPostgres():
+        return func()
+    conn = op.get_bind()
+    previous = conn.exec_driver_sql('SHOW lock_timeout').scalar()
+
+    def attempt():
+        with conn.begin_nested():
+            _setLockTimeout(conn, lock_timeout)
+            return func()
+
+    result = _retryLocked(attempt, 'lock_retry', retries, interval, max_interval)
+    conn.exec_driver_sql(f"SET LOCAL lock_timeout = '{previous}'")
+    return result
+
+
+def _estimateRows(conn, tableName):
+    if conn.dialect.name == 'postgresql':
+        # the planner estimate, as count(*) takes long on the large tables
+        n = conn.execute(text('SELECT reltuples FROM pg_class WHERE oid = CAST(:t AS regclass)'),
+                         {'t': tableName}).scalar()
+        if n is not None and n >= 0:
+            return int(n)
+    return conn.execute(text(f'SELECT count(*) FROM {tableName}')).scalar()
+
+
+def backfill(tableName, values, key='pfs_visit_id', where=None, batch_size=10000,
+             lock_timeout=2.0, retries=10, pause=0.0, progress=None):
+    """UPDATE the table in batches of keys, committing each batch
+
+    The rows are walked in the order of the key column, batch_size keys at a
+    time (the upper key of a batch is looked up with the index of the key),
+    and each batch is an UPDATE in its own transaction, so the row locks are
+    held only for a batch and the backfill can be interrupted and run again
+    (give a where which skips the updated rows, e.g. 'new_column IS NULL').
+    The changes made before by the revision are committed first.
+
+    Parameters
+    ----------
+        tableName : the table (e.g., 'noise')
+        values : dict of {column: SQL expression}, e.g. {'noise_r_mean': 'noise_mean'}
+        key : the indexed column to walk (the first primary key column)
+        where : SQL condition of the rows to be updated
+        batch_size : the number of keys per batch
+        lock_timeout, retries : as in lock_retry, for each batch
+        pause : the sleep (sec.) between the batches, to leave the I/O to the ingest
+        progress : function called with (rows updated, rows estimated) after each batch
+                   (default: a line in the log about every 10 sec.)
+
+    Returns
+    ----------
+        nUpdated : the number of updated rows (None in the offline mode)
+    """
+    assignments = ', '.join(f'{k} = {v}' for k, v in values.items())
+    cond = f' AND ({where})' if where is not None else ''
+    context = op.get_context()
+    if context.as_sql:
+        op.execute(f'UPDATE {tableName} SET {assignments}' + (f' WHERE {where}' if where is not None else ''))
+        return None
+
+    firstKey = text(f'SELECT min({key}) FROM {tableName}')
+    upperKey = text(f'SELECT {key} FROM {tableName} WHERE {key} >= :lo ORDER BY {key} LIMIT 1 OFFSET :offset')
+    nextKey = text(f'SELECT min({key}) FROM {tableName} WHERE {key} > :hi')
+    update = text(f'UPDATE {tableName} SET {assignments} WHERE {key} >= :lo AND {key} <= :hi{cond}')
+    lastUpdate = text(f'UPDATE {tableName} SET {assignments} WHERE {key} >= :lo{cond}')
+
+    with context.autocommit_block():
+        conn = op.get_bind()
+        postgres = conn.dialect.name == 'postgresql'
+        with _sessionLockTimeout(conn, lock_timeout) if postgres else nullcontext():
+            total = _estimateRows(conn, tableName)
+            lo = conn.execute(firstKey).scalar()
+            nUpdated = 0
+            nBatches = 0
+            t0 = tLog = time.monotonic()
+            while lo is not None:
+                hi = conn.execute(upperKey, {'lo': lo, 'offset': batch_size - 1}).scalar()
+                if hi is None:
+                    sql, params = lastUpdate, {'lo': lo}
+                else:
+                    sql, params = update, {'lo': lo, 'hi': hi}
+                # each statement is committed on its own in autocommit_block
+                nUpdated += _retryLocked(lambda: conn.execute(sql, params).rowcount,
+                                         f'{tableName} batch from {key}={lo}', retries)
+                nBatches += 1
+                if progress is not None:
+                    progress(nUpdated, total)
+                elif time.monotonic() - tLog > 10:
+                    elapsed = time.monotonic() - t0
+                    logger.info(f'{tableName}: {nUpdated}/{total} rows updated in {nBatches} batches '
+                                f'({nUpdated / elapsed:.0f} rows/s)')
+                    tLog = time.monotonic()
+                lo = None if hi is None else conn.execute(nextKey, {'hi': hi}).scalar()
+                if pause > 0 and lo is not None:
+                    time.sleep(pause)
+    logger.info(f'{tableName}: {nUpdated} rows updated in {nBatches} batches '
+                f'({time.monotonic() - t0:.1f} s)')
+    return nUpdated
+
+
+def _invalidIndex(conn, indexName):
+    ''' whether the index is left INVALID by a failed CREATE INDEX CONCURRENTLY '''
+    row = conn.execute(text('SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid '
+                            'WHERE c.relname = :name'), {'name': indexName}).first()
+    return row is not None and not row[0]
+
+
+def _isPartitioned(conn, tableName):
+    ''' whether the table is a partitioned table (e.g., the AGC exposure tables made by qadb.partitions) '''
+    return conn.execute(text("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(:t)"),
+                        {'t': tableName}).scalar() is True
+
+
+def _partitions(conn, tableName):
+    return [n for (n, ) in conn.execute(text('SELECT c.relname FROM pg_inherits i '
+                                             'JOIN pg_class c ON c.oid = i.inhrelid '
+                                             'WHERE i.inhparent = CAST(:t AS regclass) ORDER BY c.relname'),
+                                        {'t': tableName})]
+
+
+def _attached(conn, indexName):
+    ''' the indexes attached to the index of a partitioned table '''
+    return {n for (n, ) in conn.execute(text('SELECT c.relname FROM pg_inherits i '
+                                             'JOIN pg_class c ON c.oid = i.inhrelid '
+                                             'WHERE i.inhparent = CAST(:i AS regclass)'),
+                                        {'i': indexName})}
+
+
+def _indexSQL(indexName, tableName, columns, unique=False, postgresql_using=None, only=False,
+              concurrently=False):
+    using = f' USING {postgresql_using}' if postgresql_using is not None else ''
+    return (f'CREATE {"UNIQUE " if unique else ""}INDEX {"CONCURRENTLY " if concurrently else ""}'
+            f'IF NOT EXISTS {indexName} ON {"ONLY " if only else ""}{tableName}{using} ({", ".join(columns)})')
+
+
+def _partitionIndexName(indexName, tableName, partition):
+    # e.g., ix_seeing_agc_exposure_taken_at_y2024m01 for seeing_agc_exposure_y2024m01
+    suffix = partition[len(tableName):] if partition.startswith(tableName) else f'_{partition}'
+    return (indexName + suffix)[:63]
+
+
+def _createPartitionedIndex(conn, indexName, tableName, columns, retries, **kw):
+    ''' the index of a partitioned table, built CONCURRENTLY on each partition and attached '''
+    # CREATE INDEX CONCURRENTLY is rejected on a partitioned table: the index
+    # ON ONLY the table is created empty (and INVALID), and becomes valid when
+    # the indexes of all the partitions are attached
+    _retryLocked(lambda: conn.exec_driver_sql(_indexSQL(indexName, tableName, columns, only=True, **kw)),
+                 indexName, retries)
+    attached = _attached(conn, indexName)
+    for partition in _partitions(conn, tableName):
+        name = _partitionIndexName(indexName, tableName, partition)
+        if name in attached:
+            continue
+
+        def attempt():
+            if _invalidIndex(conn, name):
+                conn.exec_driver_sql(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+            conn.exec_driver_sql(_indexSQL(name, partition, columns, concurrently=True, **kw))
+        _retryLocked(attempt, name, retries)
+        _retryLocked(lambda: conn.exec_driver_sql(f'ALTER INDEX {indexName} ATTACH PARTITION {name}'),
+                     name, retries)
+
+
+def create_index_concurrently(indexName, tableName, columns, lock_timeout=2.0, retries=10, **kw):
+    """op.create_index with CREATE INDEX CONCURRENTLY, outside the migration transaction
+
+    The writes to the table go on while the index is built. An INVALID index
+    left by a failed (e.g., lock_timeout) attempt is dropped and built again.
+    The changes made before by the revision are committed first.
+
+    On a partitioned table, where PostgreSQL does not support CONCURRENTLY,
+    the index is created ON ONLY the table, and the index of each partition
+    is built CONCURRENTLY and attached to it; the partitions created later get
+    the index by themselves. Only unique and postgresql_using are supported in kw then.
+
+    Parameters
+    ----------
+        indexName, tableName, columns, kw : as in op.create_index (e.g., postgresql_using='brin')
+        lock_timeout, retries : as in lock_retry
+    """
+    context = op.get_context()
+    if context.dialect.name != 'postgresql':
+        op.create_index(indexName, tableName, columns, **kw)
+        return
+
+    def attempt():
+        if _invalidIndex(conn, indexName):
+            op.drop_index(indexName, table_name=tableName, postgresql_concurrently=True)
+        op.create_index(indexName, tableName, columns, postgresql_concurrently=True,
+                        if_not_exists=True, **kw)
+
+    with context.autocommit_block():
+        if context.as_sql:
+            op.create_index(indexName, tableName, columns, postgresql_concurrently=True,
+                            if_not_exists=True, **kw)
+            return
+        conn = op.get_bind()
+        with _sessionLockTimeout(conn, lock_timeout):
+            if _isPartitioned(conn, tableName):
+                _createPartitionedIndex(conn, indexName, tableName, columns, retries, **kw)
+            else:
+                _retryLocked(attempt, indexName, retries)
+
+
+def drop_index_concurrently(indexName, tableName, lock_timeout=2.0, retries=10):
+    """op.drop_index with DROP INDEX CONCURRENTLY, outside the migration transaction
+
+    The index of a partitioned table, which cannot be dropped CONCURRENTLY, is
+    dropped with the indexes of its partitions by a plain DROP INDEX.
+    """
+    context = op.get_context()
+    if context.dialect.name != 'postgresql':
+        op.drop_index(indexName, table_name=tableName)
+        return
+    with context.autocommit_block():
+        if context.as_sql:
+            op.drop_index(indexName, table_name=tableName, postgresql_concurrently=True, if_exists=True)
+            return
+        conn = op.get_bind()
+        concurrently = not _isPartitioned(conn, tableName)
+        with _sessionLockTimeout(conn, lock_timeout):
+            _retryLocked(lambda: op.drop_index(indexName, table_name=tableName,
+                                               postgresql_concurrently=concurrently, if_exists=True),
+                         indexName, retries)
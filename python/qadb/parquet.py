@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+import datetime
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+from sqlalchemy import BigInteger, Boolean, DateTime, Integer, REAL, String, select
+
+from . import models
+from .qadb import _getTable
+
+PARTITIONS = ('visit', 'night', None)
+
+# the pandas dtypes of the Arrow types which would become float64/object with NULLs
+PANDAS_TYPES = {pa.int32(): pd.Int32Dtype(), pa.int64(): pd.Int64Dtype(), pa.bool_(): pd.BooleanDtype()}
+
+
+def arrowType(column):
+    ''' Arrow type corresponding to the SQLAlchemy column type '''
+    t = column.type
+    if isinstance(t, BigInteger):
+        return pa.int64()
+    elif isinstance(t, Integer):
+        return pa.int32()
+    elif isinstance(t, REAL):
+        return pa.float32()
+    elif isinstance(t, DateTime):
+        return pa.timestamp('us')
+    elif isinstance(t, Boolean):
+        return pa.bool_()
+    elif isinstance(t, String):
+        return pa.string()
+    return pa.float64()
+
+
+def arrowSchema(table):
+    ''' Arrow schema of the table in qadb.models '''
+    return pa.schema([pa.field(c.name, arrowType(c)) for c in table.columns])
+
+
+def _partitionColumn(table, partition_by):
+    if partition_by is None or 'pfs_visit_id' not in table.c:
+        return None
+    if partition_by == 'visit':
+        return pa.field('visit_range', pa.int32())
+    return pa.field('night', pa.date32())
+
+
+def _batches(db, table, partition_by, visits_per_partition, chunksize):
+    fields = list(arrowSchema(table))
+    schema = pa.schema(fields)
+    partition = _partitionColumn(table, partition_by)
+    sql = select(table)
+    if partition is not None and partition.name == 'night':
+        visit = models.Base.metadata.tables['pfs_visit']
+        if table is visit:
+            sql = select(table, visit.c.issued_at.label('_issued_at'))
+        else:
+            sql = (select(table, visit.c.issued_at.label('_issued_at'))
+                   .join(visit, table.c.pfs_visit_id == visit.c.pfs_visit_id))
+    if partition is not None:
+        schema = schema.append(partition)
+
+    for keys, rows in db._stream(sql, chunksize):
+        columns = dict(zip(keys, zip(*rows)))
+        arrays = [pa.array(columns[f.name], type=f.type) for f in fields]
+        if partition is not None and partition.name == 'visit_range':
+            visits = np.asarray(columns['pfs_visit_id'])
+            arrays.append(pa.array(visits // visits_per_partition * visits_per_partition,
+                                   type=pa.int32()))
+        elif partition is not None:
+            # the night starts at noon of the date on which it is labelled
+            issued = pa.array(columns['_issued_at'], type=pa.timestamp('us'))
+            arrays.append(pc.subtract(issued, pa.scalar(datetime.timedelta(hours=12)))
+                          .cast(pa.date32()))
+        yield pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def export(db, tables, path, format='parquet', partition_by='visit',
+           visits_per_partition=1000, chunksize=100000):
+    """Export the tables to a hive-partitioned Parquet dataset under path/<table>/
+
+    The rows are read with a server-side cursor and converted into Arrow
+    record batches typed from qadb.models, which are written to the dataset
+    one by one, so a table is never held in memory as a whole.
+
+    Parameters
+    ----------
+        db : QaDB
+        tables : a table name or a list of table names (e.g., ['seeing', 'sky'])
+        path : the output directory
+        format : 'parquet' or 'feather'
+        partition_by : 'visit' (visit_range=N), 'night' (night=YYYY-MM-DD) or None.
+            Tables without pfs_visit_id are written without partitions, and
+            rows without a pfs_visit entry are skipped for 'night'.
+        visits_per_partition : the number of visits in each visit_range partition
+        chunksize : the number of rows in each record batch
+
+    Returns
+    ----------
+        nrows : dict of the number of exported rows for each table
+    """
+    if partition_by not in PARTITIONS:
+        raise ValueError(f'partition_by should be one of {PARTITIONS}')
+    if isinstance(tables, str):
+        tables = [tables]
+    nrows = {}
+    for tableName in tables:
+        table = _getTable(tableName)
+        partition = _partitionColumn(table, partition_by)
+        schema = arrowSchema(table)
+        if partition is not None:
+            schema = schema.append(partition)
+        counter = {'n': 0}
+
+        def counted(batches):
+            for batch in batches:
+                counter['n'] += batch.num_rows
+                yield batch
+
+        batches = _batches(db, table, partition_by, visits_per_partition, chunksize)
+        ds.write_dataset(counted(batches), os.path.join(path, tableName),
+                         schema=schema, format=format,
+                         partitioning=[partition.name] if partition is not None else None,
+                         partitioning_flavor='hive' if partition is not None else None,
+                         existing_data_behavior='delete_matching')
+        nrows[tableName] = counter['n']
+    return nrows
+
+
+def import_parquet(db, path, tableName=None, format='parquet', batch_size=100000):
+    """Load a dataset written by export back into the database
+
+    The record batches are fed one by one to QaDB.copy_into, i.e. merged
+    into the table by primary key. The partition columns are dropped, and the
+    integer columns are read as nullable Int32/Int64, so that the ones with
+    NULLs do not become float64.
+
+    Parameters
+    ----------
+        db : QaDB
+        path : the dataset directory (e.g., 'export/seeing')
+        tableName : the target table (default: the directory name)
+        format : 'parquet' or 'feather'
+        batch_size : the number of rows in each batch
+
+    Returns
+    ----------
+        counts : dict with the number of 'inserted' and 'updated' rows
+    """
+    if tableName is None:
+        tableName = os.path.basename(os.path.normpath(path))
+    table = _getTable(tableName)
+    dataset = ds.dataset(path, format=format, partitioning='hive')
+    columns = [c.name for c in table.columns if c.name in dataset.schema.names]
+
+    def chunks():
+        for batch in dataset.to_batches(columns=columns, batch_size=batch_size):
+            yield batch.to_pandas(types_mapper=PANDAS_TYPES.get)
+
+    return db.copy_into(tableName, chunks())
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+'''Monthly range partitions of the AGC exposure tables
+
+The partitioned tables are created with the database, when it is made with
+models.make_database(url, partition_agc=True) or qadb-provision --partition-agc,
+and have taken_at in their primary key (PostgreSQL requires the partition key
+in the unique constraints), in place of the unique (pfs_visit_id,
+agc_exposure_id). QaDB finds the key of the tables in the database, so the
+same code writes into either layout. Partitions should be created ahead of
+the observations, e.g. from a cron job:
+
+    python -m qadb.partitions postgresql://pfs@localhost/qadb create 2024-01 2025-12
+    python -m qadb.partitions postgresql://pfs@localhost/qadb drop 2022-01
+'''
+
+import datetime
+
+from sqlalchemy import create_engine, text, ForeignKeyConstraint, Index, MetaData, Table
+from logzero import logger
+
+from . import models
+from .models import AGC_TABLES
+
+
+def _month(date):
+    if isinstance(date, str):
+        date = datetime.datetime.strptime(date[:7], '%Y-%m')
+    return datetime.date(date.year, date.month, 1)
+
+
+def _nextMonth(month):
+    return datetime.date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def partitionedTable(table, metadata):
+    """The AGC exposure table range-partitioned by month on taken_at, in the metadata
+
+    Parameters
+    ----------
+        table : the table of qadb.models (e.g., models.seeing_agc_exposure.__table__)
+        metadata : MetaData with the tables of its foreign keys (pfs_visit)
+
+    Returns
+    ----------
+        table : the partitioned table, with taken_at in the primary key
+    """
+    columns = [c._copy() for c in table.columns]
+    for c in columns:
+        if c.name == 'taken_at':
+            c.primary_key = True
+            c.nullable = False
+    foreignKeys = [ForeignKeyConstraint([e.parent.name for e in fk.elements], [e.target_fullname for e in fk.elements])
+                   for fk in table.foreign_key_constraints]
+    indexes = [Index(i.name, *[c.name for c in i.columns], **i.dialect_kwargs) for i in table.indexes]
+    return Table(table.name, metadata, *columns, *foreignKeys, *indexes, comment=table.comment,
+                 postgresql_partition_by='RANGE (taken_at)')
+
+
+def create_all(engine, tables=AGC_TABLES):
+    """models.Base.metadata.create_all with the tables partitioned (PostgreSQL only)
+
+    The partitions of the months are created afterwards with createPartitions.
+
+    Parameters
+    ----------
+        engine : SQLAlchemy engine of the database
+        tables : the tables to be partitioned
+    """
+    if engine.dialect.name != 'postgresql':
+        raise ValueError(f'partitioning is supported only on PostgreSQL, not on {engine.dialect.name}')
+    models.Base.metadata.create_all(
+        engine, tables=[t for t in models.Base.metadata.sorted_tables if t.name not in tables])
+    metadata = MetaData()
+    models.Base.metadata.tables['pfs_visit'].to_metadata(metadata)
+    partitioned = [partitionedTable(models.Base.metadata.tables[name], metadata) for name in tables]
+    metadata.create_all(engine, tables=partitioned)
+
+
+def partitionName(tableName, month):
+    return f'{tableName}_y{month.year:04d}m{month.month:02d}'
+
+
+def months(start, end):
+    ''' the first days of the months from start to end (inclusive) '''
+    month, end = _month(start), _month(end)
+    while month <= end:
+        yield month
+        month = _nextMonth(month)
+
+
+def createPartitions(conn, start, end, tables=AGC_TABLES):
+    """Create the monthly partitions from start to end (inclusive) if they do not exist
+
+    Parameters
+    ----------
+        conn : SQLAlchemy connection
+        start, end : datetime/date or 'YYYY-MM'
+        tables : the partitioned tables
+
+    Returns
+    ----------
+        names : the partition names
+    """
+    names = []
+    for tableName in tables:
+        for month in months(start, end):
+            name = partitionName(tableName, month)
+            conn.execute(text(f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {tableName} "
+                              f"FOR VALUES FROM ('{month}') TO ('{_nextMonth(month)}')"))
+            names.append(name)
+    return names
+
+
+def dropPartitions(conn, before, tables=AGC_TABLES):
+    """Drop the monthly partitions which end before the given month (data retention)
+
+    Parameters
+    ----------
+        conn : SQLAlchemy connection
+        before : datetime/date or 'YYYY-MM'; partitions of earlier months are dropped
+        tables : the partitioned tables
+
+    Returns
+    ----------
+        names : the dropped partition names
+    """
+    before = _month(before)
+    names = []
+    for tableName in tables:
+        rows = conn.execute(text('SELECT c.relname FROM pg_inherits i '
+                                 'JOIN pg_class c ON c.oid = i.inhrelid '
+                                 'JOIN pg_class p ON p.oid = i.inhparent '
+                                 'WHERE p.relname = :name'), {'name': tableName})
+        for (name, ) in rows.all():
+            try:
+                month = datetime.datetime.strptime(name[len(tableName):], '_y%Ym%m').date()
+            except ValueError:
+                continue
+            if month < before:
+                conn.execute(text(f'DROP TABLE {name}'))
+                names.append(name)
+    return names
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='manage the monthly AGC exposure partitions')
+    parser.add_argument('url', type=str, help='database url')
+    parser.add_argument('action', choices=['create', 'drop'])
+    parser.add_argument('months', nargs='+', help='start end (create) or before (drop) as YYYY-MM')
+    args = parser.parse_args()
+
+    engine = create_engine(args.url)
+    with engine.begin() as conn:
+        if args.action == 'create':
+            names = createPartitions(conn, args.months[0], args.months[-1])
+        else:
+            names = dropPartitions(conn, args.months[0])
+    logger.info(f'{args.action}: {", ".join(names)}')
+
+
+if __name__ == '__main__':
+    main()
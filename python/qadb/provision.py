@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+'''Provisioning of empty qaDB databases by cloning a template
+
+The schema of models.Base.metadata is created once into a template database,
+named by a hash of its DDL, and each new database is a clone of the template:
+
+    PostgreSQL : CREATE DATABASE {name} TEMPLATE qadb_template_{hash} on the same server
+    SQLite     : a copy of {cache_dir}/qadb_template_{hash}.sqlite
+
+A template is built only when the models (or the alembic revision stamped into
+it) change, so test and benchmark runs get an isolated database in
+milliseconds instead of running drop_all/create_all, e.g. for each pytest-xdist
+worker:
+
+    url = provision.clone_database(f'postgresql://.../qadb_test_{worker_id}')
+
+With partition_agc=True (--partition-agc), the AGC exposure tables of the
+template are partitioned by month (PostgreSQL, see qadb.partitions).
+'''
+
+import argparse
+import glob
+import hashlib
+import os
+import shutil
+import tempfile
+
+from logzero import logger
+from sqlalchemy import create_engine, text, MetaData
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import make_url
+from sqlalchemy.schema import CreateIndex, CreateTable
+
+from . import models, partitions
+
+TEMPLATE_PREFIX = 'qadb_template_'
+
+# the key of the advisory lock held while a template is built on PostgreSQL
+LOCK_KEY = 0x71adb
+
+
+def default_cache_dir():
+    ''' the directory of the SQLite templates ($QADB_TEMPLATE_DIR or ~/.cache/qadb) '''
+    return os.environ.get('QADB_TEMPLATE_DIR',
+                          os.path.join(os.path.expanduser('~'), '.cache', 'qadb'))
+
+
+def _tables(partition_agc):
+    ''' the tables of the schema, with the AGC exposure tables partitioned if partition_agc '''
+    if not partition_agc:
+        return models.Base.metadata.sorted_tables
+    metadata = MetaData()
+    models.Base.metadata.tables['pfs_visit'].to_metadata(metadata)
+    partitioned = {name: partitions.partitionedTable(models.Base.metadata.tables[name], metadata)
+                   for name in partitions.AGC_TABLES}
+    return [partitioned.get(t.name, t) for t in models.Base.metadata.sorted_tables]
+
+
+def _checkPartitioning(dialect, partition_agc):
+    if partition_agc and dialect != 'postgresql':
+        raise ValueError(f'partitioning is supported only on PostgreSQL, not on {dialect}')
+
+
+def metadata_hash(dialect, stamp=None, partition_agc=False):
+    ''' SHA-256 of the DDL of models.Base.metadata (with the per-arm views) compiled for the dialect '''
+    dialects = {'postgresql': postgresql.dialect, 'sqlite': sqlite.dialect}
+    if dialect not in dialects:
+        raise NotImplementedError(f'provisioning is not supported for {dialect}')
+    d = dialects[dialect]()
+    h = hashlib.sha256()
+    for table in _tables(partition_agc):
+        h.update(str(CreateTable(table).compile(dialect=d)).encode())
+        for index in sorted(table.indexes, key=lambda i: i.name):
+            h.update(str(CreateIndex(index).compile(dialect=d)).encode())
+    for tableName in sorted(models.PER_ARM_COLUMNS):
+        h.update(models.per_arm_view_sql(tableName, dialect).encode())
+    h.update(repr(stamp).encode())
+    return h.hexdigest()
+
+
+def _templateName(dialect, stamp, partition_agc=False):
+    return TEMPLATE_PREFIX + metadata_hash(dialect, stamp, partition_agc)[:16]
+
+
+def _build(url, stamp, partition_agc=False):
+    ''' create the schema (and alembic_version, if stamped) in the empty database '''
+    engine = create_engine(url)
+    try:
+        models.create_all(engine, partition_agc)
+        if stamp is not None:
+            with engine.begin() as conn:
+                conn.execute(text('CREATE TABLE alembic_version (version_num VARCHAR(32) NOT NULL, '
+                                  'CONSTRAINT alembic_version_pkc PRIMARY KEY (version_num))'))
+                conn.execute(text('INSERT INTO alembic_version (version_num) VALUES (:v)'), {'v': stamp})
+    finally:
+        engine.dispose()
+
+
+def _sqlitePath(url):
+    if url.database is None or url.database in ('', ':memory:'):
+        raise ValueError(f'a file database is required to clone the template: {url}')
+    return url.database
+
+
+def _sqliteTemplate(stamp, cacheDir):
+    path = os.path.join(cacheDir, _templateName('sqlite', stamp) + '.sqlite')
+    if not os.path.exists(path):
+        os.makedirs(cacheDir, exist_ok=True)
+        # built aside and renamed, so that the concurrent builders never see a partial template
+        fd, tmppath = tempfile.mkstemp(dir=cacheDir, suffix='.sqlite.tmp')
+        os.close(fd)
+        try:
+            logger.info(f'building the template {path}')
+            _build(f'sqlite:///{tmppath}', stamp)
+            os.replace(tmppath, path)
+        finally:
+            if os.path.exists(tmppath):
+                os.unlink(tmppath)
+    return path
+
+
+def _maintenance(url, maintenance_db):
+    return create_engine(url.set(database=maintenance_db), isolation_level='AUTOCOMMIT')
+
+
+def _postgresTemplate(conn, url, stamp, partition_agc=False):
+    name = _templateName('postgresql', stamp, partition_agc)
+    # the workers starting at once wait for the one building the template
+    conn.execute(text('SELECT pg_advisory_lock(:key)'), {'key': LOCK_KEY})
+    try:
+        exists = conn.execute(text('SELECT 1 FROM pg_database WHERE datname = :name'),
+                              {'name': name}).first()
+        if exists is None:
+            building = f'{name}_building'
+            logger.info(f'building the template database {name}')
+            conn.exec_driver_sql(f'DROP DATABASE IF EXISTS "{building}"')
+            conn.exec_driver_sql(f'CREATE DATABASE "{building}"')
+            _build(url.set(database=building), stamp, partition_agc)
+            conn.exec_driver_sql(f'ALTER DATABASE "{building}" RENAME TO "{name}"')
+            conn.exec_driver_sql(f'ALTER DATABASE "{name}" IS_TEMPLATE true')
+    finally:
+        conn.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': LOCK_KEY})
+    return name
+
+
+def template_database(url, stamp=None, cache_dir=None, maintenance_db='postgres', partition_agc=False):
+    """The template of the schema, built if it does not exist yet
+
+    Parameters
+    ----------
+        url : url of a database on the server (PostgreSQL) or of any SQLite file
+        stamp : alembic revision written to alembic_version of the template (default: none)
+        cache_dir : the directory of the SQLite templates (default: default_cache_dir())
+        maintenance_db : the database to connect to for CREATE DATABASE (PostgreSQL)
+        partition_agc : partition the AGC exposure tables by month (PostgreSQL, see qadb.partitions)
+
+    Returns
+    ----------
+        template : the url of the template
+    """
+    url = make_url(url)
+    dialect = url.get_backend_name()
+    _checkPartitioning(dialect, partition_agc)
+    if dialect == 'sqlite':
+        return f'sqlite:///{_sqliteTemplate(stamp, cache_dir or default_cache_dir())}'
+    engine = _maintenance(url, maintenance_db)
+    try:
+        with engine.connect() as conn:
+            name = _postgresTemplate(conn, url, stamp, partition_agc)
+    finally:
+        engine.dispose()
+    return url.set(database=name).render_as_string(hide_password=False)
+
+
+def clone_database(url, stamp=None, cache_dir=None, replace=False, maintenance_db='postgres',
+                   partition_agc=False):
+    """Create the database as a copy of the template of the schema
+
+    The template is built first if the models have changed since the last
+    one. On PostgreSQL, the database is created with CREATE DATABASE ...
+    TEMPLATE on the server of the url; on SQLite, the template file is copied
+    to the path of the url.
+
+    Parameters
+    ----------
+        url : url of the database to be created (e.g., postgresql://.../qadb_test_gw0)
+        stamp : alembic revision written to alembic_version (default: none)
+        cache_dir : the directory of the SQLite templates (default: default_cache_dir())
+        replace : drop the database first if it exists (default: ValueError if it exists)
+        maintenance_db : the database to connect to for CREATE DATABASE (PostgreSQL)
+        partition_agc : partition the AGC exposure tables by month (PostgreSQL, see qadb.partitions)
+
+    Returns
+    ----------
+        url : the url of the new database
+    """
+    url = make_url(url)
+    dialect = url.get_backend_name()
+    _checkPartitioning(dialect, partition_agc)
+    if dialect == 'sqlite':
+        path = _sqlitePath(url)
+        if os.path.exists(path) and not replace:
+            raise ValueError(f'{path} already exists')
+        template = _sqliteTemplate(stamp, cache_dir or default_cache_dir())
+        tmppath = f'{path}.{os.getpid()}.tmp'
+        shutil.copyfile(template, tmppath)
+        os.replace(tmppath, path)
+        for suffix in ['-journal', '-wal', '-shm']:
+            if os.path.exists(path + suffix):
+                os.unlink(path + suffix)
+        return url.render_as_string(hide_password=False)
+
+    engine = _maintenance(url, maintenance_db)
+    try:
+        with engine.connect() as conn:
+            template = _postgresTemplate(conn, url, stamp, partition_agc)
+            exists = conn.execute(text('SELECT 1 FROM pg_database WHERE datname = :name'),
+                                  {'name': url.database}).first()
+            if exists is not None:
+                if not replace:
+                    raise ValueError(f'database {url.database} already exists')
+                conn.exec_driver_sql(f'DROP DATABASE "{url.database}"')
+            conn.exec_driver_sql(f'CREATE DATABASE "{url.database}" TEMPLATE "{template}"')
+    finally:
+        engine.dispose()
+    return url.render_as_string(hide_password=False)
+
+
+def create_database(url, replace=False, maintenance_db='postgres'):
+    """Create an empty database, without the schema (e.g., for the alembic revisions to build it)
+
+    Parameters
+    ----------
+        url : url of the database to be created
+        replace : drop the database first if it exists (default: ValueError if it exists)
+        maintenance_db : the database to connect to for CREATE DATABASE (PostgreSQL)
+
+    Returns
+    ----------
+        url : the url of the new database
+    """
+    url = make_url(url)
+    if url.get_backend_name() == 'sqlite':
+        path = _sqlitePath(url)
+        if os.path.exists(path) and not replace:
+            raise ValueError(f'{path} already exists')
+        drop_database(url)
+        # the file is created by the first connection
+        return url.render_as_string(hide_password=False)
+    engine = _maintenance(url, maintenance_db)
+    try:
+        with engine.connect() as conn:
+            exists = conn.execute(text('SELECT 1 FROM pg_database WHERE datname = :name'),
+                                  {'name': url.database}).first()
+            if exists is not None:
+                if not replace:
+                    raise ValueError(f'database {url.database} already exists')
+                conn.exec_driver_sql(f'DROP DATABASE "{url.database}"')
+            conn.exec_driver_sql(f'CREATE DATABASE "{url.database}"')
+    finally:
+        engine.dispose()
+    return url.render_as_string(hide_password=False)
+
+
+def drop_database(url, maintenance_db='postgres'):
+    ''' drop the database (or remove the SQLite file) created by clone_database '''
+    url = make_url(url)
+    if url.get_backend_name() == 'sqlite':
+        path = _sqlitePath(url)
+        for p in [path, path + '-journal', path + '-wal', path + '-shm']:
+            if os.path.exists(p):
+                os.unlink(p)
+        return
+    engine = _maintenance(url, maintenance_db)
+    try:
+        with engine.connect() as conn:
+            conn.exec_driver_sql(f'DROP DATABASE IF EXISTS "{url.database}"')
+    finally:
+        engine.dispose()
+
+
+def prune_templates(url, stamp=None, cache_dir=None, maintenance_db='postgres', partition_agc=False):
+    """Drop the templates of the former schemas (and of the other partitioning)
+
+    Returns
+    ----------
+        names : the dropped templates
+    """
+    url = make_url(url)
+    dialect = url.get_backend_name()
+    current = _templateName(dialect, stamp, partition_agc)
+    if dialect == 'sqlite':
+        cacheDir = cache_dir or default_cache_dir()
+        paths = [p for p in glob.glob(os.path.join(cacheDir, f'{TEMPLATE_PREFIX}*.sqlite'))
+                 if os.path.basename(p) != f'{current}.sqlite']
+        for p in paths:
+            os.unlink(p)
+        return paths
+    engine = _maintenance(url, maintenance_db)
+    try:
+        with engine.connect() as conn:
+            names = [n for (n, ) in conn.execute(text('SELECT datname FROM pg_database WHERE datname LIKE :p'),
+                                                  {'p': f'{TEMPLATE_PREFIX}%'}) if n != current]
+            for name in names:
+                conn.exec_driver_sql(f'ALTER DATABASE "{name}" IS_TEMPLATE false')
+                conn.exec_driver_sql(f'DROP DATABASE "{name}"')
+    finally:
+        engine.dispose()
+    return names
+
+
+def main():
+    parser = argparse.ArgumentParser(description='create a qaDB database as a clone of the schema template')
+    parser.add_argument('url', type=str, help='url of the database to be created')
+    parser.add_argument('--stamp', type=str, default=None, help='alembic revision to be stamped')
+    parser.add_argument('--cache-dir', type=str, default=None, help='the directory of the SQLite templates')
+    parser.add_argument('--template-only', action='store_true', help='only build the template')
+    parser.add_argument('--prune', action='store_true', help='drop the templates of the former schemas')
+    parser.add_argument('--partition-agc', action='store_true',
+                        help='partition the AGC exposure tables by month (PostgreSQL)')
+    parser.add_argument('--replace', action='store_true',
+                        help='drop the database first if it exists (otherwise an error)')
+    args = parser.parse_args()
+
+    if args.template_only:
+        url = template_database(args.url, stamp=args.stamp, cache_dir=args.cache_dir,
+                                partition_agc=args.partition_agc)
+    else:
+        url = clone_database(args.url, stamp=args.stamp, cache_dir=args.cache_dir,
+                             replace=args.replace, partition_agc=args.partition_agc)
+    logger.info(f'{make_url(url).render_as_string()} is ready')
+    if args.prune:
+        for name in prune_templates(args.url, stamp=args.stamp, cache_dir=args.cache_dir,
+                                    partition_agc=args.partition_agc):
+            logger.info(f'{name} dropped')
+
+
+if __name__ == '__main__':
+    main()
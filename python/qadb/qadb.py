@@ -1,12 +1,535 @@
 #!/usr/bin/env python
 
-import numpy as np
-from sqlalchemy import create_engine, exc, text
-import pandas as pd
-from logzero import logger
+import datetime
+import functools
+import io
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+from sqlalchemy import create_engine, exc, inspect, text, select, tuple_, and_, bindparam, func, true
+from sqlalchemy import BigInteger, Boolean, DateTime, Integer, REAL, String
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.pool import QueuePool
+
+from . import models
+from ._lazy import LazyModule, LazyAttribute
+
+# imported on the first use, so that short-lived scripts importing qadb do not pay for them
+np = LazyModule('numpy')
+pd = LazyModule('pandas')
+logger = LazyAttribute('logzero', 'logger')
+
+
+def _getTable(tableName):
+    try:
+        return models.Base.metadata.tables[tableName]
+    except KeyError:
+        raise ValueError(f'{tableName} is not defined in qadb.models')
+
+
+def _countExisting(conn, table, pkeys, records, batchsize=500):
+    cols = [table.c[k] for k in pkeys]
+    keys = [tuple(r[k] for k in pkeys) for r in records]
+    n = 0
+    for i in range(0, len(keys), batchsize):
+        batch = keys[i:i + batchsize]
+        if len(cols) == 1:
+            cond = cols[0].in_([k[0] for k in batch])
+        else:
+            cond = tuple_(*cols).in_(batch)
+        n += len(conn.execute(select(*cols).where(cond)).all())
+    return n
+
+
+# the tables which may be created with another primary key (see qadb.partitions)
+AGC_TABLES = models.AGC_TABLES
+# the number of writes to each AGC table kept in qa_table_change
+CHANGE_HISTORY = 10000
+
+# the primary keys of AGC_TABLES found in the databases, per (url, table)
+_conflictKeyCache = {}
+
+
+def _conflictKeys(conn, table):
+    ''' the primary key of the table in the database, i.e., the ON CONFLICT target of the upserts
+
+    It is that of qadb.models, except for the AGC exposure tables partitioned
+    by qadb.partitions, where taken_at is a part of the primary key.
+    '''
+    pkeys = [c.name for c in table.primary_key.columns]
+    if conn.dialect.name != 'postgresql' or table.name not in AGC_TABLES:
+        return pkeys
+    key = (conn.engine.url.render_as_string(), table.name)
+    if key not in _conflictKeyCache:
+        found = inspect(conn).get_pk_constraint(table.name)['constrained_columns']
+        _conflictKeyCache[key] = found or pkeys
+    return _conflictKeyCache[key]
+
+
+def _primaryKeys(table, df, pkeys=None):
+    if pkeys is None:
+        pkeys = [c.name for c in table.primary_key.columns]
+    missing = [k for k in pkeys if k not in df.columns]
+    if len(missing) > 0:
+        raise ValueError(f'primary key {missing} is missing for {table.name}')
+    unknown = [k for k in df.columns if k not in table.c]
+    if len(unknown) > 0:
+        raise ValueError(f'{unknown} are not columns of {table.name}')
+    return pkeys
+
+
+def _generatedKey(table, df):
+    ''' whether the rows leave the autoincrement primary key (e.g., test.test_id) to the database '''
+    column = table.autoincrement_column
+    return column is not None and column.autoincrement is True and column.name not in df.columns
+
+
+# the range of the nullable integer dtypes of the Integer/BigInteger columns
+_INT_RANGES = {'Int32': (-2**31, 2**31 - 1), 'Int64': (-2**63, 2**63 - 1)}
+
+
+def _dtype(column):
+    ''' the compact pandas dtype of the column; nullable for the integers, so that NULLs are kept '''
+    t = column.type
+    if isinstance(t, BigInteger):
+        return 'Int64'
+    elif isinstance(t, Integer):
+        return 'Int32'
+    elif isinstance(t, REAL):
+        return 'float32'
+    elif isinstance(t, DateTime):
+        return 'datetime64[us]'
+    elif isinstance(t, Boolean):
+        return 'boolean'
+    elif isinstance(t, String) and t.length == 1:
+        return 'category'
+    return None
+
+
+def _checkIntegers(table, name, values, dtype):
+    ''' raise ValueError if the values are not integers within the range of the dtype '''
+    try:
+        values = pd.to_numeric(values.dropna())
+    except (TypeError, ValueError) as e:
+        raise ValueError(f'{table.name}.{name} has non-numeric values: {e}')
+    if len(values) == 0:
+        return
+    # NaN (inf % 1) is not 0 either, so the infinities are rejected too
+    fraction = values[values % 1 != 0]
+    if len(fraction) > 0:
+        raise ValueError(f'{table.name}.{name} has non-integral values: {fraction.iloc[:3].tolist()}')
+    lo, hi = _INT_RANGES[dtype]
+    if values.min() < lo or values.max() > hi:
+        raise ValueError(f'{table.name}.{name} has values out of the range of {dtype}: '
+                         f'[{values.min()}, {values.max()}]')
+
+
+def _convert(table, df):
+    '''cast the DataFrame to the column types of the table at once
+
+    The columns which the table does not have are dropped, and NULL values are
+    kept. The integer columns are cast to the nullable Int32/Int64, and
+    ValueError is raised for the values which are not integral or do not fit.
+    '''
+    unknown = [k for k in df.columns if k not in table.c]
+    if len(unknown) > 0:
+        logger.warning(f'{unknown} are not columns of {table.name} and are dropped')
+    df = df[[k for k in df.columns if k in table.c]]
+    dtypes = {}
+    for k in df.columns:
+        dtype = _dtype(table.c[k])
+        if dtype is not None and df[k].dtype != dtype:
+            if dtype in _INT_RANGES:
+                _checkIntegers(table, k, df[k], dtype)
+            dtypes[k] = dtype
+    if len(dtypes) > 0:
+        df = df.astype(dtypes)
+    return df
+
+
+def _records(df):
+    ''' list of dicts for executemany, where NaN/NaT are sent as NULL '''
+    return df.astype(object).where(df.notna(), None).to_dict(orient='records')
+
+
+@functools.lru_cache(maxsize=256)
+def _upsertStatement(dialect, tableName, columns, pkeys):
+    ''' INSERT ... ON CONFLICT (pk) DO UPDATE with bound parameters, cached per (table, columns) '''
+    table = _getTable(tableName)
+    if dialect == 'postgresql':
+        stmt = postgresql.insert(table)
+    elif dialect == 'sqlite':
+        stmt = sqlite.insert(table)
+    else:
+        raise NotImplementedError(f'upsert is not supported for {dialect}')
+    updateCols = [k for k in columns if k not in pkeys]
+    if len(updateCols) > 0:
+        stmt = stmt.on_conflict_do_update(
+            index_elements=pkeys,
+            set_={k: stmt.excluded[k] for k in updateCols}
+        )
+    else:
+        stmt = stmt.on_conflict_do_nothing(index_elements=pkeys)
+    return stmt
+
+
+@functools.lru_cache(maxsize=256)
+def _updateStatement(tableName, columns, pkeys):
+    ''' UPDATE ... WHERE pk = :_pk_<key> with bound parameters, cached per (table, columns) '''
+    table = _getTable(tableName)
+    cond = and_(*[table.c[k] == bindparam(f'_pk_{k}') for k in pkeys])
+    values = {k: bindparam(k) for k in columns if k not in pkeys}
+    return table.update().where(cond).values(values)
+
+
+def _upsert(conn, table, df):
+    if _generatedKey(table, df):
+        # the keys are generated by the database, so the rows are all new
+        _primaryKeys(table, df, [])
+        if len(df) > 0:
+            conn.execute(table.insert(), _records(df))
+        return {'inserted': len(df), 'updated': 0}
+    pkeys = _primaryKeys(table, df, _conflictKeys(conn, table))
+    if len(df) == 0:
+        return {'inserted': 0, 'updated': 0}
+
+    df = df.drop_duplicates(subset=pkeys, keep='last')
+    records = _records(df)
+    stmt = _upsertStatement(conn.dialect.name, table.name, tuple(df.columns), tuple(pkeys))
+    nExisting = _countExisting(conn, table, pkeys, records)
+    conn.execute(stmt, records)
+    return {'inserted': len(records) - nExisting, 'updated': nExisting}
+
+
+def _update(conn, table, df):
+    pkeys = _primaryKeys(table, df, _conflictKeys(conn, table))
+    if len(df) == 0 or len(df.columns) == len(pkeys):
+        return 0
+
+    df = df.drop_duplicates(subset=pkeys, keep='last')
+    records = _records(df)
+    for r in records:
+        for k in pkeys:
+            r[f'_pk_{k}'] = r.pop(k)
+    stmt = _updateStatement(table.name, tuple(df.columns), tuple(pkeys))
+    return conn.execute(stmt, records).rowcount
+
+
+class _Touched(object):
+    ''' the rows written by an ingest call, used to maintain the derived tables and caches '''
+    def __init__(self, table, df=None):
+        self.table = table
+        self.visits = set()
+        self.takenAt = None
+        self.allTimes = False
+        if df is not None:
+            self.add(df)
+
+    def add(self, df):
+        if len(df) == 0:
+            return
+        if 'pfs_visit_id' in df.columns:
+            self.visits |= set(int(v) for v in df['pfs_visit_id'].dropna().unique())
+        if 'taken_at' in df.columns:
+            takenAt = pd.to_datetime(df['taken_at']).min()
+            if pd.isna(takenAt):
+                self.allTimes = True
+            elif self.takenAt is None or takenAt < self.takenAt:
+                self.takenAt = takenAt
+        else:
+            self.allTimes = True
+
+    @property
+    def summaryVisits(self):
+        ''' the visits whose visit_summary rows should be refreshed '''
+        if self.table.name not in models.SUMMARY_SOURCES + ['pfs_visit']:
+            return set()
+        return self.visits
+
+
+@functools.lru_cache(maxsize=8)
+def _summaryStatement(dialect, full):
+    ''' INSERT INTO visit_summary SELECT ... FROM pfs_visit LEFT JOIN ... for the :visits (or all) '''
+    tables = models.Base.metadata.tables
+    summary = models.visit_summary
+    visit = tables['pfs_visit']
+    columns = [visit.c.pfs_visit_id, visit.c.pfs_design_id, visit.c.issued_at]
+    fromClause = visit
+    for tableName in models.SUMMARY_SOURCES:
+        source = tables[tableName]
+        fromClause = fromClause.outerjoin(source, source.c.pfs_visit_id == visit.c.pfs_visit_id)
+    for tableName, colName, name in models.summary_columns():
+        columns.append(tables[tableName].c[colName].label(name))
+    if dialect == 'sqlite':
+        # CURRENT_TIMESTAMP of SQLite is in seconds, too coarse to find the rows refreshed after a rollup
+        columns.append(func.strftime('%Y-%m-%d %H:%M:%f', 'now').label('refreshed_at'))
+    else:
+        columns.append(func.current_timestamp().label('refreshed_at'))
+    sel = select(*columns).select_from(fromClause)
+    if full:
+        sel = sel.where(true())
+    else:
+        sel = sel.where(visit.c.pfs_visit_id.in_(bindparam('visits', expanding=True)))
+
+    names = [c.name for c in summary.columns]
+    if dialect == 'postgresql':
+        stmt = postgresql.insert(summary)
+    elif dialect == 'sqlite':
+        stmt = sqlite.insert(summary)
+    else:
+        raise NotImplementedError(f'visit_summary is not supported for {dialect}')
+    stmt = stmt.from_select(names, sel)
+    return stmt.on_conflict_do_update(index_elements=['pfs_visit_id'],
+                                      set_={k: stmt.excluded[k] for k in names[1:]})
+
+
+def _refreshSummary(conn, visits=None, batchsize=500):
+    ''' refresh the visit_summary rows of the visits (all visits if None) '''
+    if visits is None:
+        return conn.execute(_summaryStatement(conn.dialect.name, True)).rowcount
+    visits = sorted(visits)
+    n = 0
+    for i in range(0, len(visits), batchsize):
+        stmt = _summaryStatement(conn.dialect.name, False)
+        n += conn.execute(stmt, {'visits': visits[i:i + batchsize]}).rowcount
+    return n
+
+
+def _bumpVersions(conn, tableNames, touched=None, changes=False):
+    '''increment the versions of the written tables in qa_table_version
+
+    With changes, the earliest taken_at written to the AGC exposure tables
+    (of touched, any time if not known) is recorded in qa_table_change with
+    the new version, see QaDB.aggregate_agc.
+    '''
+    table = models.qa_table_version.__table__
+    insert = postgresql.insert if conn.dialect.name == 'postgresql' else sqlite.insert
+    now = datetime.datetime.now()
+    stmt = insert(table).values([{'table_name': t, 'version': 1, 'updated_at': now}
+                                 for t in sorted(set(tableNames))])
+    stmt = stmt.on_conflict_do_update(index_elements=['table_name'],
+                                      set_={'version': table.c.version + 1,
+                                            'updated_at': stmt.excluded.updated_at})
+    conn.execute(stmt)
+
+    agcTables = sorted(set(tableNames) & set(AGC_TABLES))
+    if not changes or len(agcTables) == 0:
+        return
+    history = models.qa_table_change.__table__
+    for tableName, version in _tableVersions(conn, agcTables).items():
+        takenFrom = None
+        if touched is not None and touched.table.name == tableName and not touched.allTimes:
+            takenFrom = touched.takenAt.to_pydatetime()
+        conn.execute(history.insert().values(table_name=tableName, version=version,
+                                             taken_from=takenFrom, changed_at=now))
+        conn.execute(history.delete().where(history.c.table_name == tableName,
+                                            history.c.version <= version - CHANGE_HISTORY))
+
+
+def _changedFrom(conn, tableName, since, until):
+    '''the earliest taken_at written to the table by the versions after since, up to until
+
+    Returns
+    ----------
+        takenFrom : datetime, or None if any time may have been written
+                    (a write of any time, or a version missing in qa_table_change)
+    '''
+    if until <= since:
+        return None
+    history = models.qa_table_change.__table__
+    n, known, takenFrom = conn.execute(
+        select(func.count(), func.count(history.c.taken_from), func.min(history.c.taken_from))
+        .where(history.c.table_name == tableName,
+               history.c.version > since, history.c.version <= until)).one()
+    if n != until - since or known != n:
+        return None
+    return takenFrom
+
+
+def _tableVersions(conn, tableNames):
+    ''' the versions of the tables in qa_table_version (0 if never written) '''
+    table = models.qa_table_version.__table__
+    versions = {t: 0 for t in tableNames}
+    if len(versions) > 0:
+        rows = conn.execute(select(table.c.table_name, table.c.version)
+                            .where(table.c.table_name.in_(sorted(versions))))
+        versions.update({t: v for t, v in rows})
+    return versions
+
+
+@contextmanager
+def _statementTimeout(conn, timeout):
+    ''' cancel the statements on the connection which take longer than timeout (sec.) '''
+    if timeout is None:
+        yield
+        return
+    if conn.dialect.name == 'postgresql':
+        # SET LOCAL lasts until the end of the transaction, which is rolled back when the connection is closed
+        conn.exec_driver_sql(f'SET LOCAL statement_timeout = {max(int(timeout * 1000), 1)}')
+        yield
+    elif conn.dialect.name == 'sqlite':
+        dbapi = conn.connection.dbapi_connection
+        deadline = time.monotonic() + timeout
+        dbapi.set_progress_handler(lambda: time.monotonic() > deadline, 10000)
+        try:
+            yield
+        finally:
+            dbapi.set_progress_handler(None, 0)
+    else:
+        logger.warning(f'statement timeout is not supported for {conn.dialect.name}')
+        yield
+
+
+def _stagingTable(table):
+    return f'_staging_{table.name}'
+
+
+def _createStagingSQL(table):
+    return (f'CREATE TEMP TABLE {_stagingTable(table)} '
+            f'(LIKE {table.name} INCLUDING DEFAULTS) ON COMMIT DROP')
+
+
+def _mergeSQL(table, cols, pkeys):
+    ''' SQL to count the staged rows which already exist and to merge them into the table '''
+    staging = _stagingTable(table)
+    collist = ', '.join(cols)
+    pklist = ', '.join(pkeys)
+    countSQL = f'SELECT count(*) FROM {staging} JOIN {table.name} USING ({pklist})'
+    updateCols = [k for k in cols if k not in pkeys]
+    if len(updateCols) > 0:
+        action = 'DO UPDATE SET ' + ', '.join(f'{k} = EXCLUDED.{k}' for k in updateCols)
+    else:
+        action = 'DO NOTHING'
+    mergeSQL = (f'INSERT INTO {table.name} ({collist}) SELECT {collist} FROM {staging} '
+                f'ON CONFLICT ({pklist}) {action}')
+    return countSQL, mergeSQL
+
+
+def _toCSV(table, df):
+    ''' the rows in CSV for COPY, with the integer columns with NULLs written as integers, not as floats '''
+    buf = io.StringIO()
+    _convert(table, df).to_csv(buf, index=False, header=False, na_rep='')
+    buf.seek(0)
+    return buf
+
+
+def _cursorExecute(cursor, statement, csv=None, instrumentation=None, kind=None, table=None):
+    '''execute the statement (COPY ... FROM STDIN of csv) on the DBAPI cursor
+
+    The cursor of a raw connection bypasses the events of the engine, so the
+    statement is recorded with the instrumentation (if any) explicitly,
+    labeled with kind and table if given (see Instrumentation.timed).
+    '''
+    if instrumentation is None:
+        return cursor.execute(statement) if csv is None else cursor.copy_expert(statement, csv)
+    with instrumentation.timed(statement, cursor, kind=kind, table=table):
+        return cursor.execute(statement) if csv is None else cursor.copy_expert(statement, csv)
+
+
+def _copyChunk(cursor, table, df, pkeys=None, instrumentation=None):
+    pkeys = _primaryKeys(table, df, pkeys)
+    df = df.drop_duplicates(subset=pkeys, keep='last')
+    cols = list(df.columns)
+    staging = _stagingTable(table)
+    countSQL, mergeSQL = _mergeSQL(table, cols, pkeys)
+
+    # labeled with the target table rather than the staging one
+    _cursorExecute(cursor, f'TRUNCATE {staging}', instrumentation=instrumentation, table=table.name)
+    _cursorExecute(cursor, f'COPY {staging} ({", ".join(cols)}) FROM STDIN WITH (FORMAT csv)',
+                   _toCSV(table, df), instrumentation, table=table.name)
+    _cursorExecute(cursor, countSQL, instrumentation=instrumentation, table=table.name)
+    nExisting = cursor.fetchone()[0]
+    _cursorExecute(cursor, mergeSQL, instrumentation=instrumentation, kind='merge', table=table.name)
+    return {'inserted': len(df) - nExisting, 'updated': nExisting}
+
+
+def _toArray(values):
+    ''' column values to a numpy array, where NULL becomes NaN/NaT '''
+    arr = np.array(values)
+    if arr.dtype != object:
+        return arr
+    for dtype in (float, 'datetime64[us]'):
+        try:
+            return np.array(values, dtype=dtype)
+        except (TypeError, ValueError):
+            pass
+    return arr
+
+
+@functools.lru_cache(maxsize=256)
+def _dateColumns(dialect, sqlCmd):
+    '''the names of the DateTime columns of the tables a SQL string refers to, on SQLite
+
+    The DBAPI of SQLite returns the DateTime values as strings, which are
+    converted by SQLAlchemy only for the statements built from the models,
+    so the result columns of a SQL string with these names are converted by
+    QaDB itself (as the DBAPI of PostgreSQL returns them).
+    '''
+    if dialect != 'sqlite' or not isinstance(sqlCmd, str):
+        return frozenset()
+    from .cache import tablesIn
+    tables = models.Base.metadata.tables
+    return frozenset(c.name for t in tablesIn(sqlCmd) if t in tables
+                     for c in tables[t].columns if isinstance(c.type, DateTime))
+
+
+def _iterChunks(df_or_iterator):
+    if isinstance(df_or_iterator, pd.DataFrame):
+        return [df_or_iterator]
+    return df_or_iterator
+
+
+def _agcColumn(metric):
+    ''' the table and column of an AGC metric (e.g., 'seeing_median' or 'transparency_agc_exposure.wavelength_ref') '''
+    if '.' in metric:
+        tableName, colName = metric.split('.', 1)
+    else:
+        tableName, colName = f'{metric.split("_")[0]}_agc_exposure', metric
+    if tableName not in AGC_TABLES or colName not in _getTable(tableName).c:
+        raise ValueError(f'{metric} is not a column of {AGC_TABLES}')
+    return _getTable(tableName), colName
+
+
+def _bucketSeconds(bucket):
+    if isinstance(bucket, (int, float)):
+        seconds = int(bucket)
+    else:
+        seconds = int(pd.Timedelta(bucket).total_seconds())
+    if seconds <= 0:
+        raise ValueError(f'bucket should be positive: {bucket}')
+    return seconds
+
+
+def _aggregateAgc(conn, table, colName, seconds, start, end, percentiles):
+    ''' rows of (bucket [epoch sec.], count, mean, median, *percentiles, last taken_at) '''
+    params = {'s': seconds, 'start': start, 'end': end}
+    where = f'WHERE taken_at >= :start AND taken_at < :end AND {colName} IS NOT NULL'
+    if conn.dialect.name == 'postgresql':
+        qs = ', '.join(str(q / 100) for q in [50] + list(percentiles))
+        sql = (f'SELECT floor(extract(epoch FROM taken_at) / :s) * :s AS bucket, '
+               f'count({colName}), avg({colName}), '
+               f'percentile_cont(ARRAY[{qs}]) WITHIN GROUP (ORDER BY {colName}), max(taken_at) '
+               f'FROM {table.name} {where} GROUP BY bucket ORDER BY bucket')
+        return [(int(b), n, mean, *qv, last)
+                for b, n, mean, qv, last in conn.execute(text(sql), params).all()]
+
+    # no percentile aggregate in SQLite: the buckets are computed in SQL, the statistics in numpy
+    sql = (f"SELECT CAST(strftime('%s', taken_at) AS INTEGER) / :s * :s AS bucket, "
+           f'{colName}, taken_at FROM {table.name} {where} ORDER BY bucket')
+    rows = conn.execute(text(sql), params).all()
+    if len(rows) == 0:
+        return []
+    buckets = np.array([r[0] for r in rows])
+    values = np.array([r[1] for r in rows], dtype=float)
+    takenAt = np.array([r[2] for r in rows], dtype='datetime64[us]')
+    edges = np.flatnonzero(np.diff(buckets)) + 1
+    result = []
+    for b, v, t in zip(np.split(buckets, edges), np.split(values, edges), np.split(takenAt, edges)):
+        qv = np.percentile(v, [50] + list(percentiles))
+        result.append((int(b[0]), len(v), v.mean(), *qv, t.max()))
+    return result
 
-import warnings
-warnings.filterwarnings('ignore')
 
 class QaDB(object):
     """QaDB
@@ -15,45 +538,780 @@ class QaDB(object):
     ----------
         url : f'{dialect}://{username}@{hostname}:{port}/{dbname}'
             Note that PASSWORD should in .pgpass
+        pool_size : the number of connections kept open in the pool
+        max_overflow : the number of connections allowed beyond pool_size
+        pool_timeout : seconds to wait for a connection before giving up
+        pool_recycle : seconds after which a connection is replaced
+        pool_pre_ping : test the connection liveness on every checkout
+        refresh_summary : refresh visit_summary for the visits touched by each write
+                          (skipped with a warning if the database has no visit_summary)
+        refresh_rollup : also recompute the nightly rollups of the nights touched by each
+                         write (see qadb.rollup; requires refresh_summary); the monthly
+                         ones are left to refreshRollup or qadb-rollup
+        cache_bytes : enable the query result cache with this size limit (default: no cache)
+        cache_ttl : the lifetime of the cached query results (sec.)
+        cache_dir : enable the query result cache shared by the processes on the host,
+                    stored as Arrow files in this directory (default: no cache)
+        cache_dir_bytes : the size budget of cache_dir
+        table_versions : increment the versions of the written tables in qa_table_version
+                         (if the database has it), which key the shared cache of cache_dir of
+                         any reader, so the writers keep it on (default: True)
+        instrument : record the latency, rows and errors of the SQL statements
+                     (see metrics(); no overhead when False)
+        statement_timeout : the default timeout (sec.) of query(), after which it is cancelled
+        slow_query_threshold : log the queries which take longer than this (sec.)
+        slow_query_log : the JSONL file of the slow queries (see qadb.slowlog.SlowQueryLog)
+        slow_query_explain : 'analyze' (EXPLAIN (ANALYZE, BUFFERS), which runs the query
+                             again), 'plan' (EXPLAIN only) or None
 
     Examples
     ----------
 
     """
-    def __init__(self, url):
+    def __init__(self, url, pool_size=5, max_overflow=10, pool_timeout=30,
+                 pool_recycle=3600, pool_pre_ping=True, refresh_summary=True, refresh_rollup=False,
+                 cache_bytes=None, cache_ttl=60.0, cache_dir=None, cache_dir_bytes=1024**3,
+                 table_versions=True, instrument=False, statement_timeout=None, slow_query_threshold=None,
+                 slow_query_log=None, slow_query_explain='analyze'):
         self.url = url
-        self._engine = create_engine(self.url)
-        self._conn = self._engine.raw_connection()
+        self.refresh_summary = refresh_summary
+        self.refresh_rollup = refresh_rollup
+        self._cache = None
+        if cache_bytes is not None:
+            from .cache import QueryCache
+            self._cache = QueryCache(max_bytes=cache_bytes, ttl=cache_ttl)
+        self._arrowCache = None
+        if cache_dir is not None:
+            from .arrowcache import ArrowCache
+            self._arrowCache = ArrowCache(cache_dir, max_bytes=cache_dir_bytes)
+        self.table_versions = table_versions
+        self._tables = {}
+        # the engine (and the DBAPI module) is created on the first use, see _engine
+        self._engineOptions = dict(poolclass=QueuePool,
+                                   pool_size=pool_size,
+                                   max_overflow=max_overflow,
+                                   pool_timeout=pool_timeout,
+                                   pool_recycle=pool_recycle,
+                                   pool_pre_ping=pool_pre_ping,
+                                   )
+        self._engineInstance = None
+        self._engineLock = threading.Lock()
+        self.statement_timeout = statement_timeout
+        self._slowLog = None
+        if slow_query_threshold is not None:
+            from .slowlog import SlowQueryLog
+            self._slowLog = SlowQueryLog(slow_query_threshold, path=slow_query_log,
+                                         explain=slow_query_explain)
+        self.instrumentation = None
+        if instrument:
+            from .instrumentation import Instrumentation
+            self.instrumentation = Instrumentation()
+            self.instrumentation.addGauges(lambda: {f'pool_{k}': v for k, v in self.poolStatus().items()})
+        self._statsLock = threading.Lock()
+        self._aggCache = {}
+        self._checkouts = 0
+        self._waitTotal = 0.0
+        self._waitMax = 0.0
 
-    def query(self, sqlCmd):
-        df = pd.read_sql(sql=sqlCmd, con=self._conn)
+    @property
+    def _engine(self):
+        ''' the engine, created on the first use; no connection is opened until a query or write '''
+        if self._engineInstance is None:
+            with self._engineLock:
+                if self._engineInstance is None:
+                    engine = create_engine(self.url, **self._engineOptions)
+                    if self.instrumentation is not None:
+                        self.instrumentation.attach(engine)
+                    self._engineInstance = engine
+        return self._engineInstance
+
+    def _recordWait(self, wait):
+        with self._statsLock:
+            self._checkouts += 1
+            self._waitTotal += wait
+            self._waitMax = max(self._waitMax, wait)
+
+    @contextmanager
+    def _connect(self):
+        t0 = time.perf_counter()
+        conn = self._engine.connect()
+        self._recordWait(time.perf_counter() - t0)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    @contextmanager
+    def _begin(self):
+        with self._connect() as conn, conn.begin():
+            yield conn
+
+    def _rawConnection(self):
+        t0 = time.perf_counter()
+        conn = self._engine.raw_connection()
+        self._recordWait(time.perf_counter() - t0)
+        return conn
+
+    def poolStatus(self):
+        """Statistics of the connection pool
+
+        Returns
+        ----------
+            status : dict with 'size', 'checked_in', 'checked_out', 'overflow',
+                     'checkouts', 'wait_time_total' and 'wait_time_max' (sec.)
+        """
+        pool = self._engine.pool
+        with self._statsLock:
+            status = {'size': pool.size(),
+                      'checked_in': pool.checkedin(),
+                      'checked_out': pool.checkedout(),
+                      'overflow': pool.overflow(),
+                      'checkouts': self._checkouts,
+                      'wait_time_total': self._waitTotal,
+                      'wait_time_max': self._waitMax,
+                      }
+        return status
+
+    def metrics(self):
+        """Metrics of the SQL statements (see qadb.instrumentation.Instrumentation.snapshot)
+
+        Returns an empty dict unless the QaDB is created with instrument=True.
+        """
+        if self.instrumentation is None:
+            return {}
+        return self.instrumentation.snapshot()
+
+    def exportMetrics(self, path=None):
+        """The metrics in the Prometheus text format, also written to the file if given"""
+        if self.instrumentation is None:
+            raise RuntimeError('QaDB is not instrumented (instrument=True)')
+        if path is not None:
+            self.instrumentation.writePrometheus(path)
+        return self.instrumentation.prometheus()
+
+    def serveMetrics(self, port=9464, host='127.0.0.1'):
+        """Serve the metrics in the Prometheus text format at http://{host}:{port}/metrics
+
+        Returns
+        ----------
+            server : http.server.ThreadingHTTPServer (call shutdown() to stop it)
+        """
+        if self.instrumentation is None:
+            raise RuntimeError('QaDB is not instrumented (instrument=True)')
+        return self.instrumentation.serve(port=port, host=host)
+
+    def close(self):
+        if self._engineInstance is None:
+            return
+        if self.instrumentation is not None:
+            self.instrumentation.detach()
+        self._engineInstance.dispose()
+
+    def _hasTable(self, tableName, conn=None):
+        ''' whether the database has the table (looked up once), e.g. not the ones of the later revisions '''
+        if tableName not in self._tables:
+            with self._connect() if conn is None else nullcontext(conn) as c:
+                self._tables[tableName] = inspect(c).has_table(tableName)
+            if not self._tables[tableName]:
+                logger.warning(f'{tableName} does not exist in {self._engine.url.render_as_string()}')
+        return self._tables[tableName]
+
+    def _requireTables(self, tableNames, conn=None):
+        ''' models.require_tables with the lookups of _hasTable, e.g. for the qadb-only tables '''
+        if not all(self._hasTable(name, conn) for name in tableNames):
+            with self._connect() if conn is None else nullcontext(conn) as c:
+                models.require_tables(c, tableNames)
+
+    def _afterWrite(self, conn, touched):
+        '''maintain the derived tables in the transaction of the write
+
+        Returns
+        ----------
+            written : the names of the tables written
+        '''
+        written = [touched.table.name]
+        if self.refresh_summary and len(touched.summaryVisits) > 0 \
+           and self._hasTable(models.visit_summary.name, conn):
+            _refreshSummary(conn, touched.summaryVisits)
+            written.append('visit_summary')
+            if self.refresh_rollup and self._hasTable(models.qa_rollup_nightly.name, conn):
+                from . import rollup
+                if rollup.refreshVisits(conn, touched.summaryVisits)['nights'] > 0:
+                    written.append('qa_rollup_nightly')
+        return written
+
+    def _afterCommit(self, written, touched=None):
+        '''invalidate the caches of the written tables, once the write is committed
+
+        The versions in qa_table_version are incremented in a short transaction
+        of their own, so that the concurrent writers do not wait for each
+        other on the row locks, and the in-process caches are invalidated only
+        now, so that a concurrent query cannot cache the rows before the commit
+        as the new version.
+        '''
+        if self.table_versions and self._hasTable(models.qa_table_version.__tablename__):
+            with self._begin() as conn:
+                _bumpVersions(conn, written, touched,
+                              changes=self._hasTable(models.qa_table_change.__tablename__, conn))
+        if self._cache is not None:
+            self._cache.bump(written)
+        if touched is not None and touched.table.name in AGC_TABLES:
+            self._invalidateAggregates(touched)
+
+    def _invalidateAggregates(self, touched):
+        ''' forget the cached buckets at or after the earliest taken_at written '''
+        with self._statsLock:
+            for key in list(self._aggCache):
+                if key[0] != touched.table.name:
+                    continue
+                if touched.allTimes:
+                    del self._aggCache[key]
+                    continue
+                entry = self._aggCache[key]
+                since = int(touched.takenAt.timestamp()) // key[2] * key[2]
+                entry['until'] = min(entry['until'], since)
+                entry['rows'] = {b: r for b, r in entry['rows'].items() if b < entry['until']}
+
+    def _advanceAggregates(self, conn, table, seconds, entry, version):
+        '''the cached buckets of entry still valid at version of the table
+
+        The buckets at or after the earliest taken_at written since the
+        version of entry (see qa_table_change) are dropped.
+
+        Returns
+        ----------
+            entry : the new cache entry, or None if the writes are not known
+        '''
+        if version is None or entry['version'] is None \
+           or not self._hasTable(models.qa_table_change.__tablename__, conn):
+            return None
+        takenFrom = _changedFrom(conn, table.name, entry['version'], version)
+        if takenFrom is None:
+            return None
+        until = min(entry['until'], int(pd.Timestamp(takenFrom).timestamp()) // seconds * seconds)
+        return {'from': entry['from'], 'until': until, 'version': version,
+                'rows': {b: r for b, r in entry['rows'].items() if b < until}}
+
+    def refreshVisitSummary(self, visits=None):
+        """Refresh the visit_summary table
+
+        Parameters
+        ----------
+            visits : list of pfs_visit_id to be refreshed (default: all the visits)
+
+        Returns
+        ----------
+            nrows : the number of refreshed rows
+        """
+        with self._begin() as conn:
+            self._requireTables([models.visit_summary.name], conn)
+            nrows = _refreshSummary(conn, visits)
+        self._afterCommit(['visit_summary'])
+        return nrows
+
+    def query(self, sqlCmd, params=None, cache=True, timeout=None):
+        """Run the query and return the result as a DataFrame
+
+        Parameters
+        ----------
+            sqlCmd : SQL string or SQLAlchemy selectable
+            params : the query parameters passed to pandas.read_sql
+            cache : use the query result caches (if enabled with cache_bytes or cache_dir)
+            timeout : cancel the query after this (sec.) (default: statement_timeout)
+        """
+        timeout = self.statement_timeout if timeout is None else timeout
+        if self._cache is None or not cache:
+            return self._queryShared(sqlCmd, params, cache, timeout)
+
+        key = self._cache.key(sqlCmd, params)
+        df = self._cache.get(key)
+        if df is None:
+            versions = self._cache.versionsOf(key)
+            df = self._queryShared(sqlCmd, params, cache, timeout)
+            self._cache.put(key, df, versions)
+        return df.copy()
+
+    def _read(self, conn, sqlCmd, params, timeout):
+        ''' read the query with the timeout, and log it if slow '''
+        t0 = time.perf_counter()
+        try:
+            with _statementTimeout(conn, timeout):
+                df = pd.read_sql(sql=sqlCmd, con=conn, params=params,
+                                 parse_dates=list(_dateColumns(conn.dialect.name, sqlCmd)))
+        except (exc.DBAPIError, pd.errors.DatabaseError) as e:
+            elapsed = time.perf_counter() - t0
+            if self._slowLog is not None and elapsed >= self._slowLog.threshold:
+                # pandas wraps the error of SQLAlchemy, which wraps the DBAPI one (e.g., QueryCanceled)
+                orig = getattr(e, 'orig', None) or getattr(e.__cause__, 'orig', None) or e
+                self._slowLog.record(conn, sqlCmd, params, elapsed, timeout=timeout, error=orig)
+            raise
+        elapsed = time.perf_counter() - t0
+        if self._slowLog is not None and elapsed >= self._slowLog.threshold:
+            self._slowLog.record(conn, sqlCmd, params, elapsed, rows=len(df), timeout=timeout)
         return df
 
+    def _queryShared(self, sqlCmd, params, cache, timeout=None):
+        ''' the query through the Arrow file cache shared by the processes (if enabled) '''
+        if self._arrowCache is None or not cache:
+            with self._connect() as conn:
+                df = self._read(conn, sqlCmd, params, timeout)
+            return df
+
+        from .cache import cacheKey, tablesIn
+        sqlKey = cacheKey(sqlCmd, params)
+        tableNames = tablesIn(sqlKey[0])
+        # the files do not expire, so only the queries on the versioned tables are cached
+        if len(tableNames) == 0 or models.qa_table_version.__tablename__ in tableNames \
+           or not self._hasTable(models.qa_table_version.__tablename__):
+            return self._queryShared(sqlCmd, params, False, timeout)
+        with self._connect() as conn:
+            # the versions are read before the query, so a result is never older than its key
+            key = self._arrowCache.key(sqlKey, _tableVersions(conn, tableNames))
+            table = self._arrowCache.get(key)
+            if table is None:
+                df = self._read(conn, sqlCmd, params, timeout)
+        if table is not None:
+            # numeric columns without nulls are not copied from the memory-mapped file
+            return table.to_pandas(split_blocks=True)
+        self._arrowCache.put(key, df)
+        return df
+
+    def cacheStats(self):
+        """Statistics of the query result caches
+
+        Returns
+        ----------
+            stats : see qadb.cache.QueryCache.stats, with the statistics of the
+                    Arrow file cache (qadb.arrowcache.ArrowCache.stats) in 'shared'
+        """
+        stats = {} if self._cache is None else self._cache.stats()
+        if self._arrowCache is not None:
+            stats['shared'] = self._arrowCache.stats()
+        return stats
+
+    def _stream(self, sqlCmd, chunksize, dates=None):
+        ''' (column names, rows) of each chunk, and the names of the columns to be converted
+        to datetimes put into dates (see _dateColumns) '''
+        with self._connect() as conn:
+            if dates is not None:
+                dates.update(_dateColumns(conn.dialect.name, sqlCmd))
+            conn = conn.execution_options(stream_results=True, max_row_buffer=chunksize)
+            if isinstance(sqlCmd, str):
+                result = conn.exec_driver_sql(sqlCmd)
+            else:
+                result = conn.execute(sqlCmd)
+            keys = list(result.keys())
+            for rows in result.partitions(chunksize):
+                yield keys, rows
+
+    def queryChunks(self, sqlCmd, chunksize=10000):
+        """Run the query with a server-side cursor and yield the results chunk by chunk
+
+        Only one chunk of rows is fetched from the server at a time, so the
+        memory usage is bounded by chunksize regardless of the result size.
+        The connection is held until the iteration ends.
+
+        Parameters
+        ----------
+            sqlCmd : SQL string or SQLAlchemy selectable
+            chunksize : the number of rows in each chunk
+
+        Yields
+        ----------
+            df : pandas.DataFrame with at most chunksize rows
+        """
+        dates = set()
+        for keys, rows in self._stream(sqlCmd, chunksize, dates):
+            df = pd.DataFrame.from_records(rows, columns=keys)
+            for k in dates.intersection(keys):
+                df[k] = pd.to_datetime(df[k])
+            yield df
+
+    def queryRecords(self, sqlCmd, chunksize=10000):
+        """Run the query with a server-side cursor and yield numpy record arrays
+
+        Same as queryChunks, but each chunk is converted column-wise into a
+        numpy record array without building a DataFrame. The datetime columns
+        are datetime64[us] (also on SQLite, as in query), and NULL values
+        become NaN (numeric columns) or NaT (datetime columns).
+
+        Parameters
+        ----------
+            sqlCmd : SQL string or SQLAlchemy selectable
+            chunksize : the number of rows in each chunk
+
+        Yields
+        ----------
+            rec : numpy.recarray with at most chunksize rows
+        """
+        dates = set()
+        for keys, rows in self._stream(sqlCmd, chunksize, dates):
+            columns = [np.array(col, dtype='datetime64[us]') if k in dates else _toArray(col)
+                       for k, col in zip(keys, zip(*rows))]
+            yield np.rec.fromarrays(columns, names=keys)
+
+    def per_arm(self, tableName, visits=None, chunksize=100000):
+        """Per-arm values of a table in long format, one row per (visit, arm)
+
+        The b/r/n/m columns (e.g., throughput_b_mean, ..., throughput_m_mean)
+        are unpivoted in the database by the {table}_per_arm view (see
+        qadb.models.per_arm_view_sql), and the rows are read column-wise into
+        numpy arrays without building a DataFrame. Each visit has a row for
+        every arm, in the order of pfs_visit_id and arm (b, m, n, r).
+
+        Parameters
+        ----------
+            tableName : 'throughput', 'noise', 'sky' or 'exposure_time'
+            visits : list of pfs_visit_id (default: all the visits)
+            chunksize : the number of rows fetched at a time
+
+        Returns
+        ----------
+            result : dict of numpy arrays, 'pfs_visit_id' (int32), 'arm' (<U1) and
+                     'mean', 'median', 'sigma', 'wavelength_ref' (float32), or
+                     'effective_exposure_time' for exposure_time; NULL values are NaN
+        """
+        if tableName not in models.PER_ARM_COLUMNS:
+            raise ValueError(f'{tableName} has no per-arm columns')
+        names = ['pfs_visit_id', 'arm'] + list(models.PER_ARM_COLUMNS[tableName])
+        dtypes = [np.int32, 'U1'] + [np.float32] * (len(names) - 2)
+        view = models.per_arm_view(tableName)
+        self._requireTables([view])
+        sqlCmd = f'SELECT {", ".join(names)} FROM {view}'
+        if visits is None:
+            batches = [sqlCmd + ' ORDER BY pfs_visit_id, arm']
+        else:
+            visits = sorted(set(int(v) for v in visits))
+            batches = [sqlCmd + f' WHERE pfs_visit_id IN ({", ".join(map(str, visits[i:i + 1000]))})'
+                       + ' ORDER BY pfs_visit_id, arm' for i in range(0, len(visits), 1000)]
+
+        chunks = {name: [] for name in names}
+        for sql in batches:
+            for keys, rows in self._stream(sql, chunksize):
+                for name, dtype, col in zip(names, dtypes, zip(*rows)):
+                    chunks[name].append(np.array(col, dtype=dtype))
+        return {name: np.concatenate(chunks[name]) if len(chunks[name]) > 0 else np.array([], dtype=dtype)
+                for name, dtype in zip(names, dtypes)}
+
+    def aggregate_agc(self, metric, start, end, bucket='10min', percentiles=(10, 90)):
+        """Time-bucketed statistics of an AGC metric computed in the database
+
+        The rows of seeing_agc_exposure / transparency_agc_exposure taken
+        before end are grouped into buckets aligned to the epoch, starting
+        from the bucket which contains start. The
+        count, mean, median and percentiles are computed with SQL aggregates
+        (PostgreSQL). When the table versions are maintained (table_versions),
+        buckets which are closed, i.e. followed by a later exposure, are
+        cached with the version of the table, so a repeated call with a later
+        end only recomputes the open bucket onwards, and a write by any
+        process drops only the buckets at or after the earliest taken_at it
+        wrote (see qa_table_change). The bucket which contains end is always
+        recomputed up to end.
+
+        Parameters
+        ----------
+            metric : column name (e.g., 'seeing_median', 'transparency_mean')
+                or 'table.column' (e.g., 'seeing_agc_exposure.wavelength_ref')
+            start, end : the time range of taken_at (datetime or str)
+            bucket : the bucket width as a timedelta/str (e.g., '10min') or seconds
+            percentiles : the percentiles (0-100) to be computed besides the median
+
+        Returns
+        ----------
+            result : dict of numpy arrays, 'bucket' (the bucket start in datetime64[s]),
+                     'count', 'mean', 'median' and 'p{q}' for each percentile
+        """
+        table, colName = _agcColumn(metric)
+        seconds = _bucketSeconds(bucket)
+        percentiles = tuple(percentiles)
+        start, end = pd.Timestamp(start), pd.Timestamp(end)
+        first = int(start.timestamp()) // seconds * seconds
+        # the bucket containing end, which is cut at end unless end is on its edge
+        last = int(end.timestamp()) // seconds * seconds
+        key = (table.name, colName, seconds, percentiles)
+
+        with self._connect() as conn:
+            self._requireTables([table.name], conn)
+            # the cached buckets are stamped with the version of the table, and those
+            # before the earliest taken_at written since are kept when it changes
+            version = None
+            if self.table_versions and self._hasTable(models.qa_table_version.__tablename__, conn):
+                version = _tableVersions(conn, [table.name])[table.name]
+            with self._statsLock:
+                entry = self._aggCache.get(key)
+            if entry is not None and entry['version'] != version:
+                entry = self._advanceAggregates(conn, table, seconds, entry, version)
+            with self._statsLock:
+                if entry is None or entry['from'] > first or entry['until'] < first:
+                    entry = {'from': first, 'until': first, 'rows': {}, 'version': version}
+                since = max(first, min(entry['until'], last))
+                cached = {b: r for b, r in entry['rows'].items() if b < since}
+            rows = []
+            if since < end.timestamp():
+                rows = _aggregateAgc(conn, table, colName, seconds,
+                                     pd.Timestamp(since, unit='s').to_pydatetime(),
+                                     end.to_pydatetime(), percentiles)
+        if version is not None:
+            # a bucket is closed when a later exposure exists, so all but the last one
+            with self._statsLock:
+                if len(rows) > 0:
+                    entry['rows'].update({r[0]: r[1:-1] for r in rows[:-1]})
+                    entry['until'] = max(entry['until'], rows[-1][0])
+                self._aggCache[key] = entry
+        cached.update({r[0]: r[1:-1] for r in rows})
+
+        buckets = sorted(b for b in cached if first <= b < end.timestamp())
+        values = np.array([cached[b] for b in buckets], dtype=float).reshape(len(buckets), -1)
+        result = {'bucket': np.array(buckets, dtype='datetime64[s]'),
+                  'count': values[:, 0].astype(np.int64),
+                  'mean': values[:, 1],
+                  'median': values[:, 2]}
+        for i, q in enumerate(percentiles):
+            result[f'p{q:g}'] = values[:, 3 + i]
+        return result
+
+    def rollup(self, metric, start=None, end=None, arm=None, period='night'):
+        """Nightly or monthly statistics of a per-visit metric from the rollup tables
+
+        Parameters
+        ----------
+            metric : 'seeing', 'transparency', 'throughput', 'sky_background' or 'noise'
+            start, end : the range of the nights/months (date or str, end is excluded)
+            arm : 'b', 'r', 'n' or 'm' for the metrics per arm (default: all the arms)
+            period : 'night' or 'month'
+
+        Returns
+        ----------
+            df : pandas.DataFrame with the period, arm, number_of_visits, mean, median
+                 and the percentiles (see qadb.models.qa_rollup_nightly)
+        """
+        tables = {'night': models.qa_rollup_nightly, 'month': models.qa_rollup_monthly}
+        if period not in tables:
+            raise ValueError(f'unknown period: {period}')
+        if metric not in set(m for m, _, _ in models.ROLLUP_METRICS):
+            raise ValueError(f'unknown rollup metric: {metric}')
+        table = tables[period]
+        self._requireTables([table.name])
+        sql = select(table).where(table.c.metric == metric)
+        if start is not None:
+            sql = sql.where(table.c[period] >= pd.Timestamp(start).date())
+        if end is not None:
+            sql = sql.where(table.c[period] < pd.Timestamp(end).date())
+        if arm is not None:
+            sql = sql.where(table.c.arm == arm)
+        return self.query(sql.order_by(table.c[period], table.c.arm))
+
+    def refreshRollup(self, nights=None, since=None, monthly=True):
+        """Recompute the nightly (and monthly) rollups
+
+        Parameters
+        ----------
+            nights : the nights to be recomputed (default: the nights changed
+                     since their rollup, see qadb.rollup.changedNights)
+            since : only the changed nights (and months) from this date
+            monthly : also recompute the months of the nights (default nights: the
+                      months whose nights changed since their rollup)
+
+        Returns
+        ----------
+            counts : dict with the number of 'nights' and 'months' recomputed
+        """
+        from . import rollup
+        with self._begin() as conn:
+            self._requireTables([models.visit_summary.name, models.qa_rollup_nightly.name,
+                                 models.qa_rollup_monthly.name], conn)
+            if nights is None:
+                counts = rollup.refreshChanged(conn, since=since, monthly=monthly)
+            else:
+                counts = rollup.refreshNights(conn, nights, monthly=monthly)
+        self._afterCommit(['qa_rollup_nightly', 'qa_rollup_monthly'])
+        return counts
+
+    def upsert(self, tableName, df):
+        """Insert or update all rows of a DataFrame in a single batch
+
+        The rows are sent as one ``INSERT ... ON CONFLICT (pk) DO UPDATE``
+        statement executed with executemany, where the conflict key is the
+        primary key of the table in ``models.Base.metadata``. The statement
+        is cached per (table, set of columns), and NaN values are sent as NULL.
+        The rows without the autoincrement primary key of a table (e.g.,
+        test.test_id) are inserted with the keys generated by the database.
+
+        Parameters
+        ----------
+            tableName : name of the table (e.g., 'seeing')
+            df : pandas.DataFrame with the columns to be written
+
+        Returns
+        ----------
+            counts : dict with the number of 'inserted' and 'updated' rows
+        """
+        table = _getTable(tableName)
+        touched = _Touched(table, df)
+        with self._begin() as conn:
+            counts = _upsert(conn, table, df)
+            written = self._afterWrite(conn, touched)
+        self._afterCommit(written, touched)
+        return counts
+
+    def update(self, tableName, df):
+        """Update the existing rows of the table, matched by primary key
+
+        The rows are sent with executemany through an ``UPDATE ... WHERE pk``
+        statement with bound parameters, so NULL and datetime values are passed
+        as they are. The statement is built from ``models.Base.metadata`` once
+        per (table, set of columns) and reused, which also works for composite
+        keys such as (run_id, spectrograph, arm). Rows which do not exist are
+        ignored (use upsert to insert them).
+
+        Parameters
+        ----------
+            tableName : name of the table (e.g., 'detector_map')
+            df : pandas.DataFrame with the primary key and the columns to be updated
+
+        Returns
+        ----------
+            nUpdated : the number of updated rows
+        """
+        table = _getTable(tableName)
+        touched = _Touched(table, df)
+        with self._begin() as conn:
+            nUpdated = _update(conn, table, df)
+            written = self._afterWrite(conn, touched)
+        self._afterCommit(written, touched)
+        return nUpdated
+
+    def bulk_insert(self, tableName, rows, batchsize=10000):
+        """Insert many new rows with executemany, without building a DataFrame or ORM objects
+
+        The rows are inserted by qadb.models.bulk_insert, and visit_summary
+        and the caches are maintained as by upsert. The rows should not exist
+        yet; use upsert to update existing rows.
+
+        Parameters
+        ----------
+            tableName : name of the table (e.g., 'seeing_agc_exposure')
+            rows : list of dicts, or a mapping of {column: array} such as a dict of
+                   numpy arrays or a DataFrame
+            batchsize : the number of rows per executemany
+
+        Returns
+        ----------
+            nrows : the number of inserted rows
+        """
+        table = _getTable(tableName)
+        keys = [k for k in ('pfs_visit_id', 'taken_at') if k in table.c]
+        if hasattr(rows, 'items'):
+            touched = _Touched(table, pd.DataFrame({k: rows[k] for k in keys if k in rows}))
+        else:
+            touched = _Touched(table, pd.DataFrame([{k: r[k] for k in keys if k in r} for r in rows]))
+        with self._begin() as conn:
+            nrows = models.bulk_insert(conn, table, rows, batchsize=batchsize)
+            written = self._afterWrite(conn, touched)
+        self._afterCommit(written, touched)
+        return nrows
+
+    def copy_into(self, tableName, df_or_iterator):
+        """Stream rows into the table with ``COPY FROM STDIN`` and merge them by primary key
+
+        Each DataFrame chunk is written to an in-memory CSV buffer, copied into
+        a temporary staging table and merged into the target with
+        ``INSERT ... ON CONFLICT (pk) DO UPDATE``, so only one chunk is held in
+        memory at a time. All the chunks are loaded in a single transaction.
+        On SQLite, which has no COPY, each chunk goes through the batched upsert.
+
+        Parameters
+        ----------
+            tableName : name of the table (e.g., 'seeing_agc_exposure')
+            df_or_iterator : pandas.DataFrame or an iterable of DataFrame chunks
+
+        Returns
+        ----------
+            counts : dict with the number of 'inserted' and 'updated' rows
+        """
+        table = _getTable(tableName)
+        chunks = _iterChunks(df_or_iterator)
+
+        counts = {'inserted': 0, 'updated': 0}
+        touched = _Touched(table)
+        if self._engine.dialect.name != 'postgresql':
+            with self._begin() as conn:
+                for df in chunks:
+                    for k, v in _upsert(conn, table, df).items():
+                        counts[k] += v
+                    touched.add(df)
+                written = self._afterWrite(conn, touched)
+            self._afterCommit(written, touched)
+            return counts
+
+        with self._connect() as conn:
+            pkeys = _conflictKeys(conn, table)
+        conn = self._rawConnection()
+        try:
+            cursor = conn.cursor()
+            _cursorExecute(cursor, _createStagingSQL(table), instrumentation=self.instrumentation)
+            for df in chunks:
+                if len(df) == 0:
+                    continue
+                for k, v in _copyChunk(cursor, table, df, pkeys, self.instrumentation).items():
+                    counts[k] += v
+                touched.add(df)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        with self._begin() as conn:
+            written = self._afterWrite(conn, touched)
+        self._afterCommit(written, touched)
+        return counts
+
+    def export(self, tables, path, format='parquet', partition_by='visit',
+               visits_per_partition=1000, chunksize=100000):
+        """Export the tables to partitioned Parquet files (see qadb.parquet.export)
+
+        Returns
+        ----------
+            nrows : dict of the number of exported rows for each table
+        """
+        from . import parquet
+        return parquet.export(self, tables, path, format=format, partition_by=partition_by,
+                              visits_per_partition=visits_per_partition, chunksize=chunksize)
+
+    def import_parquet(self, path, tableName=None, format='parquet', batch_size=100000):
+        """Load the files written by export into the table (see qadb.parquet.import_parquet)
+
+        Returns
+        ----------
+            counts : dict with the number of 'inserted' and 'updated' rows
+        """
+        from . import parquet
+        return parquet.import_parquet(self, path, tableName=tableName, format=format,
+                                      batch_size=batch_size)
+
+    def writer(self, max_rows=1000, max_delay=1.0, max_queue=10000, spool=None,
+               retry_interval=5.0, dead_letter=None):
+        """Write-behind ingest queue which writes through upsert in a background thread
+
+        See qadb.writer.QaWriter for the parameters.
+
+        Returns
+        ----------
+            writer : QaWriter
+        """
+        from .writer import QaWriter
+        return QaWriter(self, max_rows=max_rows, max_delay=max_delay, max_queue=max_queue,
+                        spool=spool, retry_interval=retry_interval, dead_letter=dead_letter)
+
     def populateQATable(self, tableName, df):
-        ''' FIXME (this is not a smart way...) '''
-        for idx, data in df.iterrows():
-            df_new = pd.DataFrame(
-                data={k: [v] for k, v in data.items()}
-                )
-            df_new = df_new.fillna(-1).astype(float)
-            try:
-                df_new.to_sql(tableName, self._engine, if_exists='append', index=False)
-            except exc.IntegrityError:
-                if 'pfs_visit_id' in data.keys():
-                    pfs_visit_id = int(data['pfs_visit_id'])
-                    keys = ''
-                    vals = ''
-                    for k, v in data.items():
-                        keys = keys + k + ','
-                        vals = vals + str(v) + ','
-                    if len(data) > 1:
-                        sqlCmd = text(f'UPDATE {tableName} SET ({keys[:-1]}) = ({vals[:-1]}) WHERE pfs_visit_id={pfs_visit_id};')
-                    else:
-                        sqlCmd = text(f'UPDATE {tableName} SET {keys[:-1]} = {vals[:-1]} WHERE pfs_visit_id={pfs_visit_id};')
-                    with self._engine.connect() as conn:
-                        conn.execute(sqlCmd)
-                        conn.commit()
-                    logger.info(f'pfs_visit_id={pfs_visit_id} updated!')
-                else:
-                    logger.info('No update...')
-                    pass
+        '''insert the rows into the table, updating the rows which already exist
+
+        The DataFrame is cast to the column types in qadb.models (Int32 for Integer,
+        float32 for REAL, datetime64 for DateTime, categorical for arm), keeping NULLs,
+        and the columns the table does not have are dropped.
+        '''
+        df_new = _convert(_getTable(tableName), df)
+        counts = self.upsert(tableName, df_new)
+        logger.info(f'{tableName}: {counts["inserted"]} inserted, {counts["updated"]} updated')
+        return counts
@@ -0,0 +1,518 @@
+#!/usr/bin/env python
+'''Rehearsal of alembic revisions against synthetic production-size data
+
+usage: qadb-migrate-rehearse postgresql://localhost/qadb_rehearse [--env qadb] [--revision head]
+                             [--from REV] [--schema-from URL] [--visits 100000] [--agc-per-visit 8]
+                             [--output report.json]
+
+The database of the url is created from scratch (it must be a disposable one!):
+
+    1. the database is created empty (qadb.provision), and the schema at the
+       starting revision (by default, the down_revision of --revision) is built
+       by upgrading it with the revisions of the environment. The first
+       revisions alter the tables made before alembic was introduced, so the
+       baseline is usually copied from --schema-from, a database of the
+       environment (e.g., a schema-only restore of production) at an earlier
+       revision: its tables are created from their reflection and stamped
+       with its revision before the upgrade
+    2. every table of the schema at that revision is filled with --visits visits
+       (and --agc-per-visit AGC exposures per visit), generated in the database
+    3. the revisions up to --revision are upgraded one by one and downgraded back,
+       with each SQL statement recorded
+
+For each statement the report has the wall time, the time spent waiting for
+locks, the relation locks it took, and whether it rewrote the table (a new
+relfilenode) with the sizes before and after; for each revision, how long the
+locks were held until its commit, and whether they block the writers. The
+lock and size figures need PostgreSQL; on SQLite only the times are recorded.
+'''
+
+import argparse
+import datetime
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+from alembic import command
+from alembic.config import Config
+from alembic.runtime.migration import MigrationContext
+from alembic.script import ScriptDirectory
+from logzero import logger
+from sqlalchemy import Boolean, Date, DateTime, Float, Integer, MetaData, String, create_engine, event, exc, text
+from sqlalchemy.engine import make_url
+
+from . import provision
+
+ENVIRONMENTS = ['qadb', 'qadb_e2e', 'qadb_e2e_2023oct']
+
+START = datetime.datetime(2024, 1, 1, 20, 0, 0)
+# seconds between visits
+CADENCE = 900
+
+# the lock modes which conflict with the RowExclusiveLock of INSERT/UPDATE, i.e. stop the ingest
+BLOCKING_MODES = ['ShareLock', 'ShareRowExclusiveLock', 'ExclusiveLock', 'AccessExclusiveLock']
+
+_TABLE = re.compile(r'\b(?:TABLE|ON|INTO|UPDATE|FROM)\s+(?:ONLY\s+)?(?:IF\s+(?:NOT\s+)?EXISTS\s+)?"?(\w+)"?',
+                    re.IGNORECASE)
+
+_LOCKS_SQL = ("SELECT c.relname, l.mode FROM pg_locks l JOIN pg_class c ON c.oid = l.relation "
+              "WHERE l.pid = pg_backend_pid() AND l.granted AND l.mode <> 'AccessShareLock' "
+              "AND c.relkind IN ('r', 'p', 'i', 'm') AND c.relnamespace <> 'pg_catalog'::regnamespace")
+_SIZE_SQL = ("SELECT pg_relation_filenode(c.oid), pg_total_relation_size(c.oid) FROM pg_class c "
+             "WHERE c.relname = %s AND c.relkind IN ('r', 'p') AND pg_table_is_visible(c.oid)")
+
+
+def defaultAlembicDir():
+    ''' alembic/ of the source tree (or of the current directory) '''
+    here = os.path.dirname(os.path.abspath(__file__))
+    for d in [os.path.join(here, '..', '..', 'alembic'), os.path.join(os.getcwd(), 'alembic')]:
+        if os.path.isdir(d):
+            return os.path.normpath(d)
+    return None
+
+
+def alembicConfig(alembicDir, env):
+    # no ini file, so that fileConfig in env.py does not replace the logging of the command
+    cfg = Config()
+    cfg.set_main_option('script_location', os.path.join(alembicDir, env, 'alembic'))
+    return cfg
+
+
+def revisionRange(script, start, end):
+    ''' the revisions after start up to end, oldest first '''
+    revisions = [r.revision for r in script.iterate_revisions(end, start)]
+    return [r for r in reversed(revisions) if r != start]
+
+
+def _copySchema(conn, cfg, schemaFrom):
+    ''' create the tables of the database schemaFrom in the empty database, stamped with its revision '''
+    source = create_engine(schemaFrom)
+    try:
+        metadata = MetaData()
+        metadata.reflect(bind=source)
+        with source.connect() as c:
+            stamp = MigrationContext.configure(c).get_current_revision()
+    finally:
+        source.dispose()
+    if 'alembic_version' in metadata.tables:
+        metadata.remove(metadata.tables['alembic_version'])
+    metadata.create_all(conn)
+    conn.commit()
+    if stamp is not None:
+        command.stamp(cfg, stamp)
+    return stamp
+
+
+def createStartSchema(conn, cfg, start, schemaFrom=None):
+    """Build the schema at the start revision in the empty database with the upgrades of the environment
+
+    Parameters
+    ----------
+        conn : connection to the empty database, which is given to env.py
+        cfg : alembic Config of the environment
+        start : the revision to be reached
+        schemaFrom : url of a database of the environment (of the same dialect) at
+                     or before start, whose tables are the baseline (default: none)
+
+    Returns
+    ----------
+        baseline : the revision of schemaFrom (None without it)
+    """
+    cfg.attributes['connection'] = conn
+    baseline = None
+    if schemaFrom is not None:
+        baseline = _copySchema(conn, cfg, schemaFrom)
+        logger.info(f'baseline copied from {make_url(schemaFrom).render_as_string()} at {baseline}')
+    try:
+        command.upgrade(cfg, start)
+    except (exc.DBAPIError, NotImplementedError) as e:
+        if schemaFrom is not None:
+            raise
+        raise ValueError(f'{start} cannot be reached from the empty database ({e}); the first revisions '
+                         'alter the tables made before alembic, so give a database of the '
+                         'environment as schema_from') from e
+    if conn.in_transaction():
+        conn.commit()
+    return baseline
+
+
+## Synthetic data ##
+
+def _keyExpressions(table, agcPerVisit):
+    '''SQL expressions of the primary key columns in the row number i, and the rows per parent
+
+    The keys are unique and refer to the rows of the parents, as in benchmarks/synthetic.py:
+    arm and spectrograph cycle, the own keys are i, and the foreign keys are i / (rows per parent).
+    '''
+    pkeys = list(table.primary_key.columns)
+    names = [c.name for c in pkeys]
+    keys = {}
+    per = 1
+    for name, n in [('arm', 4), ('spectrograph', 4)]:
+        if name in names:
+            index = f'(i / {per}) % {n}'
+            keys[name] = f"substr('brnm', {index} + 1, 1)" if name == 'arm' else f'{index} + 1'
+            per *= n
+    own = [c for c in pkeys if c.name not in keys and len(c.foreign_keys) == 0]
+    for c in own:
+        keys[c.name] = None
+    for c in pkeys:
+        if c.name in keys:
+            continue
+        if c.name == 'pfs_visit_id' and len(own) > 0:
+            per *= agcPerVisit
+        keys[c.name] = f'i / {per}'
+    hasParent = any(len(c.foreign_keys) > 0 for c in pkeys)
+    return keys, per if hasParent else 1
+
+
+def _valueExpression(column, dialect, nrows, visits):
+    ''' SQL expression of a column value in the row number i (None for NULL) '''
+    t = column.type
+    seconds = f'i * {CADENCE * visits / max(nrows, 1)}'
+    if len(column.foreign_keys) > 0:
+        return f'i % {visits}'
+    if isinstance(t, Boolean):
+        return '(i % 2 = 0)' if dialect == 'postgresql' else '(i % 2)'
+    if isinstance(t, Integer):
+        return '(i * 7919) % 1000'
+    if isinstance(t, Float):
+        return 'random()' if dialect == 'postgresql' else '(abs(random()) % 1000000) / 1000000.0'
+    if isinstance(t, DateTime):
+        if dialect == 'postgresql':
+            return f"TIMESTAMP '{START}' + ({seconds}) * INTERVAL '1 second'"
+        return f"datetime('{START}', '+' || ({seconds}) || ' seconds')"
+    if isinstance(t, Date):
+        if dialect == 'postgresql':
+            return f"DATE '{START.date()}' + i"
+        return f"date('{START.date()}', '+' || i || ' days')"
+    if isinstance(t, String):
+        value = f"'{column.name}-' || i"
+        return f'substr({value}, 1, {t.length})' if t.length else value
+    return None
+
+
+def populateSQL(table, dialect, visits, agcPerVisit):
+    ''' INSERT ... SELECT of the synthetic rows of the table, and the number of rows '''
+    keys, per = _keyExpressions(table, agcPerVisit)
+    nrows = visits * per
+    columns = []
+    values = []
+    for c in table.columns:
+        if keys.get(c.name) is not None:
+            expr = keys[c.name]
+        elif c.name in keys and isinstance(c.type, Integer):
+            # the own integer keys are the row number, the others (dates, strings) are unique in i too
+            expr = 'i'
+        else:
+            expr = _valueExpression(c, dialect, nrows, visits)
+        if expr is not None:
+            columns.append(c.name)
+            values.append(expr)
+    if dialect == 'postgresql':
+        source = f'generate_series(0, {nrows - 1}) AS g(i)'
+        prefix = ''
+    else:
+        prefix = f'WITH RECURSIVE g(i) AS (SELECT 0 UNION ALL SELECT i + 1 FROM g WHERE i < {nrows - 1}) '
+        source = 'g'
+    return (f'{prefix}INSERT INTO {table.name} ({", ".join(columns)}) '
+            f'SELECT {", ".join(values)} FROM {source}'), nrows
+
+
+def populate(conn, visits, agcPerVisit):
+    """Fill every table of the database with the synthetic rows
+
+    Returns
+    ----------
+        rows : dict of {tableName: the number of rows}
+    """
+    metadata = MetaData()
+    metadata.reflect(bind=conn)
+    rows = {}
+    for table in metadata.sorted_tables:
+        if table.name == 'alembic_version':
+            continue
+        sql, nrows = populateSQL(table, conn.dialect.name, visits, agcPerVisit)
+        t0 = time.perf_counter()
+        conn.execute(text(sql))
+        conn.commit()
+        rows[table.name] = nrows
+        logger.info(f'{table.name}: {nrows} rows ({time.perf_counter() - t0:.1f} s)')
+    if conn.dialect.name == 'postgresql':
+        conn.commit()
+        conn.execution_options(isolation_level='AUTOCOMMIT').exec_driver_sql('VACUUM ANALYZE')
+        conn.execution_options(isolation_level=conn.default_isolation_level)
+    return rows
+
+
+## Recording ##
+
+class Recorder(object):
+    """Records the SQL statements of a migration connection
+
+    Each statement gets 'seconds', 'lock_wait_seconds' (sampled from
+    pg_stat_activity by a second connection), 'locks' (the relation locks
+    held after it, other than AccessShareLock), 'rewrite' and 'size_before'/
+    'size_after' of its table. The locks are followed until they are released,
+    which is the commit of the revision unless the statement ran in an
+    autocommit_block, to get the time each of them was held.
+    """
+    def __init__(self, conn, url, interval=0.005):
+        self.conn = conn
+        self.postgres = conn.dialect.name == 'postgresql'
+        self.operations = []
+        self.steps = []
+        self.interval = interval
+        self._step = None
+        self._current = None
+        self._held = {}
+        self._holds = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._monitor = None
+        if self.postgres:
+            pid = conn.exec_driver_sql('SELECT pg_backend_pid()').scalar()
+            conn.commit()
+            self._monitor = threading.Thread(target=self._monitorLocks, args=(url, pid),
+                                             name='QaDBRehearseLocks', daemon=True)
+            self._monitor.start()
+        event.listen(conn, 'before_cursor_execute', self._before)
+        event.listen(conn, 'after_cursor_execute', self._after)
+
+    def close(self):
+        event.remove(self.conn, 'before_cursor_execute', self._before)
+        event.remove(self.conn, 'after_cursor_execute', self._after)
+        self._stopped.set()
+        if self._monitor is not None:
+            self._monitor.join()
+
+    def _monitorLocks(self, url, pid):
+        engine = create_engine(url, isolation_level='AUTOCOMMIT')
+        try:
+            with engine.connect() as conn:
+                sql = text('SELECT wait_event_type FROM pg_stat_activity WHERE pid = :pid')
+                last = time.perf_counter()
+                while not self._stopped.wait(self.interval):
+                    waiting = conn.execute(sql, {'pid': pid}).scalar() == 'Lock'
+                    now = time.perf_counter()
+                    with self._lock:
+                        if waiting and self._current is not None:
+                            self._current['lock_wait_seconds'] += now - last
+                    last = now
+        finally:
+            engine.dispose()
+
+    def _query(self, cursor, sql, params=()):
+        c = cursor.connection.cursor()
+        try:
+            c.execute(sql, params)
+            return c.fetchall()
+        finally:
+            c.close()
+
+    def _size(self, cursor, tableName):
+        if not self.postgres or not tableName:
+            return None, None
+        rows = self._query(cursor, _SIZE_SQL, (tableName, ))
+        return rows[0] if len(rows) > 0 else (None, None)
+
+    def _finish(self, error=None):
+        ''' close the statement which did not return (failed) '''
+        if self._current is not None:
+            self._current['error'] = error or 'failed'
+            self._current = None
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        if self._step is None:
+            return
+        self._finish()
+        match = _TABLE.search(statement)
+        tableName = match.group(1) if match is not None else ''
+        filenode, size = self._size(cursor, tableName)
+        op = {'revision': self._step['revision'], 'direction': self._step['direction'],
+              'statement': ' '.join(statement.split()), 'table': tableName,
+              'seconds': None, 'lock_wait_seconds': 0.0, 'locks': [], 'rewrite': None,
+              'size_before': size, 'size_after': None, 'error': None,
+              '_filenode': filenode, '_t0': time.perf_counter()}
+        with self._lock:
+            self._current = op
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        op = self._current
+        if op is None:
+            return
+        now = time.perf_counter()
+        op['seconds'] = now - op.pop('_t0')
+        with self._lock:
+            self._current = None
+        if self.postgres:
+            filenode, op['size_after'] = self._size(cursor, op['table'])
+            before = op.pop('_filenode')
+            op['rewrite'] = before is not None and filenode is not None and filenode != before
+            held = set(tuple(r) for r in self._query(cursor, _LOCKS_SQL))
+            op['locks'] = sorted(f'{mode} on {rel}' for rel, mode in held - set(self._held))
+            self._release(held, now)
+            for key in held:
+                # taken during the statement at the latest
+                self._held.setdefault(key, now - op['seconds'])
+        else:
+            op.pop('_filenode')
+        self.operations.append(op)
+
+    def _release(self, held, now):
+        for key in [k for k in self._held if k not in held]:
+            rel, mode = key
+            self._holds.append({'table': rel, 'mode': mode, 'seconds': now - self._held.pop(key),
+                                'blocks_writers': mode in BLOCKING_MODES})
+
+    def step(self, cfg, revision, direction, target):
+        ''' run one upgrade/downgrade to the target and record it '''
+        if self.conn.in_transaction():
+            self.conn.commit()
+        self._step = {'revision': revision, 'direction': direction}
+        self._held = {}
+        self._holds = []
+        t0 = time.perf_counter()
+        try:
+            cfg.attributes['connection'] = self.conn
+            (command.upgrade if direction == 'upgrade' else command.downgrade)(cfg, target)
+        except Exception as e:
+            self._finish(str(e))
+            raise
+        finally:
+            end = time.perf_counter()
+            self._release(set(), end)
+            holds = {}
+            for h in self._holds:
+                key = (h['table'], h['mode'])
+                if key not in holds or holds[key]['seconds'] < h['seconds']:
+                    holds[key] = h
+            self.steps.append(dict(self._step, seconds=end - t0,
+                                   locks=sorted(holds.values(), key=lambda h: -h['seconds'])))
+            self._step = None
+        if self.conn.in_transaction():
+            self.conn.commit()
+
+
+def rehearse(url, env='qadb', revision='head', start=None, visits=100000, agcPerVisit=8,
+             alembicDir=None, schemaFrom=None):
+    """Rehearse the upgrade to the revision and the downgrade back
+
+    Parameters
+    ----------
+        url : url of the disposable database, which is recreated
+        env : one of ENVIRONMENTS
+        revision : the revision to be rehearsed
+        start : the revision at which the data are populated (default: the down_revision of revision)
+        visits : the number of synthetic visits
+        agcPerVisit : the number of AGC exposures per visit
+        alembicDir : the directory of the alembic environments (default: defaultAlembicDir())
+        schemaFrom : url of a database of the environment whose schema is the baseline
+                     of the upgrades to start (see createStartSchema)
+
+    Returns
+    ----------
+        report : dict with 'meta', 'steps' (a revision each) and 'operations' (a statement each)
+    """
+    if env not in ENVIRONMENTS:
+        raise ValueError(f'env should be one of {ENVIRONMENTS}')
+    alembicDir = alembicDir or defaultAlembicDir()
+    if alembicDir is None:
+        raise ValueError('the alembic directory is not found; give alembicDir')
+    cfg = alembicConfig(alembicDir, env)
+    script = ScriptDirectory.from_config(cfg)
+    head = script.get_current_head()
+    revision = script.get_revision(revision).revision
+    if start is None:
+        down = script.get_revision(revision).down_revision
+        if isinstance(down, tuple):
+            raise ValueError(f'{revision} is a merge revision; give the start revision')
+        start = down or 'base'
+    steps = revisionRange(script, None if start == 'base' else start, revision)
+
+    logger.info(f'{env}: creating the schema at {start} in {make_url(url).render_as_string()}')
+    provision.create_database(url, replace=True)
+    engine = create_engine(url)
+    meta = {'env': env, 'revision': revision, 'start': start, 'head': head,
+            'visits': visits, 'agc_per_visit': agcPerVisit, 'dialect': engine.dialect.name,
+            'created_at': datetime.datetime.now().isoformat(timespec='seconds')}
+    recorder = None
+    try:
+        with engine.connect() as conn:
+            meta['baseline'] = createStartSchema(conn, cfg, start, schemaFrom)
+            t0 = time.perf_counter()
+            meta['rows'] = populate(conn, visits, agcPerVisit)
+            meta['populate_seconds'] = time.perf_counter() - t0
+            if engine.dialect.name == 'postgresql':
+                meta['server_version'] = conn.exec_driver_sql('SHOW server_version').scalar()
+                conn.commit()
+
+            recorder = Recorder(conn, url)
+            previous = start
+            for r in steps:
+                logger.info(f'upgrade {previous} -> {r}')
+                recorder.step(cfg, r, 'upgrade', r)
+                previous = r
+            for r in reversed(steps):
+                down = script.get_revision(r).down_revision or 'base'
+                logger.info(f'downgrade {r} -> {down}')
+                recorder.step(cfg, r, 'downgrade', down)
+    finally:
+        if recorder is not None:
+            recorder.close()
+        engine.dispose()
+    return {'meta': meta, 'steps': recorder.steps, 'operations': recorder.operations}
+
+
+def _mb(size):
+    return f'{size / 1024**2:9.1f}' if size is not None else f'{"-":>9s}'
+
+
+def printReport(report, file=sys.stderr):
+    for op in report['operations']:
+        if op['statement'].upper().startswith(('SELECT', 'PRAGMA')):
+            continue
+        print(f'{op["direction"]:<9s} {op["revision"]:<12s} {op["seconds"] or 0:9.3f} s  '
+              f'lock wait {op["lock_wait_seconds"]:7.3f} s  '
+              f'{"REWRITE" if op["rewrite"] else "       "} {_mb(op["size_before"])} -> {_mb(op["size_after"])} MB  '
+              f'{op["statement"][:80]}', file=file)
+    for step in report['steps']:
+        print(f'{step["direction"]:<9s} {step["revision"]:<12s} {step["seconds"]:9.3f} s', file=file)
+        for h in step['locks']:
+            print(f'    {h["mode"]:<24s} {h["table"]:<32s} held {h["seconds"]:8.3f} s'
+                  f'{"  (blocks writers)" if h["blocks_writers"] else ""}', file=file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='rehearse an alembic revision against synthetic data')
+    parser.add_argument('url', type=str, help='url of a disposable database, which is recreated')
+    parser.add_argument('--env', type=str, default='qadb', choices=ENVIRONMENTS)
+    parser.add_argument('--revision', type=str, default='head', help='the revision to be rehearsed')
+    parser.add_argument('--from', dest='start', type=str, default=None,
+                        help='the revision at which the data are populated (default: the down_revision)')
+    parser.add_argument('--visits', type=int, default=100000, help='the number of synthetic visits')
+    parser.add_argument('--agc-per-visit', type=int, default=8, help='AGC exposures per visit')
+    parser.add_argument('--alembic-dir', type=str, default=None,
+                        help='the directory of the alembic environments (default: alembic/ of the source tree)')
+    parser.add_argument('--schema-from', type=str, default=None,
+                        help='url of a database of the environment whose schema is the baseline of the upgrades')
+    parser.add_argument('--output', type=str, default=None, help='JSON report (default: stdout)')
+    args = parser.parse_args()
+
+    report = rehearse(args.url, env=args.env, revision=args.revision, start=args.start,
+                      visits=args.visits, agcPerVisit=args.agc_per_visit, alembicDir=args.alembic_dir,
+                      schemaFrom=args.schema_from)
+    printReport(report)
+    text = json.dumps(report, indent=2, default=str)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+'''Nightly and monthly rollups of the per-visit QA
+
+qa_rollup_nightly and qa_rollup_monthly hold the number of visits, mean,
+median and percentiles of models.ROLLUP_METRICS (seeing, transparency, and
+throughput, sky background and noise per arm) for each night and month, so
+that the long-term trends are read from a few rows per night instead of
+every visit. They are computed from visit_summary, and are maintained either
+by the ingest path (QaDB(refresh_rollup=True), which recomputes the nights
+touched by each write) or by the command
+
+    qadb-rollup postgresql://pfs@localhost/qadb [--since 2024-01-01] [--all]
+
+which recomputes only the nights with visit_summary rows refreshed after
+their rollup, and the months whose nights were recomputed after them.
+
+A night starts at noon in Hawaii (HST, UTC-10 without daylight saving time)
+and is labelled by that date. pfs_visit.issued_at (copied into
+visit_summary) is a naive timestamp in ISSUED_AT_TZ, the local time of the
+summit (HST) as written by Gen2; it is converted to HST explicitly before the
+noon boundary is applied, so set ISSUED_AT_TZ = datetime.timezone.utc (or
+--issued-at-tz UTC) for a database filled with UTC times.
+'''
+
+import argparse
+import datetime
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine, select, func, cast, or_, Date
+from logzero import logger
+
+from . import models
+from .qadb import _upsert, _bumpVersions
+
+NOON = datetime.timedelta(hours=12)
+
+# the time zone of the observatory, in which the nights start at noon
+HST = datetime.timezone(datetime.timedelta(hours=-10), 'HST')
+
+# the time zone of the naive issued_at values
+ISSUED_AT_TZ = HST
+
+TIME_ZONES = {'HST': HST, 'UTC': datetime.timezone.utc}
+
+
+def _nightShift():
+    ''' the time from the start of a night to midnight of its date, in the issued_at clock '''
+    return NOON + ISSUED_AT_TZ.utcoffset(None) - HST.utcoffset(None)
+
+
+def nightOf(issuedAt):
+    ''' the night of the time (naive in ISSUED_AT_TZ, or aware); a night starts at noon HST of its date '''
+    t = pd.Timestamp(issuedAt)
+    if t.tzinfo is None:
+        t = t.tz_localize(ISSUED_AT_TZ)
+    return (t.tz_convert(HST) - NOON).date()
+
+
+def nightStart(night):
+    ''' the start (noon HST) of the night as a naive time in ISSUED_AT_TZ, to compare with issued_at '''
+    return datetime.datetime.combine(_toDate(night), datetime.time()) + _nightShift()
+
+
+def _month(date):
+    return datetime.date(date.year, date.month, 1)
+
+
+def _nextMonth(month):
+    return datetime.date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def _toDate(value):
+    if isinstance(value, str):
+        return datetime.date.fromisoformat(value[:10])
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    return value
+
+
+def _nightExpr(conn, column):
+    shift = _nightShift()
+    if conn.dialect.name == 'postgresql':
+        return cast(column - shift, Date)
+    return func.date(column, f'-{int(shift.total_seconds())} seconds')
+
+
+def changedNights(conn, since=None):
+    """The nights whose visit_summary rows were refreshed after their rollup
+
+    Parameters
+    ----------
+        conn : SQLAlchemy connection
+        since : only the nights from this date (default: all the nights)
+
+    Returns
+    ----------
+        nights : sorted list of datetime.date
+    """
+    summary = models.visit_summary
+    rollup = models.qa_rollup_nightly
+    night = _nightExpr(conn, summary.c.issued_at).label('night')
+    sql = (select(night, func.max(summary.c.refreshed_at))
+           .where(summary.c.issued_at.isnot(None)).group_by(night))
+    done = select(rollup.c.night, func.min(rollup.c.refreshed_at)).group_by(rollup.c.night)
+    if since is not None:
+        since = pd.Timestamp(since).date()
+        sql = sql.where(summary.c.issued_at >= nightStart(since))
+        done = done.where(rollup.c.night >= since)
+    rolledUp = {_toDate(n): r for n, r in conn.execute(done)}
+    nights = []
+    for n, refreshedAt in conn.execute(sql):
+        n = _toDate(n)
+        if n not in rolledUp or (refreshedAt is not None and rolledUp[n] is not None
+                                 and refreshedAt > rolledUp[n]):
+            nights.append(n)
+    return sorted(nights)
+
+
+def changedMonths(conn, since=None):
+    """The months whose nightly rollups were recomputed after the monthly one
+
+    Returns
+    ----------
+        months : sorted list of datetime.date (the first day of the months)
+    """
+    nightly = models.qa_rollup_nightly
+    monthly = models.qa_rollup_monthly
+    sql = select(nightly.c.night, func.max(nightly.c.refreshed_at)).group_by(nightly.c.night)
+    done = select(monthly.c.month, func.min(monthly.c.refreshed_at)).group_by(monthly.c.month)
+    if since is not None:
+        since = pd.Timestamp(since).date()
+        sql = sql.where(nightly.c.night >= since)
+        done = done.where(monthly.c.month >= _month(since))
+    rolledUp = {_toDate(m): r for m, r in conn.execute(done)}
+    months = set()
+    for n, refreshedAt in conn.execute(sql):
+        month = _month(_toDate(n))
+        if month not in rolledUp or (refreshedAt is not None and rolledUp[month] is not None
+                                     and pd.Timestamp(refreshedAt) > pd.Timestamp(rolledUp[month])):
+            months.add(month)
+    return sorted(months)
+
+
+def _summaryRows(conn, ranges):
+    ''' the visit_summary rows of the nights in the [first, last] ranges of nights '''
+    summary = models.visit_summary
+    columns = [summary.c.issued_at, summary.c.refreshed_at] + \
+        [summary.c[col] for _, _, col in models.ROLLUP_METRICS]
+    cond = or_(*[(summary.c.issued_at >= nightStart(first))
+                 & (summary.c.issued_at < nightStart(last + datetime.timedelta(days=1)))
+                 for first, last in ranges])
+    df = pd.DataFrame(conn.execute(select(*columns).where(cond)).all(), columns=[c.name for c in columns])
+    df['night'] = [nightOf(t) for t in df['issued_at']]
+    return df
+
+
+def _statistics(period, value, df):
+    ''' the rollup rows of the metrics for the rows of a period '''
+    refreshedAt = pd.to_datetime(df['refreshed_at']).max() if len(df) > 0 else None
+    rows = []
+    for metric, arm, col in models.ROLLUP_METRICS:
+        values = pd.to_numeric(df[col], errors='coerce').to_numpy(dtype=float)
+        values = values[np.isfinite(values)]
+        row = {period: value, 'metric': metric, 'arm': arm, 'number_of_visits': len(values),
+               'mean': None, 'median': None, 'refreshed_at': refreshedAt}
+        row.update({f'p{p}': None for p in models.ROLLUP_PERCENTILES})
+        if len(values) > 0:
+            row['mean'] = values.mean()
+            row['median'] = np.median(values)
+            row.update({f'p{p}': v for p, v in
+                        zip(models.ROLLUP_PERCENTILES, np.percentile(values, models.ROLLUP_PERCENTILES))})
+        rows.append(row)
+    return rows
+
+
+def _ranges(nights):
+    ''' the sorted nights as [first, last] ranges of consecutive nights '''
+    ranges = []
+    for night in nights:
+        if len(ranges) > 0 and night - ranges[-1][1] == datetime.timedelta(days=1):
+            ranges[-1][1] = night
+        else:
+            ranges.append([night, night])
+    return ranges
+
+
+def _nightlyRows(df, nights):
+    groups = dict(list(df.groupby('night'))) if len(df) > 0 else {}
+    rows = []
+    for night in nights:
+        rows += _statistics('night', night, groups.get(night, df.iloc[:0]))
+    return rows
+
+
+def refreshNights(conn, nights, monthly=True, batchsize=100):
+    """Recompute the rollups of the nights, and of their months
+
+    Only the visit_summary rows of the nights are read, unless the months
+    are also recomputed, which reads the rows of the whole months.
+
+    Parameters
+    ----------
+        conn : SQLAlchemy connection (in a transaction)
+        nights : iterable of datetime.date
+        monthly : also recompute qa_rollup_monthly for the months of the nights
+        batchsize : the number of nights read at a time
+
+    Returns
+    ----------
+        counts : dict with the number of 'nights' and 'months' recomputed
+    """
+    nights = sorted(set(_toDate(n) for n in nights))
+    counts = {'nights': len(nights), 'months': 0}
+    if not monthly:
+        for i in range(0, len(nights), batchsize):
+            batch = nights[i:i + batchsize]
+            df = _summaryRows(conn, _ranges(batch))
+            _upsert(conn, models.qa_rollup_nightly, pd.DataFrame(_nightlyRows(df, batch)))
+        return counts
+
+    byMonth = {}
+    for night in nights:
+        byMonth.setdefault(_month(night), []).append(night)
+    for month, monthNights in sorted(byMonth.items()):
+        df = _monthRows(conn, month)
+        _upsert(conn, models.qa_rollup_nightly, pd.DataFrame(_nightlyRows(df, monthNights)))
+        _upsert(conn, models.qa_rollup_monthly, pd.DataFrame(_statistics('month', month, df)))
+        counts['months'] += 1
+    return counts
+
+
+def _monthRows(conn, month):
+    return _summaryRows(conn, [(month, _nextMonth(month) - datetime.timedelta(days=1))])
+
+
+def refreshMonths(conn, months):
+    """Recompute the monthly rollups of the months (the first days of the months)
+
+    Returns
+    ----------
+        counts : dict with the number of 'months' recomputed
+    """
+    months = sorted(set(_month(_toDate(m)) for m in months))
+    for month in months:
+        _upsert(conn, models.qa_rollup_monthly,
+                pd.DataFrame(_statistics('month', month, _monthRows(conn, month))))
+    return {'months': len(months)}
+
+
+def refreshVisits(conn, visits, monthly=False):
+    '''recompute the nightly rollups of the nights of the visits (used by the ingest path)
+
+    The monthly rollups, which need all the visits of the months, are left to
+    qadb-rollup (or QaDB.refreshRollup), which finds them with changedMonths.
+    '''
+    visit = models.Base.metadata.tables['pfs_visit']
+    visits = sorted(visits)
+    nights = set()
+    for i in range(0, len(visits), 500):
+        sql = select(visit.c.issued_at).where(visit.c.pfs_visit_id.in_(visits[i:i + 500]),
+                                              visit.c.issued_at.isnot(None))
+        nights |= set(nightOf(t) for (t, ) in conn.execute(sql))
+    if len(nights) == 0:
+        return {'nights': 0, 'months': 0}
+    return refreshNights(conn, nights, monthly=monthly)
+
+
+def refreshChanged(conn, since=None, monthly=True):
+    """Recompute the nights changed since their rollup, then the months changed since theirs
+
+    Returns
+    ----------
+        counts : dict with the number of 'nights' and 'months' recomputed
+    """
+    counts = refreshNights(conn, changedNights(conn, since=since), monthly=False)
+    if monthly:
+        counts.update(refreshMonths(conn, changedMonths(conn, since=since)))
+    return counts
+
+
+def main():
+    global ISSUED_AT_TZ
+    parser = argparse.ArgumentParser(description='recompute the nightly/monthly QA rollups which are out of date')
+    parser.add_argument('url', type=str, help='database url')
+    parser.add_argument('--since', type=str, default=None, help='only the nights from this date (YYYY-MM-DD)')
+    parser.add_argument('--all', action='store_true', help='recompute all the nights')
+    parser.add_argument('--no-monthly', action='store_true', help='do not recompute the monthly rollups')
+    parser.add_argument('--issued-at-tz', type=str, default='HST', choices=sorted(TIME_ZONES),
+                        help='the time zone of pfs_visit.issued_at')
+    args = parser.parse_args()
+    ISSUED_AT_TZ = TIME_ZONES[args.issued_at_tz]
+
+    engine = create_engine(args.url)
+    with engine.begin() as conn:
+        models.require_tables(conn, [models.visit_summary.name, models.qa_rollup_nightly.name,
+                                     models.qa_rollup_monthly.name])
+        if args.all:
+            summary = models.visit_summary
+            night = _nightExpr(conn, summary.c.issued_at)
+            sql = select(night).where(summary.c.issued_at.isnot(None)).distinct()
+            if args.since is not None:
+                sql = sql.where(summary.c.issued_at >= nightStart(args.since))
+            nights = sorted(_toDate(n) for (n, ) in conn.execute(sql))
+            counts = refreshNights(conn, nights, monthly=not args.no_monthly)
+        else:
+            counts = refreshChanged(conn, since=args.since, monthly=not args.no_monthly)
+    written = (['qa_rollup_nightly'] if counts['nights'] > 0 else []) + \
+        (['qa_rollup_monthly'] if counts['months'] > 0 else [])
+    if len(written) > 0:
+        # after the commit, so that the shared caches never take the old rows for the new version
+        with engine.begin() as conn:
+            _bumpVersions(conn, written)
+    engine.dispose()
+    logger.info(f'{counts["nights"]} nights and {counts["months"]} months recomputed')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+import datetime
+import json
+import threading
+
+from logzero import logger
+
+EXPLAINS = ('analyze', 'plan', None)
+
+
+def explainSQL(conn, sqlCmd, params=None, analyze=True):
+    """The EXPLAIN statement and its parameters of the query
+
+    PostgreSQL gives the plan as JSON, with the actual times and buffers
+    when analyze is True (the query is executed again); SQLite gives
+    EXPLAIN QUERY PLAN.
+    """
+    if isinstance(sqlCmd, str):
+        sql = sqlCmd
+    else:
+        compiled = sqlCmd.compile(dialect=conn.dialect)
+        sql = str(compiled)
+        values = dict(compiled.params, **(params or {}))
+        params = tuple(values[k] for k in compiled.positiontup) if compiled.positiontup else values
+    if conn.dialect.name == 'postgresql':
+        options = 'ANALYZE, BUFFERS, FORMAT JSON' if analyze else 'FORMAT JSON'
+        return f'EXPLAIN ({options}) {sql}', params
+    return f'EXPLAIN QUERY PLAN {sql}', params
+
+
+class SlowQueryLog(object):
+    """JSONL log of the queries slower than the threshold
+
+    Each line has 'logged_at', 'sql', 'params', 'duration' (sec.), 'rows',
+    'timeout', 'error' (e.g., the cancellation by statement_timeout) and
+    'plan'. The plan is captured with EXPLAIN (ANALYZE, BUFFERS) on
+    PostgreSQL, which runs the query once more, or with a plain EXPLAIN
+    when explain='plan' (and always for the failed queries).
+
+    Parameters
+    ----------
+        threshold : the duration (sec.) from which a query is logged
+        path : the JSONL file (default: only a warning in the log)
+        explain : 'analyze', 'plan' or None (no plan)
+    """
+    def __init__(self, threshold, path=None, explain='analyze'):
+        if explain not in EXPLAINS:
+            raise ValueError(f'explain should be one of {EXPLAINS}')
+        self.threshold = threshold
+        self.path = path
+        self.explain = explain
+        self._lock = threading.Lock()
+
+    def _plan(self, conn, sqlCmd, params, analyze, timeout):
+        from .qadb import _statementTimeout
+        try:
+            # the transaction of a failed query is aborted (PostgreSQL), and the one
+            # of the EXPLAIN is not kept open on the connection of the caller
+            conn.rollback()
+            sql, values = explainSQL(conn, sqlCmd, params, analyze=analyze)
+            with _statementTimeout(conn, timeout):
+                rows = conn.exec_driver_sql(sql, values).all()
+        except Exception as e:
+            return f'EXPLAIN failed: {e}'
+        finally:
+            conn.rollback()
+        if len(rows) == 1 and len(rows[0]) == 1:
+            return rows[0][0]
+        return [list(row) for row in rows]
+
+    def record(self, conn, sqlCmd, params, duration, rows=None, timeout=None, error=None):
+        """Log the query
+
+        Parameters
+        ----------
+            conn : the connection of the query, on which the EXPLAIN runs (another
+                   one could not be checked out from a pool exhausted by the caller)
+            sqlCmd, params : the query
+            duration : the duration (sec.)
+            rows : the number of rows returned
+            timeout : statement_timeout of the query (sec.)
+            error : the error of the query, if failed
+        """
+        logger.warning(f'slow query ({duration:.3f} s{", " + str(error) if error else ""}): '
+                       f'{" ".join(str(sqlCmd).split())[:200]}')
+        if self.path is None:
+            return
+        plan = None
+        if self.explain is not None:
+            analyze = self.explain == 'analyze' and error is None
+            plan = self._plan(conn, sqlCmd, params, analyze, timeout)
+        if not isinstance(sqlCmd, str):
+            # the values bound in the statement (e.g., select(...).where(...))
+            params = dict(sqlCmd.compile().params, **(params or {}))
+        entry = {'logged_at': datetime.datetime.now().isoformat(),
+                 'sql': str(sqlCmd),
+                 'params': params,
+                 'duration': duration,
+                 'rows': rows,
+                 'timeout': timeout,
+                 'error': None if error is None else str(error),
+                 'plan': plan}
+        line = json.dumps(entry, default=str)
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(line + '\n')
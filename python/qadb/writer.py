@@ -0,0 +1,461 @@
+#!/usr/bin/env python
+
+import datetime
+import json
+import queue
+import sqlite3
+import threading
+import time
+
+from sqlalchemy import DateTime, exc
+
+from . import models
+from ._lazy import LazyModule, LazyAttribute
+from .qadb import _getTable, _primaryKeys, _convert
+
+# imported on the first use, as in qadb.qadb
+pd = LazyModule('pandas')
+logger = LazyAttribute('logzero', 'logger')
+
+_FLUSH = 'flush'
+_STOP = 'stop'
+
+
+def _validate(tableName, df):
+    ''' the records cast to the column types of the table; ValueError if they cannot be written '''
+    table = _getTable(tableName)
+    _primaryKeys(table, df)
+    return _convert(table, df)
+
+
+def _sameColumns(records):
+    ''' the first records which have the same columns, e.g. to be written by one upsert '''
+    columns = set(records[0][1].columns)
+    n = 1
+    while n < len(records) and set(records[n][1].columns) == columns:
+        n += 1
+    return records[:n]
+
+
+def _isTransient(e):
+    ''' whether the write may succeed later (e.g., the database is down), rather than the records being bad '''
+    return isinstance(e, exc.DBAPIError) and not isinstance(e, (exc.IntegrityError, exc.DataError))
+
+
+def _parents(tableName):
+    ''' the tables referred to by the foreign keys of the table '''
+    return set(fk.column.table.name for fk in _getTable(tableName).foreign_keys) - {tableName}
+
+
+class _DeadLetter(object):
+    '''JSON Lines file of the records which failed to be written for a reason other than the database'''
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def append(self, tableName, df, error):
+        record = {'table_name': tableName,
+                  'failed_at': datetime.datetime.now().isoformat(),
+                  'error': f'{type(error).__name__}: {error}',
+                  'records': json.loads(df.to_json(orient='split', index=False,
+                                                   date_format='iso', date_unit='us'))}
+        with self._lock, open(self.path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+class _Spool(object):
+    '''Crash-safe local spool of the records which are not flushed yet (SQLite file)'''
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS spool '
+                           '(id INTEGER PRIMARY KEY AUTOINCREMENT, table_name TEXT, payload TEXT)')
+
+    def append(self, tableName, df):
+        payload = df.to_json(orient='split', index=False, date_format='iso', date_unit='us')
+        with self._lock:
+            cur = self._conn.execute('INSERT INTO spool (table_name, payload) VALUES (?, ?)',
+                                     (tableName, payload))
+        return cur.lastrowid
+
+    def delete(self, ids):
+        with self._lock:
+            self._conn.executemany('DELETE FROM spool WHERE id = ?', [(i, ) for i in ids])
+
+    def load(self):
+        ''' the spooled (id, tableName, DataFrame) in the order of arrival '''
+        with self._lock:
+            rows = self._conn.execute('SELECT id, table_name, payload FROM spool ORDER BY id').fetchall()
+        for spoolId, tableName, payload in rows:
+            data = json.loads(payload)
+            df = pd.DataFrame(data['data'], columns=data['columns'])
+            # an unknown table is rejected by the writer, as an unknown column
+            table = models.Base.metadata.tables.get(tableName)
+            for c in table.columns if table is not None else []:
+                if c.name in df.columns and isinstance(c.type, DateTime):
+                    df[c.name] = pd.to_datetime(df[c.name])
+            yield spoolId, tableName, df
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute('SELECT count(*) FROM spool').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class QaWriter(object):
+    """Write-behind ingest queue of QaDB
+
+    Records put into the writer are validated against the columns of the
+    table, coalesced per table in a background thread and written with
+    QaDB.upsert when a table has max_rows rows or its oldest record is older
+    than max_delay. put() blocks when max_queue records are waiting, so that a
+    slow database slows the producers down instead of growing the memory. With
+    a spool file, every record is also kept in a local SQLite file until it is
+    written to the database, and the records left by a crash are replayed
+    when the writer is created again.
+
+    A table whose write fails because of the database (e.g., the connection)
+    is retried after retry_interval, while the other tables go on. When a
+    batch fails for another reason (e.g., a constraint violation), its
+    records are written one by one, and the ones which still fail are moved
+    to the dead_letter file (or logged) and dropped from the spool.
+
+    Parameters
+    ----------
+        db : QaDB
+        max_rows : the number of rows of a table which triggers a flush
+        max_delay : the age (sec.) of the oldest record which triggers a flush
+        max_queue : the number of records which can wait to be written
+        spool : path to the spool file (default: no spool)
+        retry_interval : seconds to wait before retrying a failed flush
+        dead_letter : path to the JSON Lines file of the records which cannot be
+                      written (default: they are only logged)
+
+    Examples
+    ----------
+        with db.writer(spool='/tmp/qadb_spool.sqlite') as writer:
+            writer.put('seeing', {'pfs_visit_id': 123456, 'seeing_mean': 0.8})
+    """
+    def __init__(self, db, max_rows=1000, max_delay=1.0, max_queue=10000, spool=None,
+                 retry_interval=5.0, dead_letter=None):
+        self._db = db
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.max_queue = max_queue
+        self.retry_interval = retry_interval
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._pending = {}
+        self._pendingRows = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._stopAt = None
+        self._waiting = []
+        self._metrics = {'flushes': 0, 'rows_flushed': 0, 'last_flush_rows': 0,
+                         'flush_latency_last': 0.0, 'flush_latency_total': 0.0,
+                         'flush_latency_max': 0.0, 'errors': 0, 'replayed': 0, 'dead_letters': 0}
+
+        self._deadLetter = _DeadLetter(dead_letter) if dead_letter is not None else None
+        self._spool = _Spool(spool) if spool is not None else None
+        if self._spool is not None:
+            for spoolId, tableName, df in self._spool.load():
+                try:
+                    df = _validate(tableName, df)
+                except ValueError as e:
+                    self._reject(tableName, spoolId, df, e)
+                    continue
+                self._add(tableName, spoolId, df)
+                self._metrics['replayed'] += 1
+            if self._metrics['replayed'] > 0:
+                logger.info(f'{self._metrics["replayed"]} spooled records replayed')
+
+        self._thread = threading.Thread(target=self._run, name='QaWriter', daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def put(self, tableName, data, timeout=None):
+        """Queue a record (dict), a list of records or a DataFrame to be written to the table
+
+        The records are cast to the column types of the table first, and
+        ValueError is raised for an unknown table or column, a missing primary
+        key or a value which does not fit its column. Blocks while the queue
+        is full; raises queue.Full after timeout seconds.
+        """
+        if isinstance(data, pd.DataFrame):
+            df = data
+        elif isinstance(data, dict):
+            df = pd.DataFrame([data])
+        else:
+            df = pd.DataFrame(data)
+        df = _validate(tableName, df)
+        spoolId = self._spool.append(tableName, df) if self._spool is not None else None
+        self._queue.put((tableName, spoolId, df), timeout=timeout)
+
+    def flush(self, timeout=None):
+        """Write all the queued records now and wait until they are written (or the writer is closed)
+
+        Returns
+        ----------
+            done : False if the records are not written within timeout
+        """
+        done = threading.Event()
+        try:
+            self._queue.put((_FLUSH, None, done), timeout=timeout)
+        except queue.Full:
+            return False
+        return done.wait(timeout)
+
+    def close(self, timeout=60.0):
+        """Write the remaining records and stop the background thread
+
+        Parameters
+        ----------
+            timeout : the time (sec.) given to write the remaining records (None: no limit).
+                      The records not written by then are left in the spool, and replayed
+                      by the next writer on the same spool.
+        """
+        if self._thread.is_alive():
+            self._stopAt = None if timeout is None else time.monotonic() + timeout
+            self._stop.set()
+            try:
+                # only to wake the thread up; it also sees the stop while the queue is full
+                self._queue.put_nowait((_STOP, None, None))
+            except queue.Full:
+                pass
+            self._thread.join(timeout)
+        if self._thread.is_alive():
+            # still in a write to the database; the records are not lost as long as they are spooled
+            logger.error(f'the writer did not stop in {timeout} sec.; '
+                         f'{self._pendingRows + self._queue.qsize()} records are not written'
+                         + (f', and left in {self._spool.path}' if self._spool is not None else ''))
+            return
+        if self._spool is not None:
+            nLeft = self._spool.count()
+            if nLeft > 0:
+                logger.warning(f'{nLeft} records are left in {self._spool.path}')
+            self._spool.close()
+
+    def metrics(self):
+        """Statistics of the writer
+
+        Returns
+        ----------
+            metrics : dict with 'queue_depth', 'pending_rows', 'flushes', 'rows_flushed',
+                      'last_flush_rows', 'rows_per_flush', 'flush_latency_last',
+                      'flush_latency_mean', 'flush_latency_max' (sec.), 'errors',
+                      'dead_letters', 'replayed' and 'spooled' (while the writer is running)
+        """
+        with self._lock:
+            metrics = dict(self._metrics)
+            metrics['pending_rows'] = self._pendingRows
+        metrics['queue_depth'] = self._queue.qsize()
+        n = max(metrics['flushes'], 1)
+        metrics['rows_per_flush'] = metrics['rows_flushed'] / n
+        metrics['flush_latency_mean'] = metrics.pop('flush_latency_total') / n
+        if self._spool is not None and self._thread.is_alive():
+            metrics['spooled'] = self._spool.count()
+        return metrics
+
+    def _add(self, tableName, spoolId, df):
+        entry = self._pending.setdefault(tableName, {'since': time.monotonic(), 'retryAt': 0.0,
+                                                     'records': []})
+        entry['records'].append((spoolId, df))
+        with self._lock:
+            self._pendingRows += len(df)
+
+    def _due(self, force):
+        now = time.monotonic()
+        ready = set(tableName for tableName, entry in self._pending.items()
+                    if force or now >= entry['retryAt'])
+        due = set(tableName for tableName in ready
+                  if force or now - self._pending[tableName]['since'] >= self.max_delay
+                  or sum(len(df) for _, df in self._pending[tableName]['records']) >= self.max_rows)
+        # with the pending rows of the parent tables (e.g., pfs_visit), which are written first
+        for tableName in list(due):
+            due |= _parents(tableName) & ready
+        return due
+
+    def _reject(self, tableName, spoolId, df, error):
+        ''' move the records which cannot be written to the dead letter, out of the spool '''
+        if self._deadLetter is not None:
+            self._deadLetter.append(tableName, df, error)
+            logger.error(f'{len(df)} rows of {tableName} moved to {self._deadLetter.path}: {error}')
+        else:
+            logger.error(f'{len(df)} rows of {tableName} dropped: {error}\n{df.to_string()}')
+        if spoolId is not None:
+            self._spool.delete([spoolId])
+        with self._lock:
+            self._metrics['dead_letters'] += 1
+
+    def _written(self, tableName, records, elapsed):
+        nrows = sum(len(df) for _, df in records)
+        if self._spool is not None:
+            self._spool.delete([i for i, _ in records if i is not None])
+        with self._lock:
+            self._pendingRows -= nrows
+            self._metrics['flushes'] += 1
+            self._metrics['rows_flushed'] += nrows
+            self._metrics['last_flush_rows'] = nrows
+            self._metrics['flush_latency_last'] = elapsed
+            self._metrics['flush_latency_total'] += elapsed
+            self._metrics['flush_latency_max'] = max(self._metrics['flush_latency_max'], elapsed)
+
+    def _failed(self, tableName, entry, nrows, error):
+        logger.error(f'failed to write {nrows} rows to {tableName}, retrying in {self.retry_interval} sec.: {error}')
+        with self._lock:
+            self._metrics['errors'] += 1
+        if self._db.instrumentation is not None:
+            self._db.instrumentation.count('retries', component='writer', table=tableName)
+        entry['retryAt'] = time.monotonic() + self.retry_interval
+
+    def _write(self, tableName, entry):
+        '''write the pending records of the table
+
+        The records are written in the order of the puts, each run of records
+        with the same columns as one upsert, so that a record only writes the
+        columns which were given with it.
+
+        Returns
+        ----------
+            done : False if the table is to be retried later
+        '''
+        records = entry['records']
+        while len(records) > 0:
+            batch = _sameColumns(records)
+            df = pd.concat([df for _, df in batch], ignore_index=True)
+            t0 = time.perf_counter()
+            try:
+                self._db.upsert(tableName, df)
+            except Exception as e:
+                if _isTransient(e):
+                    self._failed(tableName, entry, len(df), e)
+                    return False
+                logger.warning(f'failed to write {len(df)} rows to {tableName}, '
+                               f'writing the {len(batch)} records one by one: {e}')
+                if not self._writeEach(tableName, entry, len(batch)):
+                    return False
+            else:
+                self._written(tableName, batch, time.perf_counter() - t0)
+                del records[:len(batch)]
+        return True
+
+    def _writeEach(self, tableName, entry, n):
+        ''' write the first n records one by one, to find the ones which fail on their own '''
+        records = entry['records']
+        for _ in range(n):
+            spoolId, df = records[0]
+            t0 = time.perf_counter()
+            try:
+                self._db.upsert(tableName, df)
+            except Exception as e:
+                if _isTransient(e):
+                    self._failed(tableName, entry, len(df), e)
+                    return False
+                self._reject(tableName, spoolId, df, e)
+                with self._lock:
+                    self._pendingRows -= len(df)
+            else:
+                self._written(tableName, [records[0]], time.perf_counter() - t0)
+            records.pop(0)
+        return True
+
+    def _flush(self, tableNames):
+        '''write the pending records of the tables, each table on its own
+
+        Returns
+        ----------
+            done : False if some of the tables are to be retried later
+        '''
+        # parent tables (e.g., pfs_visit) are written before the tables referring to them
+        order = [t.name for t in models.Base.metadata.sorted_tables]
+        done = True
+        for tableName in sorted(tableNames, key=order.index):
+            entry = self._pending[tableName]
+            parents = [self._pending[t] for t in _parents(tableName) if t in self._pending]
+            if len(parents) > 0:
+                # the rows referred to are not written yet
+                entry['retryAt'] = max(p['retryAt'] for p in parents)
+                done = False
+            elif self._write(tableName, entry):
+                del self._pending[tableName]
+            else:
+                done = False
+        return done
+
+    def _stopping(self):
+        ''' take all the queued records, and whether to give up the records not written yet '''
+        while True:
+            try:
+                tableName, spoolId, payload = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if tableName == _FLUSH:
+                self._waiting.append(payload)
+            elif tableName != _STOP:
+                self._add(tableName, spoolId, payload)
+        if len(self._pending) == 0:
+            return True
+        if self._stopAt is not None and time.monotonic() >= self._stopAt:
+            logger.error(f'{self._pendingRows} rows are not written'
+                         + (f' and left in {self._spool.path}' if self._spool is not None else ''))
+            return True
+        return False
+
+    def _run(self):
+        while True:
+            if self._stop.is_set():
+                if self._stopping():
+                    break
+                if self._flush(self._due(True)):
+                    continue
+                wait = min(entry['retryAt'] for entry in self._pending.values()) - time.monotonic()
+                if self._stopAt is not None:
+                    wait = min(wait, self._stopAt - time.monotonic())
+                time.sleep(min(max(wait, 0.01), self.retry_interval))
+                continue
+
+            timeout = self.max_delay
+            if len(self._pending) > 0:
+                deadline = min(max(entry['since'] + self.max_delay, entry['retryAt'])
+                               for entry in self._pending.values())
+                timeout = min(max(deadline - time.monotonic(), 0.01), self.max_delay)
+            item = None
+            # stop taking records while the database is behind (backpressure on put)
+            if self._pendingRows < self.max_queue:
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    pass
+            else:
+                time.sleep(timeout)
+
+            force = False
+            if item is not None:
+                tableName, spoolId, payload = item
+                if tableName == _FLUSH:
+                    self._waiting.append(payload)
+                    force = True
+                elif tableName != _STOP:
+                    self._add(tableName, spoolId, payload)
+
+            if len(self._pending) > 0:
+                self._flush(self._due(force))
+            if len(self._waiting) > 0 and len(self._pending) == 0:
+                self._notify()
+        self._notify()
+
+    def _notify(self):
+        ''' wake up the callers of flush() '''
+        for done in self._waiting:
+            done.set()
+        self._waiting = []
@@ -22,6 +22,14 @@ def main():
           license='',
           package_dir={'': 'python'},
           packages=['qadb'],
+          entry_points={
+              'console_scripts': [
+                  'qadb-backfill = qadb.backfill:main',
+                  'qadb-rollup = qadb.rollup:main',
+                  'qadb-provision = qadb.provision:main',
+                  'qadb-migrate-rehearse = qadb.rehearse:main',
+              ],
+          },
           extras_require={
               'dev': [
                   'numpy',
@@ -31,6 +39,14 @@ def main():
                   'alembic',
                   'pylint',
               ],
+              'async': [
+                  'sqlalchemy[asyncio]',
+                  'asyncpg',
+                  'aiosqlite',
+              ],
+              'arrow': [
+                  'pyarrow',
+              ],
           },
           )
 
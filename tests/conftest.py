@@ -0,0 +1,27 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'python'))
+
+from qadb import provision  # noqa: E402
+from qadb.qadb import QaDB  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def templateDir(tmp_path_factory):
+    return str(tmp_path_factory.mktemp('templates'))
+
+
+@pytest.fixture
+def url(tmp_path, templateDir):
+    ''' an empty SQLite database with the schema of qadb.models '''
+    return provision.clone_database(f'sqlite:///{tmp_path / "qadb.sqlite"}', cache_dir=templateDir)
+
+
+@pytest.fixture
+def db(url):
+    qadb = QaDB(url)
+    yield qadb
+    qadb.close()
@@ -0,0 +1,81 @@
+import pandas as pd
+
+from qadb import qadb
+from qadb.qadb import QaDB
+
+
+def agc(ids, times, values):
+    return pd.DataFrame({'pfs_visit_id': [1] * len(ids), 'agc_exposure_id': ids,
+                         'seeing_median': values, 'taken_at': pd.to_datetime(times)})
+
+
+def testEndInsideCachedBucket(url):
+    db = QaDB(url, table_versions=True)
+    db.upsert('seeing_agc_exposure', agc([1, 2, 3], ['2024-01-01 00:01', '2024-01-01 00:05',
+                                                     '2024-01-01 00:12'], [1.0, 2.0, 3.0]))
+    result = db.aggregate_agc('seeing_median', '2024-01-01 00:00', '2024-01-01 00:20')
+    assert result['count'].tolist() == [2, 1]
+    assert len(db._aggCache) == 1
+    # the first bucket is cached, but only the rows before end are counted
+    result = db.aggregate_agc('seeing_median', '2024-01-01 00:00', '2024-01-01 00:03')
+    assert result['count'].tolist() == [1]
+    assert result['mean'].tolist() == [1.0]
+    result = db.aggregate_agc('seeing_median', '2024-01-01 00:00', '2024-01-01 00:20')
+    assert result['count'].tolist() == [2, 1]
+    db.close()
+
+
+def testLateRowsFromOtherWriter(url):
+    reader = QaDB(url, table_versions=True)
+    writer = QaDB(url, table_versions=True)
+    writer.upsert('seeing_agc_exposure', agc([1, 2], ['2024-01-01 00:01', '2024-01-01 00:12'], [1.0, 3.0]))
+    assert reader.aggregate_agc('seeing_median', '2024-01-01', '2024-01-01 00:20')['count'].tolist() == [1, 1]
+    writer.upsert('seeing_agc_exposure', agc([3], ['2024-01-01 00:02'], [2.0]))
+    result = reader.aggregate_agc('seeing_median', '2024-01-01', '2024-01-01 00:20')
+    assert result['count'].tolist() == [2, 1]
+    assert result['mean'].tolist() == [1.5, 3.0]
+    reader.close()
+    writer.close()
+
+
+def testWithoutVersions(url):
+    reader = QaDB(url, table_versions=False)
+    writer = QaDB(url, table_versions=False)
+    writer.upsert('seeing_agc_exposure', agc([1, 2], ['2024-01-01 00:01', '2024-01-01 00:12'], [1.0, 3.0]))
+    assert reader.aggregate_agc('seeing_median', '2024-01-01', '2024-01-01 00:20')['count'].tolist() == [1, 1]
+    writer.upsert('seeing_agc_exposure', agc([3], ['2024-01-01 00:02'], [2.0]))
+    assert reader.aggregate_agc('seeing_median', '2024-01-01', '2024-01-01 00:20')['count'].tolist() == [2, 1]
+    reader.close()
+    writer.close()
+
+
+def testLateRowsKeepEarlierBuckets(url, monkeypatch):
+    reader = QaDB(url)
+    writer = QaDB(url)
+    writer.upsert('seeing_agc_exposure', agc([1, 2, 3], ['2024-01-01 00:01', '2024-01-01 00:12',
+                                                         '2024-01-01 00:25'], [1.0, 3.0, 5.0]))
+    assert reader.aggregate_agc('seeing_median', '2024-01-01', '2024-01-01 00:30')['count'].tolist() == [1, 1, 1]
+
+    starts = []
+
+    def aggregateAgc(conn, table, colName, seconds, start, *args):
+        starts.append(start)
+        return aggregate(conn, table, colName, seconds, start, *args)
+
+    aggregate = qadb._aggregateAgc
+    monkeypatch.setattr(qadb, '_aggregateAgc', aggregateAgc)
+    writer.upsert('seeing_agc_exposure', agc([4], ['2024-01-01 00:15'], [4.0]))
+    result = reader.aggregate_agc('seeing_median', '2024-01-01', '2024-01-01 00:30')
+    assert result['count'].tolist() == [1, 2, 1]
+    assert result['mean'].tolist() == [1.0, 3.5, 5.0]
+    # the bucket before the earliest taken_at written is still cached
+    assert starts == [pd.Timestamp('2024-01-01 00:10').to_pydatetime()]
+
+    # a write without taken_at may change any bucket
+    writer.update('seeing_agc_exposure', pd.DataFrame({'pfs_visit_id': [1], 'agc_exposure_id': [1],
+                                                       'seeing_median': [2.0]}))
+    result = reader.aggregate_agc('seeing_median', '2024-01-01', '2024-01-01 00:30')
+    assert result['mean'].tolist() == [2.0, 3.5, 5.0]
+    assert starts[-1] == pd.Timestamp('2024-01-01 00:00').to_pydatetime()
+    reader.close()
+    writer.close()
@@ -0,0 +1,53 @@
+import asyncio
+
+import pandas as pd
+
+from qadb.asyncqadb import AsyncQaDB
+
+
+def asyncUrl(url):
+    return url.replace('sqlite://', 'sqlite+aiosqlite://', 1)
+
+
+def visits(ids):
+    return pd.DataFrame({'pfs_visit_id': ids, 'pfs_design_id': [10 * i for i in ids]})
+
+
+def seeing(visit, value):
+    return pd.DataFrame({'pfs_visit_id': [visit], 'seeing_mean': [value]})
+
+
+def testConcurrentWrites(db, url):
+    async def run():
+        adb = AsyncQaDB(asyncUrl(url), pool_size=1, max_overflow=0)
+        try:
+            assert await adb.upsert('pfs_visit', visits([1, 2, 3])) == {'inserted': 3, 'updated': 0}
+            counts = await asyncio.gather(*[adb.upsert('seeing', seeing(v, 0.1 * v)) for v in [1, 2, 3]])
+            assert counts == [{'inserted': 1, 'updated': 0}] * 3
+            assert await adb.update('seeing', seeing(2, 0.5)) == 1
+            return await adb.query('SELECT pfs_visit_id, seeing_mean FROM seeing ORDER BY pfs_visit_id')
+        finally:
+            await adb.close()
+
+    df = asyncio.run(run())
+    assert df['pfs_visit_id'].tolist() == [1, 2, 3]
+    assert df['seeing_mean'].round(3).tolist() == [0.1, 0.5, 0.3]
+    # the same rows through the sync client, with visit_summary refreshed by the writes
+    summary = db.query('SELECT pfs_visit_id, seeing_mean FROM visit_summary ORDER BY pfs_visit_id', cache=False)
+    assert summary['seeing_mean'].round(3).tolist() == [0.1, 0.5, 0.3]
+    versions = dict(db.query('SELECT table_name, version FROM qa_table_version', cache=False).values.tolist())
+    assert versions['seeing'] == 4
+
+
+def testCopyInto(db, url):
+    async def run():
+        adb = AsyncQaDB(asyncUrl(url))
+        try:
+            # on SQLite each chunk goes through the batched upsert
+            return await adb.copy_into('pfs_visit', iter([visits([1, 2]), visits([2, 3])]))
+        finally:
+            await adb.close()
+
+    assert asyncio.run(run()) == {'inserted': 3, 'updated': 1}
+    assert db.query('SELECT pfs_visit_id FROM pfs_visit ORDER BY pfs_visit_id',
+                    cache=False)['pfs_visit_id'].tolist() == [1, 2, 3]
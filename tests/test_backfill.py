@@ -0,0 +1,49 @@
+import os
+
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine, text
+
+from qadb import backfill
+
+
+def source(start, end):
+    ''' the pfs_visit rows of the shard, failing on visit 150 if BACKFILL_FAIL is set '''
+    if os.environ.get('BACKFILL_FAIL') and start <= 150 < end:
+        raise RuntimeError('visit 150 is not ready')
+    ids = list(range(start, end))
+    return {'pfs_visit': pd.DataFrame({'pfs_visit_id': ids, 'pfs_design_id': ids})}
+
+
+def testCovered():
+    finished = [(0, 100), (100, 150), (200, 300)]
+    assert backfill.covered(finished, 0, 150)
+    assert backfill.covered(finished, 50, 120)
+    assert not backfill.covered(finished, 100, 200)
+    assert not backfill.covered(finished, 0, 300)
+    assert backfill.covered(finished, 250, 300)
+
+
+def testResumeWithAnotherShardSize(db, url, monkeypatch):
+    monkeypatch.setenv('BACKFILL_FAIL', '1')
+    summary = backfill.backfill(url, 0, 300, 'test_backfill:source', job='job', shard_size=100,
+                                retries=0, retry_wait=0)
+    assert (summary['shards'], summary['skipped'], summary['failed']) == (3, 0, 1)
+
+    monkeypatch.delenv('BACKFILL_FAIL')
+    # (0, 200) is not covered by the finished shards, (200, 300) is
+    summary = backfill.backfill(url, 0, 300, 'test_backfill:source', job='job', shard_size=200,
+                                retries=0, retry_wait=0)
+    assert (summary['shards'], summary['skipped'], summary['failed']) == (1, 1, 0)
+    assert summary['visits'] == 200
+    assert db.query('SELECT count(*) AS n FROM pfs_visit', cache=False)['n'][0] == 300
+    assert backfill.finishedShards(db, 'job') == [(0, 200), (200, 300)]
+
+
+def testQadbOnly(url):
+    engine = create_engine(url)
+    with engine.begin() as conn:
+        conn.execute(text('DROP TABLE backfill_progress'))
+    engine.dispose()
+    with pytest.raises(ValueError, match='backfill_progress.*alembic/qadb'):
+        backfill.backfill(url, 0, 100, 'test_backfill:source')
@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+
+from qadb import models
+from qadb.qadb import QaDB
+
+
+def testRowsNormalized():
+    rows = [{'pfs_visit_id': 1, 'seeing_mean': 0.5}, {'pfs_visit_id': 2, 'seeing_sigma': float('nan')}]
+    (batch, ) = list(models.bulk_rows(models.seeing, rows))
+    assert batch == [{'pfs_visit_id': 1, 'seeing_mean': 0.5, 'seeing_sigma': None},
+                     {'pfs_visit_id': 2, 'seeing_mean': None, 'seeing_sigma': None}]
+
+
+def testColumnsNullsAsNone():
+    df = pd.DataFrame({'pfs_visit_id': [1, 2], 'agc_exposure_id': [1, 2],
+                       'seeing_median': [np.nan, 0.5],
+                       'taken_at': pd.to_datetime(['2024-01-01 00:00', None])})
+    (batch, ) = list(models.bulk_rows(models.seeing_agc_exposure, df))
+    assert batch[0]['seeing_median'] is None
+    assert batch[1]['taken_at'] is None
+    assert batch[0]['taken_at'] == pd.Timestamp('2024-01-01')
+
+
+def testBulkInsert(url):
+    db = QaDB(url, cache_bytes=1024**2)
+    db.upsert('pfs_visit', pd.DataFrame({'pfs_visit_id': [1, 2]}))
+    sql = 'SELECT pfs_visit_id, seeing_median FROM visit_summary ORDER BY pfs_visit_id'
+    assert db.query(sql)['seeing_median'].isna().all()
+    n = db.bulk_insert('seeing_agc_exposure', {'pfs_visit_id': np.array([1, 1, 2]),
+                                               'agc_exposure_id': np.array([1, 2, 3]),
+                                               'seeing_median': np.array([0.5, np.nan, 0.7])})
+    assert n == 3
+    df = db.query('SELECT seeing_median FROM seeing_agc_exposure ORDER BY agc_exposure_id')
+    assert df['seeing_median'].isna().tolist() == [False, True, False]
+    db.bulk_insert('seeing', [{'pfs_visit_id': 1, 'seeing_median': 0.5}, {'pfs_visit_id': 2}])
+    # visit_summary is refreshed, and the cached result is not served
+    assert db.query(sql)['seeing_median'].tolist()[0] == 0.5
+    db.close()
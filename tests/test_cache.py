@@ -0,0 +1,82 @@
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine, text
+
+from qadb.qadb import QaDB
+
+SQL = 'SELECT pfs_visit_id, seeing_mean FROM seeing ORDER BY pfs_visit_id'
+
+
+def seeing(visits, value):
+    return pd.DataFrame({'pfs_visit_id': visits, 'seeing_mean': [value] * len(visits)})
+
+
+def versions(url):
+    engine = create_engine(url)
+    with engine.connect() as conn:
+        rows = dict(conn.execute(text('SELECT table_name, version FROM qa_table_version')).all())
+    engine.dispose()
+    return rows
+
+
+def testQueryCache(url):
+    db = QaDB(url, cache_bytes=1024**2)
+    db.upsert('seeing', seeing([1], 0.5))
+    assert db.query(SQL)['seeing_mean'].tolist() == [0.5]
+    db.upsert('seeing', seeing([1, 2], 0.7))
+    assert db.query(SQL)['seeing_mean'].tolist() == pytest.approx([0.7, 0.7])
+    assert db.cacheStats()['invalidations'] == 1
+    db.close()
+
+
+def testFailedWrite(url):
+    db = QaDB(url, cache_bytes=1024**2)
+    db.upsert('seeing', seeing([1], 0.5))
+    db.query(SQL)
+    with pytest.raises(ValueError):
+        db.upsert('seeing', pd.DataFrame({'pfs_visit_id': [2], 'unknown': [1]}))
+    db.query(SQL)
+    assert db.cacheStats()['hits'] == 1
+    db.close()
+
+
+def testVersionsByDefault(url):
+    db = QaDB(url)
+    db.upsert('seeing', seeing([1], 0.5))
+    db.close()
+    assert versions(url) == {'seeing': 1, 'visit_summary': 1}
+    db = QaDB(url, table_versions=False)
+    db.upsert('seeing', seeing([1], 0.6))
+    db.close()
+    assert versions(url) == {'seeing': 1, 'visit_summary': 1}
+
+
+def testSharedCache(url, tmp_path):
+    pytest.importorskip('pyarrow')
+    reader = QaDB(url, cache_dir=str(tmp_path / 'cache'))
+    # a plain writer, as in the pipelines
+    writer = QaDB(url)
+    writer.upsert('seeing', seeing([1], 0.5))
+    assert reader.query(SQL)['seeing_mean'].tolist() == [0.5]
+    assert reader.query(SQL)['seeing_mean'].tolist() == [0.5]
+    assert reader.cacheStats()['shared']['hits'] == 1
+    # written by the other instance (process), seen through qa_table_version
+    writer.upsert('seeing', seeing([2], 0.6))
+    assert reader.query(SQL)['pfs_visit_id'].tolist() == [1, 2]
+    assert versions(url) == {'seeing': 2, 'visit_summary': 2}
+    reader.close()
+    writer.close()
+
+
+def testSharedCacheWithoutVersionTable(url, tmp_path):
+    pytest.importorskip('pyarrow')
+    engine = create_engine(url)
+    with engine.begin() as conn:
+        conn.execute(text('DROP TABLE qa_table_version'))
+    engine.dispose()
+    db = QaDB(url, cache_dir=str(tmp_path / 'cache'))
+    db.upsert('seeing', seeing([1], 0.5))
+    assert db.query(SQL)['seeing_mean'].tolist() == [0.5]
+    db.upsert('seeing', seeing([1], 0.7))
+    assert db.query(SQL)['seeing_mean'].tolist() == pytest.approx([0.7])
+    db.close()
@@ -0,0 +1,30 @@
+import pandas as pd
+import pytest
+
+from qadb.qadb import _convert, _getTable
+
+
+def testNullableIntegers():
+    df = _convert(_getTable('seeing'), pd.DataFrame({'pfs_visit_id': [1.0, None], 'seeing_mean': [0.5, 0.6]}))
+    assert str(df['pfs_visit_id'].dtype) == 'Int32'
+    assert df['pfs_visit_id'].tolist() == [1, pd.NA]
+    assert str(df['seeing_mean'].dtype) == 'float32'
+
+
+def testNonIntegral(db):
+    with pytest.raises(ValueError, match='seeing.pfs_visit_id'):
+        db.populateQATable('seeing', pd.DataFrame({'pfs_visit_id': [1.5], 'seeing_mean': [0.5]}))
+    assert len(db.query('SELECT * FROM seeing', cache=False)) == 0
+
+
+def testOutOfRange(db):
+    with pytest.raises(ValueError, match='seeing.pfs_visit_id.*Int32'):
+        db.populateQATable('seeing', pd.DataFrame({'pfs_visit_id': [2**40], 'seeing_mean': [0.5]}))
+    assert len(db.query('SELECT * FROM seeing', cache=False)) == 0
+
+
+def testPopulate(db):
+    db.populateQATable('seeing', pd.DataFrame({'pfs_visit_id': [1, 2], 'seeing_mean': [0.5, None]}))
+    df = db.query('SELECT * FROM seeing ORDER BY pfs_visit_id', cache=False)
+    assert df['pfs_visit_id'].tolist() == [1, 2]
+    assert pd.isna(df['seeing_mean'].iloc[1])
@@ -0,0 +1,18 @@
+import numpy as np
+import pandas as pd
+
+from qadb.qadb import _getTable, _toCSV
+
+
+def testNullableIntegers():
+    # pfs_design_id is missing for one row, so pandas holds the column as float64
+    df = pd.DataFrame({'pfs_visit_id': [5, 6], 'pfs_design_id': [7, None],
+                       'pfs_visit_description': ['a', None]})
+    assert df['pfs_design_id'].dtype == np.float64
+    lines = _toCSV(_getTable('pfs_visit'), df).read().splitlines()
+    assert lines == ['5,7,a', '6,,']
+
+
+def testColumnsKept():
+    df = pd.DataFrame({'seeing_mean': [0.5], 'pfs_visit_id': [1.0]})
+    assert _toCSV(_getTable('seeing'), df).read() == '0.5,1\n'
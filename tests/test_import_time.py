@@ -0,0 +1,17 @@
+import json
+import os
+import subprocess
+import sys
+
+BENCH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks', 'bench_import.py')
+
+
+def testImportBudget():
+    # each probe is a fresh interpreter; the command fails on the budget, the deferred imports
+    # (including those of qadb.writer and qadb.asyncqadb) and an engine created by QaDB()
+    proc = subprocess.run([sys.executable, BENCH, '--repeat', '3', '--json'], capture_output=True, text=True)
+    assert proc.returncode == 0, proc.stderr
+    result = json.loads(proc.stdout)
+    assert result['qadb_ms'] <= result['budget_ms']
+    assert result['deferred_imported'] == []
+    assert not result['engine_created']
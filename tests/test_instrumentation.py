@@ -0,0 +1,77 @@
+import pandas as pd
+import pytest
+
+from qadb.instrumentation import Instrumentation
+from qadb.qadb import QaDB, _copyChunk, _getTable
+
+
+class IntegrityError(Exception):
+    pass
+
+
+class Cursor(object):
+    ''' a DBAPI cursor of psycopg2 for COPY, with no server behind '''
+    def __init__(self, existing=0, failing=None):
+        self.existing = existing
+        self.failing = failing
+        self.rowcount = -1
+        self.statements = []
+
+    def execute(self, statement):
+        self.statements.append(statement)
+        if self.failing is not None and statement.startswith(self.failing):
+            raise IntegrityError('duplicate key value violates unique constraint')
+        self.rowcount = 2 if statement.startswith('INSERT') else -1
+
+    def copy_expert(self, statement, file):
+        self.statements.append(statement)
+        self.rowcount = len(file.read().splitlines())
+
+    def fetchone(self):
+        return (self.existing, )
+
+
+def statements(instrumentation):
+    return {(s['statement'], s['table']): s for s in instrumentation.snapshot()['statements']}
+
+
+def seeing():
+    return pd.DataFrame({'pfs_visit_id': [1, 2], 'seeing_mean': [0.5, 0.6]})
+
+
+def testStatementCounters(url):
+    db = QaDB(url, instrument=True)
+    db.upsert('pfs_visit', pd.DataFrame({'pfs_visit_id': [1, 2], 'pfs_design_id': [10, 20]}))
+    db.query('SELECT * FROM pfs_visit', cache=False)
+    db.instrumentation.count('retries', component='writer', table='pfs_visit')
+    s = statements(db.instrumentation)
+    assert s[('insert', 'pfs_visit')]['calls'] >= 1
+    assert s[('insert', 'pfs_visit')]['rows'] >= 2
+    assert s[('select', 'pfs_visit')]['calls'] >= 1
+    assert db.metrics()['counters'] == [{'name': 'retries', 'labels': {'component': 'writer', 'table': 'pfs_visit'},
+                                         'value': 1}]
+    assert 'qadb_retries_total{component="writer",table="pfs_visit"} 1' in db.exportMetrics()
+    db.close()
+
+
+def testCopyCounters():
+    instrumentation = Instrumentation()
+    cursor = Cursor(existing=1)
+    assert _copyChunk(cursor, _getTable('seeing'), seeing(), ['pfs_visit_id'], instrumentation) == \
+        {'inserted': 1, 'updated': 1}
+    s = statements(instrumentation)
+    # the statements on the raw cursor are labeled with the target table
+    assert set(s) == {('truncate', 'seeing'), ('copy', 'seeing'), ('select', 'seeing'), ('merge', 'seeing')}
+    assert (s[('copy', 'seeing')]['calls'], s[('copy', 'seeing')]['rows']) == (1, 2)
+    assert (s[('merge', 'seeing')]['calls'], s[('merge', 'seeing')]['rows']) == (1, 2)
+    assert s[('copy', 'seeing')]['seconds_total'] > 0
+
+
+def testCopyErrors():
+    instrumentation = Instrumentation()
+    with pytest.raises(IntegrityError):
+        _copyChunk(Cursor(failing='INSERT'), _getTable('seeing'), seeing(), ['pfs_visit_id'], instrumentation)
+    s = statements(instrumentation)
+    assert (s[('merge', 'seeing')]['calls'], s[('merge', 'seeing')]['errors'],
+            s[('merge', 'seeing')]['integrity_errors']) == (0, 1, 1)
+    assert s[('copy', 'seeing')]['errors'] == 0
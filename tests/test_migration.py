@@ -0,0 +1,72 @@
+import pandas as pd
+import pytest
+from alembic.migration import MigrationContext
+from alembic.operations import Operations
+from sqlalchemy import create_engine, exc
+
+from qadb import migration
+
+
+class LockNotAvailable(Exception):
+    pgcode = migration.LOCK_NOT_AVAILABLE
+
+
+def lockTimeout():
+    return exc.OperationalError('ALTER TABLE noise ...', {}, LockNotAvailable('canceling statement'))
+
+
+def populate(db, n):
+    db.upsert('pfs_visit', pd.DataFrame({'pfs_visit_id': range(n), 'pfs_design_id': range(n)}))
+    db.upsert('seeing', pd.DataFrame({'pfs_visit_id': range(n), 'seeing_mean': [float(i) for i in range(n)]}))
+
+
+def testBackfill(db, url):
+    populate(db, 25)
+    db.upsert('seeing', pd.DataFrame({'pfs_visit_id': [3], 'seeing_sigma': [-1.0]}))
+    progress = []
+    engine = create_engine(url)
+    with engine.connect() as conn:
+        context = MigrationContext.configure(conn)
+        with Operations.context(context), context.begin_transaction():
+            n = migration.backfill('seeing', {'seeing_sigma': 'seeing_mean * 2'}, where='seeing_sigma IS NULL',
+                                   batch_size=10, progress=lambda *args: progress.append(args))
+    engine.dispose()
+    # the batches of 10 keys, with the rows already filled skipped
+    assert n == 24
+    assert progress == [(9, 25), (19, 25), (24, 25)]
+    df = db.query('SELECT pfs_visit_id, seeing_sigma FROM seeing ORDER BY pfs_visit_id', cache=False)
+    assert df['seeing_sigma'].tolist() == [-1.0 if i == 3 else 2.0 * i for i in range(25)]
+
+
+def testRetryLocked():
+    calls = []
+
+    def alter():
+        calls.append(len(calls))
+        if len(calls) < 3:
+            raise lockTimeout()
+        return 'done'
+
+    assert migration._retryLocked(alter, 'alter', retries=5, interval=0) == 'done'
+    assert calls == [0, 1, 2]
+
+
+def testRetryGivesUp():
+    calls = []
+
+    def alter():
+        calls.append(len(calls))
+        raise lockTimeout()
+
+    with pytest.raises(exc.OperationalError):
+        migration._retryLocked(alter, 'alter', retries=2, interval=0)
+    assert len(calls) == 3
+
+    # the other errors are not retried
+    def fail():
+        calls.append(len(calls))
+        raise exc.OperationalError('ALTER TABLE noise ...', {}, Exception('syntax error'))
+
+    with pytest.raises(exc.OperationalError):
+        migration._retryLocked(fail, 'alter', retries=2, interval=0)
+    assert len(calls) == 4
@@ -0,0 +1,38 @@
+import pandas as pd
+import pytest
+
+from qadb import provision
+from qadb.qadb import QaDB
+
+pytest.importorskip('pyarrow')
+
+
+def testRoundTripNullIntegers(db, tmp_path, templateDir):
+    visits = pd.DataFrame({'pfs_visit_id': [1, 2, 3], 'pfs_design_id': [2**40, None, 7],
+                           'issued_at': pd.to_datetime(['2024-01-01 20:00', '2024-01-01 21:00', None])})
+    db.upsert('pfs_visit', visits)
+    assert db.export('pfs_visit', str(tmp_path / 'export')) == {'pfs_visit': 3}
+
+    other = QaDB(provision.clone_database(f'sqlite:///{tmp_path / "other.sqlite"}', cache_dir=templateDir))
+    try:
+        counts = other.import_parquet(str(tmp_path / 'export' / 'pfs_visit'))
+        assert counts == {'inserted': 3, 'updated': 0}
+        df = other.query('SELECT pfs_visit_id, pfs_design_id FROM pfs_visit ORDER BY pfs_visit_id', cache=False)
+    finally:
+        other.close()
+    assert df['pfs_visit_id'].tolist() == [1, 2, 3]
+    assert df['pfs_design_id'].iloc[0] == 2**40
+    assert pd.isna(df['pfs_design_id'].iloc[1])
+    assert df['pfs_design_id'].iloc[2] == 7
+
+
+def testImportDtypes(db, tmp_path, monkeypatch):
+    db.upsert('pfs_visit', pd.DataFrame({'pfs_visit_id': [1, 2], 'pfs_design_id': [5, None]}))
+    db.export('pfs_visit', str(tmp_path / 'export'))
+    chunks = []
+    monkeypatch.setattr(db, 'copy_into', lambda tableName, it: chunks.extend(it))
+    db.import_parquet(str(tmp_path / 'export' / 'pfs_visit'))
+    df = pd.concat(chunks)
+    # the integers with NULLs are not float64, which COPY would reject as '5.0'
+    assert str(df['pfs_design_id'].dtype) == 'Int64'
+    assert str(df['pfs_visit_id'].dtype) == 'Int32'
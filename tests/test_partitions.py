@@ -0,0 +1,44 @@
+import pytest
+from sqlalchemy import MetaData
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.schema import CreateTable
+
+from qadb import models, partitions, provision
+from qadb.qadb import _conflictKeys, _getTable
+
+
+def testModelKeys():
+    # the models are the same whichever layout the database has
+    for tableName in partitions.AGC_TABLES:
+        table = models.Base.metadata.tables[tableName]
+        assert [c.name for c in table.primary_key.columns] == ['pfs_visit_id', 'agc_exposure_id']
+        assert table.dialect_options['postgresql']['partition_by'] is None
+
+
+def testPartitionedTable():
+    metadata = MetaData()
+    models.Base.metadata.tables['pfs_visit'].to_metadata(metadata)
+    table = partitions.partitionedTable(models.Base.metadata.tables['seeing_agc_exposure'], metadata)
+    assert [c.name for c in table.primary_key.columns] == ['pfs_visit_id', 'agc_exposure_id', 'taken_at']
+    ddl = str(CreateTable(table).compile(dialect=postgresql.dialect()))
+    assert 'PARTITION BY RANGE (taken_at)' in ddl
+    assert 'REFERENCES pfs_visit (pfs_visit_id)' in ddl
+    assert {i.name for i in table.indexes} == {'ix_seeing_agc_exposure_taken_at',
+                                               'ix_seeing_agc_exposure_agc_exposure_id'}
+
+
+def testTemplateHash():
+    assert provision.metadata_hash('postgresql') != provision.metadata_hash('postgresql', partition_agc=True)
+
+
+def testSqliteRejected(tmp_path):
+    url = f'sqlite:///{tmp_path / "qadb.sqlite"}'
+    with pytest.raises(ValueError):
+        models.make_database(url, partition_agc=True)
+    with pytest.raises(ValueError):
+        provision.clone_database(url, cache_dir=tmp_path, partition_agc=True)
+
+
+def testConflictKeys(db):
+    with db._connect() as conn:
+        assert _conflictKeys(conn, _getTable('seeing_agc_exposure')) == ['pfs_visit_id', 'agc_exposure_id']
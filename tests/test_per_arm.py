@@ -0,0 +1,42 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+
+def populate(db):
+    db.upsert('pfs_visit', pd.DataFrame({'pfs_visit_id': [1, 2, 3], 'pfs_design_id': [1, 2, 3]}))
+    db.upsert('throughput', pd.DataFrame({'pfs_visit_id': [2, 1],
+                                          'throughput_b_mean': [0.2, 0.1],
+                                          'throughput_r_mean': [0.4, 0.3],
+                                          'throughput_m_median': [0.6, np.nan],
+                                          'wavelength_ref_b': [450.0, 451.0]}))
+
+
+def testRowShape(db):
+    populate(db)
+    result = db.per_arm('throughput')
+    assert list(result) == ['pfs_visit_id', 'arm', 'mean', 'median', 'sigma', 'wavelength_ref']
+    assert [result[k].dtype for k in result] == [np.int32, np.dtype('<U1')] + [np.float32] * 4
+    assert all(len(v) == 8 for v in result.values())
+    # a row for every arm of each visit, in the order of visit and arm
+    assert result['pfs_visit_id'].tolist() == [1, 1, 1, 1, 2, 2, 2, 2]
+    assert result['arm'].tolist() == ['b', 'm', 'n', 'r'] * 2
+    assert result['mean'][result['arm'] == 'r'].tolist() == pytest.approx([0.3, 0.4])
+    assert result['wavelength_ref'][result['arm'] == 'b'].tolist() == [451.0, 450.0]
+    assert np.isnan(result['median']).tolist() == [True] * 5 + [False] + [True] * 2
+
+
+def testVisits(db):
+    populate(db)
+    result = db.per_arm('throughput', visits=[2, 3, 2])
+    assert result['pfs_visit_id'].tolist() == [2, 2, 2, 2]
+    assert result['arm'].tolist() == ['b', 'm', 'n', 'r']
+    assert result['mean'][0] == pytest.approx(0.2)
+
+
+def testExposureTime(db):
+    result = db.per_arm('exposure_time')
+    assert list(result) == ['pfs_visit_id', 'arm', 'effective_exposure_time']
+    assert all(len(v) == 0 for v in result.values())
+    with pytest.raises(ValueError):
+        db.per_arm('seeing')
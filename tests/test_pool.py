@@ -0,0 +1,63 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from qadb.qadb import QaDB
+
+
+def visits(n):
+    return pd.DataFrame({'pfs_visit_id': range(n), 'pfs_design_id': range(n)})
+
+
+def testCheckoutPerCall(url):
+    db = QaDB(url)
+    # nothing is opened until the first call
+    assert db._engineInstance is None
+    db.upsert('pfs_visit', visits(3))
+    assert len(db.query('SELECT * FROM pfs_visit', cache=False)) == 3
+    status = db.poolStatus()
+    # the connections are back in the pool between the calls
+    assert status['checked_out'] == 0
+    assert status['checked_in'] >= 1
+    assert status['checkouts'] >= 2
+    db.close()
+
+
+def testThreads(url):
+    db = QaDB(url, pool_size=2, max_overflow=0)
+    db.upsert('pfs_visit', visits(5))
+
+    def count(i):
+        return len(db.query(f'SELECT * FROM pfs_visit WHERE pfs_visit_id >= {i % 5}', cache=False))
+
+    with ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(count, range(40)))
+    assert results == [5 - i % 5 for i in range(40)]
+    status = db.poolStatus()
+    # no more connections than the pool size, all returned
+    assert (status['size'], status['checked_out']) == (2, 0)
+    assert 1 <= status['checked_in'] <= 2
+    assert status['checkouts'] >= 40
+    db.close()
+
+
+def testWaitTime(url):
+    db = QaDB(url, pool_size=1, max_overflow=0)
+    held = threading.Event()
+
+    def hold():
+        with db._connect():
+            held.set()
+            time.sleep(0.3)
+
+    thread = threading.Thread(target=hold)
+    thread.start()
+    held.wait()
+    # waits for the connection held by the other thread
+    assert len(db.query('SELECT * FROM pfs_visit', cache=False)) == 0
+    thread.join()
+    assert db.poolStatus()['wait_time_max'] >= 0.2
+    assert db.poolStatus()['wait_time_total'] >= db.poolStatus()['wait_time_max']
+    db.close()
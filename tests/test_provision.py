@@ -0,0 +1,20 @@
+import pytest
+from sqlalchemy import create_engine, inspect
+
+from qadb import provision
+
+
+def testNoReplaceByDefault(url, templateDir):
+    with pytest.raises(ValueError):
+        provision.clone_database(url, cache_dir=templateDir)
+    with pytest.raises(ValueError):
+        provision.create_database(url)
+    engine = create_engine(url)
+    assert inspect(engine).has_table('pfs_visit')
+    engine.dispose()
+
+    provision.create_database(url, replace=True)
+    engine = create_engine(url)
+    assert not inspect(engine).has_table('pfs_visit')
+    engine.dispose()
+    assert provision.clone_database(url, cache_dir=templateDir, replace=True) == url
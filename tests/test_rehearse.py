@@ -0,0 +1,76 @@
+import textwrap
+
+import pytest
+from sqlalchemy import create_engine, text
+
+from qadb import rehearse
+
+ENV = '''
+from alembic import context
+
+context.configure(connection=context.config.attributes['connection'], transaction_per_migration=True)
+with context.begin_transaction():
+    context.run_migrations()
+'''
+
+# as the first revisions of the environments, the first one alters a table made before alembic
+REVISION = '''
+from alembic import op
+import sqlalchemy as sa
+
+revision = {revision!r}
+down_revision = {down!r}
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('pfs_visit', sa.Column({column!r}, sa.REAL(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('pfs_visit', {column!r})
+'''
+
+
+@pytest.fixture
+def alembicDir(tmp_path):
+    versions = tmp_path / 'alembic' / 'qadb' / 'alembic' / 'versions'
+    versions.mkdir(parents=True)
+    (versions.parent / 'env.py').write_text(ENV)
+    for revision, down, column in [('aaaa00000001', None, 'note_a'), ('aaaa00000002', 'aaaa00000001', 'note_b')]:
+        (versions / f'{revision}.py').write_text(textwrap.dedent(REVISION.format(
+            revision=revision, down=down, column=column)))
+    return str(tmp_path / 'alembic')
+
+
+def baseline(path):
+    url = f'sqlite:///{path}'
+    engine = create_engine(url)
+    with engine.begin() as conn:
+        conn.execute(text('CREATE TABLE pfs_visit (pfs_visit_id INTEGER PRIMARY KEY, issued_at DATETIME)'))
+    engine.dispose()
+    return url
+
+
+def testRehearseFromBaseline(tmp_path, alembicDir):
+    url = f'sqlite:///{tmp_path / "rehearse.sqlite"}'
+    report = rehearse.rehearse(url, revision='aaaa00000002', visits=10, alembicDir=alembicDir,
+                               schemaFrom=baseline(tmp_path / 'baseline.sqlite'))
+    assert report['meta']['start'] == 'aaaa00000001'
+    assert report['meta']['rows'] == {'pfs_visit': 10}
+    assert [(s['direction'], s['revision']) for s in report['steps']] == \
+        [('upgrade', 'aaaa00000002'), ('downgrade', 'aaaa00000002')]
+    engine = create_engine(url)
+    with engine.connect() as conn:
+        # built by the upgrade to the start revision, and back there after the rehearsal
+        columns = [r[1] for r in conn.execute(text('PRAGMA table_info(pfs_visit)'))]
+        assert conn.execute(text('SELECT version_num FROM alembic_version')).scalar() == 'aaaa00000001'
+    engine.dispose()
+    assert columns == ['pfs_visit_id', 'issued_at', 'note_a']
+
+
+def testRehearseWithoutBaseline(tmp_path, alembicDir):
+    url = f'sqlite:///{tmp_path / "rehearse.sqlite"}'
+    with pytest.raises(ValueError, match='schema_from'):
+        rehearse.rehearse(url, revision='aaaa00000002', visits=10, alembicDir=alembicDir)
@@ -0,0 +1,84 @@
+import datetime
+
+import pandas as pd
+import pytest
+
+from qadb import rollup
+from qadb.qadb import QaDB
+
+
+def testNightOf(monkeypatch):
+    assert rollup.nightOf('2024-01-01 13:00') == datetime.date(2024, 1, 1)
+    assert rollup.nightOf('2024-01-02 03:00') == datetime.date(2024, 1, 1)
+    assert rollup.nightOf('2024-01-01 11:59') == datetime.date(2023, 12, 31)
+    # noon HST is 22:00 UTC
+    assert rollup.nightOf(pd.Timestamp('2024-01-01 22:30', tz='UTC')) == datetime.date(2024, 1, 1)
+    monkeypatch.setattr(rollup, 'ISSUED_AT_TZ', datetime.timezone.utc)
+    assert rollup.nightOf('2024-01-01 21:59') == datetime.date(2023, 12, 31)
+    assert rollup.nightOf('2024-01-02 09:00') == datetime.date(2024, 1, 1)
+    assert rollup.nightStart('2024-01-01') == datetime.datetime(2024, 1, 1, 22)
+
+
+def visits(ids, times):
+    return pd.DataFrame({'pfs_visit_id': ids, 'issued_at': pd.to_datetime(times)})
+
+
+def seeing(ids, values):
+    return pd.DataFrame({'pfs_visit_id': ids, 'seeing_mean': values})
+
+
+def nightly(db):
+    sql = "SELECT night, number_of_visits, mean, refreshed_at FROM qa_rollup_nightly WHERE metric = 'seeing'"
+    df = db.query(sql + ' ORDER BY night', cache=False)
+    df['night'] = [rollup._toDate(n) for n in df['night']]
+    return df.set_index('night')
+
+
+@pytest.fixture
+def rollupDB(url):
+    db = QaDB(url, refresh_rollup=True)
+    db.upsert('pfs_visit', visits([1, 2, 3, 4], ['2024-01-01 20:00', '2024-01-02 03:00',
+                                                 '2024-01-05 20:00', '2024-02-01 20:00']))
+    yield db
+    db.close()
+
+
+def testIncrementalRefresh(rollupDB, monkeypatch):
+    db = rollupDB
+    db.upsert('seeing', seeing([1, 2, 3, 4], [0.5, 0.7, 0.9, 1.1]))
+    df = nightly(db)
+    assert df['number_of_visits'].to_dict() == {datetime.date(2024, 1, 1): 2, datetime.date(2024, 1, 5): 1,
+                                                datetime.date(2024, 2, 1): 1}
+    assert df.loc[datetime.date(2024, 1, 1), 'mean'] == pytest.approx(0.6)
+    # the months are left to refreshRollup
+    assert len(db.query('SELECT * FROM qa_rollup_monthly', cache=False)) == 0
+    assert db.refreshRollup() == {'nights': 0, 'months': 2}
+
+    # only the rows of the touched night are read
+    ranges = []
+    summaryRows = rollup._summaryRows
+    monkeypatch.setattr(rollup, '_summaryRows', lambda conn, r: ranges.append(r) or summaryRows(conn, r))
+    db.upsert('seeing', seeing([3], [1.3]))
+    assert [[tuple(r) for r in rs] for rs in ranges] == [[(datetime.date(2024, 1, 5), datetime.date(2024, 1, 5))]]
+    after = nightly(db)
+    assert after.loc[datetime.date(2024, 1, 5), 'mean'] == pytest.approx(1.3)
+    assert after.loc[datetime.date(2024, 1, 1), 'refreshed_at'] == df.loc[datetime.date(2024, 1, 1), 'refreshed_at']
+
+    # then only the month of the night is recomputed
+    ranges.clear()
+    assert db.refreshRollup() == {'nights': 0, 'months': 1}
+    assert [[tuple(r) for r in rs] for rs in ranges] == [[(datetime.date(2024, 1, 1), datetime.date(2024, 1, 31))]]
+    monthly = db.query("SELECT month, mean FROM qa_rollup_monthly WHERE metric = 'seeing' ORDER BY month",
+                       cache=False)
+    assert monthly['mean'].tolist() == pytest.approx([(0.5 + 0.7 + 1.3) / 3, 1.1])
+
+
+def testChangedNights(url, monkeypatch):
+    monkeypatch.setattr(rollup, 'ISSUED_AT_TZ', datetime.timezone.utc)
+    db = QaDB(url)
+    # 21:00 UTC is 11:00 HST, in the night before
+    db.upsert('pfs_visit', visits([1, 2], ['2024-01-01 21:00', '2024-01-01 23:00']))
+    db.upsert('seeing', seeing([1, 2], [0.5, 0.7]))
+    assert db.refreshRollup(monthly=False) == {'nights': 2, 'months': 0}
+    assert sorted(nightly(db).index) == [datetime.date(2023, 12, 31), datetime.date(2024, 1, 1)]
+    db.close()
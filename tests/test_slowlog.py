@@ -0,0 +1,36 @@
+import json
+
+import pandas as pd
+import pytest
+
+from qadb.qadb import QaDB
+
+
+def entries(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def testSlowQueryEntry(url, tmp_path):
+    path = tmp_path / 'slow.jsonl'
+    # the EXPLAIN runs on the connection of the query, so a single connection is enough
+    db = QaDB(url, pool_size=1, max_overflow=0, pool_timeout=1, slow_query_threshold=0,
+              slow_query_log=str(path), slow_query_explain='plan')
+    db.upsert('pfs_visit', pd.DataFrame({'pfs_visit_id': [1, 2], 'pfs_design_id': [10, 20]}))
+    df = db.query('SELECT * FROM pfs_visit WHERE pfs_visit_id > :v', params={'v': 0}, cache=False)
+    assert len(df) == 2
+    with pytest.raises(Exception):
+        db.query('SELECT * FROM no_such_table', cache=False)
+    db.close()
+
+    entry, failed = entries(path)
+    assert entry['sql'] == 'SELECT * FROM pfs_visit WHERE pfs_visit_id > :v'
+    assert entry['params'] == {'v': 0}
+    assert entry['rows'] == 2
+    assert entry['error'] is None
+    assert entry['duration'] >= 0
+    # EXPLAIN QUERY PLAN of SQLite, not a failure to check out a connection
+    assert isinstance(entry['plan'], list)
+    assert 'pfs_visit' in ' '.join(str(v) for row in entry['plan'] for v in row)
+    assert 'no such table' in failed['error']
+    assert failed['rows'] is None
@@ -0,0 +1,45 @@
+import numpy as np
+import pandas as pd
+from sqlalchemy import select
+
+from qadb.qadb import _getTable
+
+SQL = 'SELECT agc_exposure_id, taken_at, seeing_median FROM seeing_agc_exposure ORDER BY agc_exposure_id'
+
+
+def populate(db):
+    db.upsert('pfs_visit', pd.DataFrame({'pfs_visit_id': [1], 'pfs_design_id': [10]}))
+    db.upsert('seeing_agc_exposure', pd.DataFrame({
+        'pfs_visit_id': [1, 1, 1], 'agc_exposure_id': [1, 2, 3], 'seeing_median': [1.0, None, 3.0],
+        'taken_at': pd.to_datetime(['2024-01-01 00:01', '2024-01-01 00:02', '2024-01-01 00:03'])}))
+
+
+def statement():
+    table = _getTable('seeing_agc_exposure')
+    return select(table.c.agc_exposure_id, table.c.taken_at, table.c.seeing_median) \
+        .order_by(table.c.agc_exposure_id)
+
+
+def testQueryChunks(db):
+    populate(db)
+    for sqlCmd in [SQL, statement()]:
+        chunks = list(db.queryChunks(sqlCmd, chunksize=2))
+        assert [len(df) for df in chunks] == [2, 1]
+        df = pd.concat(chunks, ignore_index=True)
+        expected = db.query(sqlCmd, cache=False)
+        assert df['taken_at'].dtype.kind == 'M'
+        assert df['taken_at'].tolist() == expected['taken_at'].tolist()
+        assert df['agc_exposure_id'].tolist() == [1, 2, 3]
+        assert df['seeing_median'].isna().tolist() == [False, True, False]
+
+
+def testQueryRecords(db):
+    populate(db)
+    for sqlCmd in [SQL, statement()]:
+        chunks = list(db.queryRecords(sqlCmd, chunksize=2))
+        assert [len(rec) for rec in chunks] == [2, 1]
+        rec = np.concatenate(chunks)
+        assert rec.dtype['taken_at'] == np.dtype('datetime64[us]')
+        assert rec['taken_at'].tolist() == db.query(sqlCmd, cache=False)['taken_at'].tolist()
+        assert rec['agc_exposure_id'].tolist() == [1, 2, 3]
+        assert np.isnan(rec['seeing_median']).tolist() == [False, True, False]
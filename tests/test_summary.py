@@ -0,0 +1,80 @@
+import asyncio
+
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine, text
+
+from qadb.qadb import QaDB
+
+
+def dropTable(url, tableName):
+    engine = create_engine(url)
+    with engine.begin() as conn:
+        conn.execute(text(f'DROP TABLE {tableName}'))
+    engine.dispose()
+
+
+def visits():
+    return pd.DataFrame({'pfs_visit_id': [1, 2], 'pfs_design_id': [10, 11],
+                         'issued_at': pd.to_datetime(['2024-01-01 20:00', '2024-01-02 03:00'])})
+
+
+def testRefresh(db):
+    db.upsert('pfs_visit', visits())
+    db.upsert('seeing', pd.DataFrame({'pfs_visit_id': [1], 'seeing_mean': [0.5]}))
+    df = db.query('SELECT pfs_visit_id, seeing_mean FROM visit_summary ORDER BY pfs_visit_id', cache=False)
+    assert df['pfs_visit_id'].tolist() == [1, 2]
+    assert df['seeing_mean'].iloc[0] == 0.5
+    assert pd.isna(df['seeing_mean'].iloc[1])
+
+
+def testWithoutSummaryTable(url):
+    # e.g. the databases of the e2e environments
+    dropTable(url, 'visit_summary')
+    db = QaDB(url)
+    assert db.upsert('pfs_visit', visits()) == {'inserted': 2, 'updated': 0}
+    assert db.update('pfs_visit', visits()) == 2
+    db.close()
+
+
+def testAsyncWithoutSummaryTable(url):
+    pytest.importorskip('aiosqlite')
+    from qadb.asyncqadb import AsyncQaDB
+    dropTable(url, 'visit_summary')
+
+    async def run():
+        db = AsyncQaDB(url.replace('sqlite://', 'sqlite+aiosqlite://'))
+        try:
+            return await db.upsert('pfs_visit', visits())
+        finally:
+            await db.close()
+
+    assert asyncio.run(run()) == {'inserted': 2, 'updated': 0}
+
+
+def testQadbOnlyTablesRequired(url):
+    # the maintenance of the qadb-only tables is rejected on the e2e databases
+    dropTable(url, 'visit_summary')
+    db = QaDB(url)
+    with pytest.raises(ValueError, match='alembic/qadb'):
+        db.refreshVisitSummary()
+    with pytest.raises(ValueError, match='alembic/qadb'):
+        db.refreshRollup()
+    db.close()
+
+
+def testQadbOnlyReads(url):
+    # the per-arm views and the rollups are read only from the databases of alembic/qadb
+    engine = create_engine(url)
+    with engine.begin() as conn:
+        conn.execute(text('DROP VIEW throughput_per_arm'))
+    engine.dispose()
+    dropTable(url, 'qa_rollup_nightly')
+    db = QaDB(url)
+    with pytest.raises(ValueError, match='throughput_per_arm.*alembic/qadb'):
+        db.per_arm('throughput')
+    with pytest.raises(ValueError, match='alembic/qadb'):
+        db.rollup('seeing')
+    # the other views are still there
+    assert len(db.per_arm('noise')['arm']) == 0
+    db.close()
@@ -0,0 +1,81 @@
+import numpy as np
+import pandas as pd
+
+from qadb.qadb import _updateStatement
+
+
+def rows(db, sql):
+    return db.query(sql, cache=False)
+
+
+def visits(ids, designs):
+    return pd.DataFrame({'pfs_visit_id': ids, 'pfs_design_id': designs})
+
+
+def detectorMap(values):
+    return pd.DataFrame({'run_id': [1, 1, 1], 'spectrograph': [1, 1, 2], 'arm': ['b', 'r', 'b'],
+                         'residual_wavelength_mean': values})
+
+
+def testUpsertCounts(db):
+    assert db.upsert('pfs_visit', visits([1, 2, 3], [10, 20, 30])) == {'inserted': 3, 'updated': 0}
+    # the duplicated key in the batch is written once, with its last row
+    assert db.upsert('pfs_visit', visits([2, 3, 4, 4], [21, 31, 40, 41])) == {'inserted': 1, 'updated': 2}
+    df = rows(db, 'SELECT pfs_visit_id, pfs_design_id FROM pfs_visit ORDER BY pfs_visit_id')
+    assert df['pfs_design_id'].tolist() == [10, 21, 31, 41]
+
+
+def testPopulateQATable(db):
+    db.upsert('pfs_visit', visits([1], [10]))
+    counts = db.populateQATable('seeing', pd.DataFrame({'pfs_visit_id': [1, 2], 'seeing_mean': [0.5, 0.6],
+                                                        'not_a_column': [0, 0]}))
+    assert counts == {'inserted': 2, 'updated': 0}
+    assert db.populateQATable('seeing', pd.DataFrame({'pfs_visit_id': [2], 'seeing_mean': [0.7]})) == \
+        {'inserted': 0, 'updated': 1}
+
+
+def testCopyIntoChunks(db):
+    # on SQLite each chunk goes through the batched upsert
+    chunks = iter([visits([1, 2], [10, 20]), visits([2, 3], [21, 30])])
+    assert db.copy_into('pfs_visit', chunks) == {'inserted': 3, 'updated': 1}
+
+
+def testCompositeKeyUpsert(db):
+    assert db.upsert('detector_map', detectorMap([0.1, 0.2, 0.3])) == {'inserted': 3, 'updated': 0}
+    assert db.upsert('detector_map', detectorMap([0.1, 0.25, 0.3]).iloc[[1]]) == {'inserted': 0, 'updated': 1}
+    df = rows(db, 'SELECT spectrograph, arm, residual_wavelength_mean FROM detector_map '
+                  'ORDER BY spectrograph, arm')
+    assert np.allclose(df['residual_wavelength_mean'], [0.1, 0.25, 0.3])
+
+
+def testCompositeKeyUpdate(db):
+    db.upsert('detector_map', detectorMap([0.1, 0.2, 0.3]))
+    # only (1, 1, 'r') matches, and NaN is written as NULL
+    df = pd.DataFrame({'run_id': [1, 1], 'spectrograph': [1, 3], 'arm': ['r', 'r'],
+                       'residual_wavelength_mean': [np.nan, 0.9]})
+    assert db.update('detector_map', df) == 1
+    df = rows(db, 'SELECT spectrograph, arm, residual_wavelength_mean FROM detector_map '
+                  'ORDER BY spectrograph, arm')
+    assert df[['spectrograph', 'arm']].values.tolist() == [[1, 'b'], [1, 'r'], [2, 'b']]
+    assert df['residual_wavelength_mean'].isna().tolist() == [False, True, False]
+
+
+def testUpdateStatementCached(db):
+    db.upsert('detector_map', detectorMap([0.1, 0.2, 0.3]))
+    db.update('detector_map', detectorMap([0.4, 0.5, 0.6]))
+    hits = _updateStatement.cache_info().hits
+    assert db.update('detector_map', detectorMap([0.7, 0.8, 0.9])) == 3
+    assert _updateStatement.cache_info().hits == hits + 1
+
+
+def testGeneratedKeys(db):
+    # test.test_id is left to the database
+    df = pd.DataFrame({'test_val1': [1, 2], 'test_val2': [0.5, np.nan], 'test_val3': ['a', 'b'],
+                       'test_val4': pd.to_datetime(['2024-01-01', '2024-01-02'])})
+    assert db.populateQATable('test', df) == {'inserted': 2, 'updated': 0}
+    assert db.populateQATable('test', df.iloc[:1]) == {'inserted': 1, 'updated': 0}
+    # with the keys, the rows are upserted as in the other tables
+    assert db.populateQATable('test', pd.DataFrame({'test_id': [1], 'test_val1': [9]})) == \
+        {'inserted': 0, 'updated': 1}
+    df = rows(db, 'SELECT test_id, test_val1, test_val3 FROM test ORDER BY test_id')
+    assert df.values.tolist() == [[1, 9, 'a'], [2, 2, 'b'], [3, 1, 'a']]
@@ -0,0 +1,136 @@
+import json
+import time
+
+import pandas as pd
+import pytest
+from sqlalchemy import exc
+
+from qadb.qadb import QaDB
+from qadb.writer import _Spool
+
+
+def rows(db, sql):
+    return db.query(sql, cache=False)
+
+
+def deadLetters(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def testWrite(db, tmp_path):
+    with db.writer(max_delay=0.05, spool=str(tmp_path / 'spool.sqlite')) as writer:
+        writer.put('pfs_visit', {'pfs_visit_id': 1, 'pfs_design_id': 10})
+        writer.put('seeing', [{'pfs_visit_id': 1, 'seeing_mean': 0.5}, {'pfs_visit_id': 2, 'seeing_mean': 0.6}])
+        assert writer.flush(timeout=10)
+        assert writer.metrics()['spooled'] == 0
+    assert rows(db, 'SELECT pfs_visit_id FROM seeing ORDER BY pfs_visit_id')['pfs_visit_id'].tolist() == [1, 2]
+
+
+def testPutValidates(db):
+    with db.writer() as writer:
+        with pytest.raises(ValueError, match='unknown'):
+            writer.put('seeing', {'pfs_visit_id': 1, 'unknown': 0.5})
+        with pytest.raises(ValueError, match='non-integral'):
+            writer.put('seeing', {'pfs_visit_id': 1.5, 'seeing_mean': 0.5})
+        with pytest.raises(ValueError, match='primary key'):
+            writer.put('seeing', {'seeing_mean': 0.5})
+        assert writer.metrics()['queue_depth'] == 0
+
+
+def testPartialRecords(db):
+    # each put writes only its own columns, in the order of the puts
+    with db.writer(max_delay=10) as writer:
+        writer.put('throughput', {'pfs_visit_id': 1, 'throughput_b_mean': 0.9})
+        writer.put('throughput', {'pfs_visit_id': 1, 'throughput_r_mean': 0.8})
+        writer.put('throughput', {'pfs_visit_id': 1, 'throughput_b_mean': 0.7, 'throughput_r_mean': 0.6})
+        writer.put('throughput', {'pfs_visit_id': 2, 'throughput_b_mean': 0.5})
+        writer.put('throughput', {'pfs_visit_id': 2, 'throughput_r_mean': 0.4})
+        assert writer.flush(timeout=10)
+    df = rows(db, 'SELECT pfs_visit_id, throughput_b_mean, throughput_r_mean FROM throughput ORDER BY pfs_visit_id')
+    assert df['throughput_b_mean'].tolist() == pytest.approx([0.7, 0.5])
+    assert df['throughput_r_mean'].tolist() == pytest.approx([0.6, 0.4])
+
+
+def testPoisonRecord(db, tmp_path):
+    deadLetter = str(tmp_path / 'dead.jsonl')
+    spool = str(tmp_path / 'spool.sqlite')
+    with db.writer(max_delay=10, spool=spool, dead_letter=deadLetter) as writer:
+        writer.put('seeing_agc_exposure', {'pfs_visit_id': 1, 'agc_exposure_id': 1, 'seeing_median': 0.5})
+        # NULL in the primary key fails in the database (NOT NULL), not in put
+        writer.put('seeing_agc_exposure', {'pfs_visit_id': 1, 'agc_exposure_id': None, 'seeing_median': 0.6})
+        writer.put('seeing_agc_exposure', {'pfs_visit_id': 1, 'agc_exposure_id': 2, 'seeing_median': 0.7})
+        writer.put('seeing', {'pfs_visit_id': 1, 'seeing_mean': 0.5})
+        assert writer.flush(timeout=10)
+        metrics = writer.metrics()
+        assert metrics['dead_letters'] == 1
+        assert metrics['spooled'] == 0
+    assert rows(db, 'SELECT agc_exposure_id FROM seeing_agc_exposure')['agc_exposure_id'].tolist() == [1, 2]
+    assert len(rows(db, 'SELECT * FROM seeing')) == 1
+    letters = deadLetters(deadLetter)
+    assert [d['table_name'] for d in letters] == ['seeing_agc_exposure']
+    assert 'IntegrityError' in letters[0]['error']
+    assert letters[0]['records']['data'][0][2] == pytest.approx(0.6)
+
+
+def testSpoolReplay(url, tmp_path):
+    spool = str(tmp_path / 'spool.sqlite')
+    deadLetter = str(tmp_path / 'dead.jsonl')
+    # left by a crash, including a record which cannot be written
+    left = _Spool(spool)
+    left.append('seeing', pd.DataFrame({'pfs_visit_id': [1, 2], 'seeing_mean': [0.5, 0.6]}))
+    left.append('seeing', pd.DataFrame({'pfs_visit_id': [3], 'no_such_column': [0.7]}))
+    left.append('no_such_table', pd.DataFrame({'pfs_visit_id': [4]}))
+    left.close()
+
+    db = QaDB(url)
+    with db.writer(spool=spool, dead_letter=deadLetter) as writer:
+        assert writer.metrics()['replayed'] == 1
+        assert writer.flush(timeout=10)
+    assert rows(db, 'SELECT pfs_visit_id FROM seeing ORDER BY pfs_visit_id')['pfs_visit_id'].tolist() == [1, 2]
+    assert len(deadLetters(deadLetter)) == 2
+    spooled = _Spool(spool)
+    assert spooled.count() == 0
+    spooled.close()
+    db.close()
+
+
+def testRetryPerTable(db, monkeypatch):
+    upsert = db.upsert
+    down = {'seeing'}
+
+    def failing(tableName, df):
+        if tableName in down:
+            raise exc.OperationalError('INSERT', {}, Exception('the server is down'))
+        return upsert(tableName, df)
+
+    monkeypatch.setattr(db, 'upsert', failing)
+    with db.writer(max_delay=0.01, retry_interval=0.05) as writer:
+        writer.put('seeing', {'pfs_visit_id': 1, 'seeing_mean': 0.5})
+        writer.put('sky', {'pfs_visit_id': 1, 'sky_background_b_mean': 10.0})
+        assert not writer.flush(timeout=0.5)
+        # the other table is written while seeing is retried
+        assert len(rows(db, 'SELECT * FROM sky')) == 1
+        assert writer.metrics()['errors'] > 0
+        down.clear()
+        assert writer.flush(timeout=10)
+    assert len(rows(db, 'SELECT * FROM seeing')) == 1
+
+
+def testCloseWhileDown(url, tmp_path):
+    spool = str(tmp_path / 'spool.sqlite')
+    down = QaDB(f'sqlite:///{tmp_path / "no_such_dir" / "qadb.sqlite"}')
+    writer = down.writer(max_delay=0.01, max_queue=2, spool=spool, retry_interval=0.05)
+    for i in range(4):
+        writer.put('seeing', {'pfs_visit_id': i, 'seeing_mean': 0.5}, timeout=1)
+    t0 = time.monotonic()
+    writer.close(timeout=0.5)
+    assert time.monotonic() - t0 < 5
+
+    # replayed by the next writer
+    db = QaDB(url)
+    with db.writer(spool=spool) as writer:
+        assert writer.metrics()['replayed'] == 4
+        assert writer.flush(timeout=10)
+    assert len(rows(db, 'SELECT * FROM seeing')) == 4
+    db.close()